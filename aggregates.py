@@ -0,0 +1,575 @@
+## This page builds the shared aggregates that all sales charts are computed from
+
+import os
+import weakref
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+# Dimensions of the monthly cube, every sales chart can be answered from a roll-up of it
+CUBE_DIMENSIONS = ['month', 'location', 'product_name', 'sales_channel', 'fulfillment_status']
+
+# Dimensions and measures of the daily cube, used for day-level trends and anomaly detection
+DAILY_DIMENSIONS = ['day', 'location', 'product_name', 'sales_channel']
+DAILY_MEASURES = ['product_revenue', 'lines', 'refunded_lines', 'discounted_lines']
+
+
+class SalesAggregates:
+    """
+    Pre-aggregated views of the sales data, computed in one pass over the line items.
+
+    - monthly_cube: revenue, discount, refund, quantity, line, order and refunded order counts per month,
+      location, product, sales channel and fulfillment status (an order is counted in the cell of its first
+      line, a refunded order in the cell of its first refunded line)
+    - daily_cube: revenue, line, refunded line and discounted line counts per day, location, product
+      and sales channel
+    - hourly: product revenue per hour of the order date
+    - orders: one row per order_id with the month of its first line and its discount/refund/fulfilled flags
+    - discount_codes: number of line items per normalized discount code
+    - product_totals / location_totals: revenue and line counts per product and per location
+
+    Aggregates of two datasets can be combined with combine(), which is how new sales data is
+    appended without reprocessing the full history.
+    """
+
+    def __init__(self, monthly_cube, daily_cube, hourly, orders, discount_codes, product_totals, location_totals):
+        self.monthly_cube = monthly_cube
+        self.daily_cube = daily_cube
+        self.hourly = hourly
+        self.orders = orders
+        self.discount_codes = discount_codes
+        self.product_totals = product_totals
+        self.location_totals = location_totals
+        self._monthly_totals = None
+        self._rollups = {}
+
+    @classmethod
+    def from_frame(cls, sales_data, existing_orders=None, refunded_orders=None):
+        """
+        Builds all aggregates from the sales line items.
+        Orders listed in existing_orders (when appending) are not counted again in the monthly cube, nor
+        are the refunds of orders listed in refunded_orders.
+        """
+        lines = cube_lines(sales_data, existing_orders, refunded_orders)
+        monthly_cube = lines.groupby(CUBE_DIMENSIONS, dropna=False, observed=True).sum()
+
+        lines['day'] = _naive_utc(sales_data['order_date']).dt.floor('D')
+        daily_cube = lines.groupby(DAILY_DIMENSIONS, dropna=False, observed=True)[DAILY_MEASURES].sum()
+
+        return cls(
+            monthly_cube,
+            daily_cube,
+            hourly_revenue(sales_data),
+            order_flags(sales_data, lines['month']),
+            discount_code_counts(sales_data),
+            totals_by(monthly_cube, 'product_name'),
+            totals_by(monthly_cube, 'location')
+        )
+
+    def combine(self, other):
+        """
+        Returns the aggregates of both datasets together. Costs time proportional to the size
+        of the aggregates, not to the number of line items behind them.
+        """
+        monthly_cube = pd.concat(_align_categories(self.monthly_cube, other.monthly_cube))
+        monthly_cube = monthly_cube.groupby(level=CUBE_DIMENSIONS, dropna=False, observed=True).sum()
+
+        daily_cube = pd.concat(_align_categories(self.daily_cube, other.daily_cube))
+        daily_cube = daily_cube.groupby(level=DAILY_DIMENSIONS, dropna=False, observed=True).sum()
+
+        hourly = pd.concat([self.hourly, other.hourly]).groupby(level=0).sum()
+
+        # Orders continued in the new data get their flags merged with the existing rows
+        orders = pd.concat([self.orders, other.orders])
+        if orders.index.has_duplicates:
+            orders = orders.groupby(level=0).agg(
+                {'month': 'min', 'discounted': 'max', 'refunded': 'max', 'fulfilled': 'max'}
+            )
+
+        discount_codes = self.discount_codes.add(other.discount_codes, fill_value=0).astype('int64')
+
+        return SalesAggregates(
+            monthly_cube,
+            daily_cube,
+            hourly,
+            orders,
+            discount_codes,
+            pd.concat([self.product_totals, other.product_totals]).groupby(level=0).sum(),
+            pd.concat([self.location_totals, other.location_totals]).groupby(level=0).sum()
+        )
+
+    def append(self, new_rows):
+        """
+        Returns the aggregates updated with new sales line items.
+        """
+        return self.combine(build_aggregates(
+            new_rows, existing_orders=self.orders.index, refunded_orders=self.orders.index[self.orders['refunded']]
+        ))
+
+    def monthly_totals(self):
+        """
+        Returns all cube measures summed per month (sorted by month).
+        """
+        if self._monthly_totals is None:
+            self._monthly_totals = self.monthly_cube.groupby(level='month', observed=True).sum()
+        return self._monthly_totals
+
+    def rollup(self, levels):
+        """
+        Returns all cube measures summed over the given cube dimensions (cached per list of dimensions).
+        """
+        key = tuple(levels)
+        if key not in self._rollups:
+            self._rollups[key] = self.monthly_cube.groupby(level=list(levels), dropna=False, observed=True).sum()
+        return self._rollups[key]
+
+
+def _align_categories(left, right):
+    # Returns both cubes with the union of the categories of each categorical index level (sorted, as
+    # read from CSV files): concatenating levels with different categories would fall back to strings
+    for level, (left_level, right_level) in enumerate(zip(left.index.levels, right.index.levels)):
+        if isinstance(left_level.dtype, pd.CategoricalDtype) and isinstance(right_level.dtype, pd.CategoricalDtype) \
+                and left_level.dtype != right_level.dtype:
+            dtype = union_categoricals([left_level, right_level], sort_categories=True).dtype
+            left = left.set_axis(left.index.set_levels(left_level.astype(dtype), level=level))
+            right = right.set_axis(right.index.set_levels(right_level.astype(dtype), level=level))
+    return left, right
+
+
+def cube_lines(sales_data, existing_orders=None, refunded_orders=None):
+    """
+    Returns the monthly cube dimensions and measures of every sales line item, the cube is their sum
+    per group of CUBE_DIMENSIONS. An order is counted ('orders') on its first line only, so the order
+    counts of any group of lines add up to its distinct orders; a refunded order ('refunded_orders')
+    likewise on its first refunded line.
+    Orders listed in existing_orders (when appending) are not counted again, nor are orders listed in
+    refunded_orders counted as refunded again.
+    """
+    discount = sales_data['discount_amount']
+    refund = sales_data['refund_amount']
+
+    first_lines = first_order_lines(sales_data)
+    if existing_orders is not None:
+        first_lines &= ~sales_data['order_id'].isin(existing_orders)
+    first_refunds = first_refund_lines(sales_data)
+    if refunded_orders is not None:
+        first_refunds &= ~sales_data['order_id'].isin(refunded_orders)
+
+    return cube_dimensions(sales_data).assign(**{
+        'product_revenue': sales_data['product_revenue'],
+        'revenue_lines': sales_data['product_revenue'].notna(),
+        'total_sales_revenue': sales_data['total_sales_revenue'],
+        # Floats whatever the discount type, also when where masks nothing (e.g. no line items)
+        'discounted_amount': discount.where(discount > 0).astype('float64'),
+        'discounted_lines': discount > 0,
+        'refund_amount': refund,
+        'refunded_lines': refund > 0,
+        'quantity_sold': sales_data['quantity_sold'],
+        'lines': 1,
+        'orders': first_lines,
+        'refunded_orders': first_refunds
+    })
+
+
+def first_order_lines(sales_data):
+    """
+    Returns whether each sales line item is the first line of its order (False for lines without order_id).
+    """
+    return sales_data['order_id'].notna() & ~sales_data['order_id'].duplicated()
+
+
+def first_refund_lines(sales_data):
+    """
+    Returns whether each sales line item is the first refunded line of its order (False for lines without order_id).
+    """
+    refunded_orders = sales_data['order_id'].where(sales_data['refund_amount'] > 0)
+    return refunded_orders.notna() & ~refunded_orders.duplicated()
+
+
+def cube_dimensions(sales_data):
+    """
+    Returns the monthly cube dimensions (CUBE_DIMENSIONS, labels normalized) of every sales line item.
+    """
+    return pd.DataFrame({
+        'month': _naive_utc(sales_data['order_date']).dt.to_period('M'),
+        'location': normalize_labels(sales_data['location']),
+        'product_name': normalize_labels(sales_data['product_name'], lower=False),
+        'sales_channel': normalize_labels(sales_data['sales_channel'], lower=False),
+        'fulfillment_status': normalize_labels(sales_data['fulfillment_status'])
+    })
+
+
+def _duckdb_aggregates(sales_data, existing_orders=None, refunded_orders=None):
+    # DuckDB is an optional dependency, only imported when its backend is selected
+    from duckdb_backend import duckdb_aggregates
+    return duckdb_aggregates(sales_data, existing_orders, refunded_orders)
+
+
+def _polars_aggregates(sales_data, existing_orders=None, refunded_orders=None):
+    # Polars is an optional dependency, only imported when its backend is selected
+    from polars_backend import polars_aggregates
+    return polars_aggregates(sales_data, existing_orders, refunded_orders)
+
+
+# Backends the aggregates can be computed with; all of them build the same SalesAggregates
+AGGREGATE_BACKENDS = {
+    'pandas': SalesAggregates.from_frame,
+    'duckdb': _duckdb_aggregates,
+    'polars': _polars_aggregates
+}
+
+# Backend used for new datasets, configured with the DASHLIT_BACKEND environment variable
+AGGREGATE_BACKEND = os.environ.get('DASHLIT_BACKEND', 'pandas').strip().lower()
+
+
+def build_aggregates(sales_data, existing_orders=None, refunded_orders=None, backend=None):
+    """
+    Builds the SalesAggregates of sales line items with the given backend (the configured one by default).
+    When appending, existing_orders and refunded_orders are the orders and refunded orders of the data
+    appended to (see SalesAggregates.from_frame).
+    """
+    backend = backend or AGGREGATE_BACKEND
+    if backend not in AGGREGATE_BACKENDS:
+        raise ValueError(f"Unknown aggregate backend '{backend}', expected one of: {', '.join(AGGREGATE_BACKENDS)}")
+    return AGGREGATE_BACKENDS[backend](sales_data, existing_orders, refunded_orders)
+
+
+# Label columns the backends read as codes of their normalized categories, and whether they are lowercased
+ENCODED_LABELS = {
+    'location': True,
+    'product_name': False,
+    'sales_channel': False,
+    'fulfillment_status': True,
+    'discount_code': True
+}
+
+# Numeric sales columns the backends read
+ENCODED_MEASURES = ['product_revenue', 'total_sales_revenue', 'discount_amount', 'refund_amount', 'quantity_sold']
+
+
+def encoded_lines(sales_data):
+    """
+    Returns the sales columns the aggregate backends read as a dict of column name -> array, so they
+    group numbers only and labels are decoded once per group:
+    'line' (row number), 'order_id' (codes of the distinct order ids, -1 if missing), 'order_date'
+    (naive UTC), the label columns as codes of their normalized categories (-1 if missing) and the
+    numeric columns. Also returns the categories of every label column and the distinct order ids.
+    """
+    labels = {column: normalize_labels(sales_data[column], lower=lower) for column, lower in ENCODED_LABELS.items()}
+    order_codes, order_ids = pd.factorize(sales_data['order_id'])
+    columns = {
+        'line': np.arange(len(sales_data)),
+        'order_id': order_codes,
+        'order_date': _naive_utc(sales_data['order_date']).to_numpy(),
+        **{column: values.cat.codes.to_numpy() for column, values in labels.items()},
+        **{column: sales_data[column].to_numpy() for column in ENCODED_MEASURES}
+    }
+    categories = {column: values.cat.categories for column, values in labels.items()}
+    return columns, categories, order_ids
+
+
+def renumber_codes(codes, order):
+    """
+    Returns codes renumbered so that code order[i] becomes i (missing codes, -1, are kept).
+    Used by the backends to number the order ids in sorted order, like the index of order_flags.
+    """
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order))
+    return np.where(codes >= 0, ranks[np.maximum(codes, 0)], -1) if len(order) else codes
+
+
+def _decode_groups(groups, categories, timestamp=None, to_period=False):
+    # Label codes back to the normalized categoricals, truncated timestamps to months or days
+    groups = groups.copy()
+    for column in groups.columns.intersection(list(categories)):
+        groups[column] = pd.Categorical.from_codes(groups[column].to_numpy(), categories=categories[column])
+    if timestamp is not None:
+        values = pd.to_datetime(groups[timestamp]).astype('datetime64[ns]')
+        groups[timestamp] = values.dt.to_period('M') if to_period else values
+    return groups
+
+
+def assemble_aggregates(sales_data, monthly, daily, hourly, orders, discount_codes, categories, order_ids):
+    """
+    Builds the SalesAggregates of a backend from its grouped results, label columns still as codes
+    (see encoded_lines). The groups are grouped once more with pandas, which costs time proportional
+    to the number of groups and gives the cubes exactly the index of the pandas backend.
+
+    Parameters:
+        - monthly / daily: one row per group of the cube dimensions ('month' / 'day' truncated timestamps)
+          with the cube measures.
+        - hourly: 'hour_start' (naive UTC) and 'product_revenue', sorted by hour.
+        - orders: 'order_id' (codes into order_ids, sorted), 'month' (truncated timestamp) and the order flags.
+        - discount_codes: 'discount_code' (codes) and 'lines', sorted by code.
+        - categories / order_ids: as returned by encoded_lines, order_ids in sorted order.
+    """
+    monthly_cube = _decode_groups(monthly, categories, 'month', to_period=True).groupby(
+        CUBE_DIMENSIONS, dropna=False, observed=True
+    ).sum()
+    daily_cube = _decode_groups(daily, categories, 'day').groupby(
+        DAILY_DIMENSIONS, dropna=False, observed=True
+    )[DAILY_MEASURES].sum()
+
+    hour_start = pd.DatetimeIndex(pd.to_datetime(hourly['hour_start']).astype('datetime64[ns]'), name='hour_start')
+    if getattr(sales_data['order_date'].dt, 'tz', None) is not None:
+        hour_start = hour_start.tz_localize('UTC').tz_convert(sales_data['order_date'].dt.tz)
+    hourly = pd.Series(hourly['product_revenue'].to_numpy(), index=hour_start, name='product_revenue')
+
+    orders = _decode_groups(orders, categories, 'month', to_period=True)
+    orders.index = pd.Index(order_ids, name='order_id')[orders.pop('order_id').to_numpy()]
+
+    discount_codes = pd.Series(
+        discount_codes['lines'].to_numpy(dtype='int64'),
+        index=pd.Index(categories['discount_code'][discount_codes['discount_code'].to_numpy()], dtype=object, name='discount_code'),
+        name='discount_code'
+    )
+
+    return SalesAggregates(
+        monthly_cube,
+        daily_cube,
+        hourly,
+        orders,
+        discount_codes,
+        totals_by(monthly_cube, 'product_name'),
+        totals_by(monthly_cube, 'location')
+    )
+
+
+def backend_differences(sales_data, backend, reference='pandas'):
+    """
+    Returns the aggregates a backend computes differently from the reference backend for the same
+    sales data, as a dict of aggregate name -> description of the difference (empty if they all match).
+    Sums may differ by rounding only, as backends add values up in a different order.
+    """
+    aggregates = build_aggregates(sales_data, backend=backend)
+    expected = build_aggregates(sales_data, backend=reference)
+    differences = {}
+    for name in ['monthly_cube', 'daily_cube', 'hourly', 'orders', 'discount_codes', 'product_totals', 'location_totals']:
+        compare = pd.testing.assert_series_equal if isinstance(getattr(expected, name), pd.Series) else pd.testing.assert_frame_equal
+        try:
+            compare(getattr(aggregates, name), getattr(expected, name), check_exact=False, rtol=1e-9)
+        except AssertionError as e:
+            differences[name] = str(e)
+    return differences
+
+
+def _naive_utc(order_date):
+    # Periods carry no timezone, convert to UTC first so months match the UTC timestamps
+    if getattr(order_date.dt, 'tz', None) is not None:
+        return order_date.dt.tz_convert(None)
+    return order_date
+
+
+def hourly_revenue(sales_data):
+    """
+    Returns product revenue per hour of the order date.
+    """
+    hourly = sales_data['product_revenue'].groupby(sales_data['order_date'].dt.floor('h')).sum()
+    hourly.index.name = 'hour_start'
+    return hourly
+
+
+def order_flags(sales_data, month=None):
+    """
+    Returns one row per order_id with the month of its first line and whether any of its lines was
+    discounted, refunded or fulfilled.
+    """
+    if month is None:
+        month = _naive_utc(sales_data['order_date']).dt.to_period('M')
+    return pd.DataFrame({
+        'order_id': sales_data['order_id'],
+        'month': month,
+        'discounted': sales_data['discount_amount'] > 0,
+        'refunded': sales_data['refund_amount'] > 0,
+        'fulfilled': normalize_labels(sales_data['fulfillment_status']) == 'fulfilled'
+    }).groupby('order_id').agg(
+        month=('month', 'min'),
+        discounted=('discounted', 'max'),
+        refunded=('refunded', 'max'),
+        fulfilled=('fulfilled', 'max')
+    )
+
+
+def discount_code_counts(sales_data):
+    """
+    Returns the number of line items per normalized discount code.
+    """
+    codes = normalize_labels(sales_data['discount_code'])
+    discount_codes = codes.groupby(codes, observed=True).size()
+    discount_codes.index = discount_codes.index.astype(object).rename('discount_code')
+    return discount_codes
+
+
+def totals_by(monthly_cube, level):
+    """
+    Returns revenue and revenue line counts of the monthly cube per value of one of its dimensions.
+    """
+
+    totals = monthly_cube.groupby(level=level, observed=True)[['product_revenue', 'revenue_lines']].sum()
+    totals.index = totals.index.astype(object).rename(level)
+    return totals
+
+
+def normalize_labels(values, lower=True):
+    """
+    Returns values as a categorical with surrounding whitespace stripped (and lowercased).
+
+    The values are dictionary-encoded first and only the distinct values are normalized, then the
+    codes are remapped, so the string work scales with the number of distinct labels, not rows.
+    Already normalized categoricals are returned as they are.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes, uniques = values.cat.codes.to_numpy(), values.cat.categories
+    else:
+        codes, uniques = pd.factorize(values)
+        uniques = pd.Index(uniques)
+
+    labels = uniques.astype(str).str.strip()
+    if lower:
+        labels = labels.str.lower()
+    if isinstance(values.dtype, pd.CategoricalDtype) and labels.equals(uniques) and uniques.is_monotonic_increasing:
+        return values
+
+    # Normalized labels can collide (e.g. 'London' and 'london '), factorize them again and remap the codes
+    label_codes, categories = pd.factorize(labels, sort=True)
+    if len(label_codes):
+        codes = np.where(codes >= 0, label_codes[codes], -1)
+    categorical = pd.Categorical.from_codes(codes, categories=categories)
+    return pd.Series(categorical, index=values.index, name=values.name)
+
+
+class FrameCache:
+    """
+    Values computed from a frame, kept for as long as the frame is alive.
+    Frames are not hashable, so entries are keyed by identity and dropped when the frame is collected.
+    """
+
+    def __init__(self):
+        self._values = {}
+
+    def get(self, frame):
+        cached = self._values.get(id(frame))
+        if cached is not None and cached[0]() is frame:
+            return cached[1]
+        return None
+
+    def set(self, frame, value):
+        key = id(frame)
+        self._values[key] = (weakref.ref(frame, lambda _: self._values.pop(key, None)), value)
+
+
+# Aggregates are cached per sales frame for as long as the frame is alive
+_AGGREGATES = FrameCache()
+
+
+def remember_aggregates(sales_data, aggregates, weak=False):
+    """
+    Registers already computed aggregates for a sales frame, e.g. after appending new data.
+
+    Parameters:
+        - weak: keep only a weak reference to the aggregates, for aggregates that hold the frame
+          themselves (e.g. a filtered view and its line items), so the entry does not keep both alive.
+    """
+    _AGGREGATES.set(sales_data, weakref.ref(aggregates) if weak else aggregates)
+
+
+def sales_aggregates(sales_data):
+    """
+    Returns the SalesAggregates for a sales frame, computing them on first use (with the configured backend).
+    Charts may also be handed a SalesAggregates object directly.
+    """
+    if isinstance(sales_data, SalesAggregates):
+        return sales_data
+    aggregates = _AGGREGATES.get(sales_data)
+    if isinstance(aggregates, weakref.ref):
+        aggregates = aggregates()
+    if aggregates is None:
+        aggregates = build_aggregates(sales_data)
+        remember_aggregates(sales_data, aggregates)
+    return aggregates
+
+
+def breakdown_metrics(measures):
+    """
+    Returns revenue, orders, average order value, refund rate (% of orders with a refunded line, as the
+    refund rate gauge) and discount rate (% of line items discounted) from summed cube measures, e.g. a
+    rollup of the monthly cube.
+    """
+    lines = measures['lines'].where(measures['lines'] > 0)
+    orders = measures['orders'].where(measures['orders'] > 0)
+    return pd.DataFrame({
+        'product_revenue': measures['product_revenue'],
+        'orders': measures['orders'],
+        'aov': measures['product_revenue'] / orders,
+        'refund_rate': measures['refunded_orders'] / orders * 100,
+        'discount_rate': measures['discounted_lines'] / lines * 100
+    }, index=measures.index)
+
+
+# Metrics that are rates: their period-over-period change is a difference in percentage points
+RATE_METRICS = ['refund_rate', 'discount_rate']
+
+# Period comparisons are cached per aggregates object and lag
+_COMPARISONS = FrameCache()
+
+
+def period_comparison(sales_data, lag):
+    """
+    Returns the monthly metrics (see breakdown_metrics) next to the same metrics lag months earlier
+    (12 for year over year, 1 for month over month) and the change between them: % change for
+    revenue, orders and AOV, percentage points for the rates.
+
+    Derived by shifting the cached monthly totals on a complete month index, no line items are read.
+    Columns are '<metric>', '<metric>_previous' and '<metric>_change', one row per month.
+    """
+    aggregates = sales_aggregates(sales_data)
+    comparisons = _COMPARISONS.get(aggregates)
+    if comparisons is None:
+        comparisons = {}
+        _COMPARISONS.set(aggregates, comparisons)
+    if lag in comparisons:
+        return comparisons[lag]
+
+    totals = aggregates.monthly_totals()
+    if totals.empty:
+        months = pd.PeriodIndex([], freq='M', name='month')
+    else:
+        months = pd.period_range(totals.index.min(), totals.index.max(), freq='M', name='month')
+    metrics = breakdown_metrics(totals.reindex(months, fill_value=0))
+    previous = metrics.reindex(months - lag).set_axis(months)
+
+    change = (metrics / previous.where(previous != 0) - 1) * 100
+    change[RATE_METRICS] = metrics[RATE_METRICS] - previous[RATE_METRICS]
+
+    comparison = pd.concat(
+        [metrics, previous.add_suffix('_previous'), change.add_suffix('_change')], axis=1
+    )
+    comparisons[lag] = comparison
+    return comparison
+
+
+def safe_ratio(numerator, denominator):
+    """
+    Returns numerator / denominator, or NaN when the denominator is zero.
+    """
+    return numerator / denominator if denominator else np.nan
+
+
+if __name__ == '__main__':
+    # Parity check of every backend against pandas over the sample CSVs
+    import sys
+    from data_store import load_sales_data
+
+    paths = sys.argv[1:] or [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app_files', 'sample_sales_data.csv')]
+    failed = False
+    for path in paths:
+        with open(path, 'rb') as file:
+            sample = load_sales_data([(os.path.basename(path), file.read())])
+        for backend in AGGREGATE_BACKENDS:
+            differences = backend_differences(sample, backend)
+            failed = failed or bool(differences)
+            print(f"{os.path.basename(path)} [{backend}]: {'OK' if not differences else ', '.join(differences)}")
+            for name, difference in differences.items():
+                print(f"  {name}: {difference}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,138 @@
+## This page flags anomalous days in the daily revenue, refund rate and discount rate series
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from aggregates import FrameCache, sales_aggregates
+
+# Measures that can be checked: the daily cube measure, the measure it is a rate of (if any) and the
+# sales column it is derived from
+ANOMALY_MEASURES = {
+    'revenue': ('product_revenue', None, 'product_revenue'),
+    'refund_rate': ('refunded_lines', 'lines', 'refund_amount'),
+    'discount_rate': ('discounted_lines', 'lines', 'discount_amount')
+}
+
+# Series are scored in blocks of rows to bound the memory of the rolling windows
+_BLOCK_ROWS = 512
+
+
+def daily_series(sales_data, measure, by=None):
+    """
+    Returns a daily measure from the cached daily cube as a DataFrame with one row per value of by
+    ('location' or 'product_name'; a single 'total' row if by is None) and one column per consecutive day.
+
+    Days without sales have a revenue of 0 and a missing rate.
+    """
+    numerator, denominator, _ = ANOMALY_MEASURES[measure]
+    cube = sales_aggregates(sales_data).daily_cube
+    levels = ['day'] if by is None else [by, 'day']
+    daily = cube[[numerator] + ([denominator] if denominator else [])].groupby(level=levels, observed=True).sum()
+
+    if by is None:
+        daily = daily.T.rename(index={numerator: 'total', denominator: 'lines'})
+        values = daily.loc[['total']]
+        counts = daily.loc[['lines']].set_axis(['total']) if denominator else None
+    else:
+        values = daily[numerator].unstack('day')
+        counts = daily[denominator].unstack('day') if denominator else None
+        values.index = values.index.astype(object)
+
+    if counts is not None:
+        values = values / counts.where(counts > 0)
+    values = values.loc[:, values.columns.notna()]
+    if values.columns.empty:
+        return values
+    days = pd.date_range(values.columns.min(), values.columns.max(), freq='D')
+    values = values.reindex(columns=days)
+    return values if denominator else values.fillna(0)
+
+
+def _nanmedian(windows):
+    # Median over the last axis ignoring missing values: one sort moves them to the end of each window
+    ordered = np.sort(windows, axis=-1)
+    counts = np.count_nonzero(~np.isnan(windows), axis=-1)
+    lower = np.take_along_axis(ordered, np.maximum((counts - 1) // 2, 0)[..., None], axis=-1)[..., 0]
+    upper = np.take_along_axis(ordered, np.maximum(counts // 2, 0)[..., None], axis=-1)[..., 0]
+    return np.where(counts > 0, (lower + upper) / 2, np.nan), counts
+
+
+def rolling_robust_scores(values, window=28, min_periods=14):
+    """
+    Scores every day of every series against the window days before it with a robust z-score:
+    (value - rolling median) / (1.4826 * rolling median absolute deviation).
+
+    Parameters:
+        - values: 2D array, one row per series and one column per day (missing values allowed).
+        - window: Number of preceding days the baseline is computed from.
+        - min_periods: Minimum number of non-missing preceding days for a day to be scored.
+
+    Returns:
+        - (baseline, scores): the rolling medians and the scores, both shaped like values. Days that
+          cannot be scored (short history, or no spread in the history) have a missing score.
+    """
+    rows, days = values.shape
+    baseline = np.full((rows, days), np.nan)
+    scores = np.full((rows, days), np.nan)
+    if days == 0:
+        # No days to score (e.g. a selection without sales)
+        return baseline, scores
+    padded = np.concatenate([np.full((rows, window), np.nan), values], axis=1)
+
+    for start in range(0, rows, _BLOCK_ROWS):
+        block = slice(start, start + _BLOCK_ROWS)
+        # history[r, t] holds the window days before day t
+        history = sliding_window_view(padded[block, :-1], window, axis=1)
+        median, counts = _nanmedian(history)
+        deviation, _ = _nanmedian(np.abs(history - median[..., None]))
+        scale = 1.4826 * deviation
+        scored = (counts >= min_periods) & (scale > 0)
+
+        baseline[block] = median
+        scores[block] = np.where(scored, (values[block] - median) / np.where(scored, scale, 1), np.nan)
+    return baseline, scores
+
+
+# Scores are cached per dataset (its aggregates), measure, series dimension and window
+_SCORES = FrameCache()
+
+
+def anomaly_scores(sales_data, measure, by=None, window=28):
+    """
+    Returns the (cached) daily values, rolling baselines and robust scores of a measure as three
+    DataFrames shaped like daily_series(sales_data, measure, by).
+    """
+    aggregates = sales_aggregates(sales_data)
+    cached = _SCORES.get(aggregates)
+    if cached is None:
+        cached = {}
+        _SCORES.set(aggregates, cached)
+    key = (measure, by, window)
+    if key not in cached:
+        values = daily_series(aggregates, measure, by)
+        baseline, scores = rolling_robust_scores(values.to_numpy(dtype='float64'), window, max(window // 2, 1))
+        cached[key] = (
+            values,
+            pd.DataFrame(baseline, index=values.index, columns=values.columns),
+            pd.DataFrame(scores, index=values.index, columns=values.columns)
+        )
+    return cached[key]
+
+
+def daily_anomalies(sales_data, measure, by=None, window=28, threshold=3.5):
+    """
+    Returns the anomalous days of a measure, one row per series and day whose robust score exceeds
+    the threshold, with its value, baseline and score (most extreme first).
+    """
+    values, baseline, scores = anomaly_scores(sales_data, measure, by, window)
+    flagged = np.abs(scores.to_numpy()) > threshold
+    series, days = np.nonzero(flagged)
+    anomalies = pd.DataFrame({
+        by or 'series': values.index[series],
+        'day': values.columns[days],
+        'value': values.to_numpy()[series, days],
+        'baseline': baseline.to_numpy()[series, days],
+        'score': scores.to_numpy()[series, days]
+    })
+    return anomalies.iloc[np.argsort(-np.abs(anomalies['score'].to_numpy()), kind='stable')].reset_index(drop=True)
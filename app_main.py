@@ -1,16 +1,12 @@
 import streamlit as st
-import pandas as pd
-import plotly.express as px
-import requests
 import os
 import base64
+import hashlib
+import logging
+import mimetypes
 
-# Importing the defintions back from definition.py
-
-from definition import plot_total_sales_revenue_by_month, plot_total_sales_by_quarter_with_filter, plot_total_sales_by_year,plot_sales_growth_rate_by_month, plot_aov_by_month, plot_total_orders_by_quarter, plot_avg_discounted_amount, plot_discount_usage_rate
-from definition import plot_top_selling_products, plot_combined_product_sales_with_labels, segment_by_spend_level, plot_refund_rate_with_threshold_label, plot_fulfilled_order_rate_all_orders
-from definition import segment_by_order_frequency, visualize_customer_distribution_city, plot_customer_retention_rate_as_gauge, plot_sales_by_region
-from definition import plot_region_sales_growth, segment_by_location, plot_new_vs_returning_customers, plot_average_daily_and_hourly_sales_last_90_days, plot_top_discounts
+# Pandas, Plotly Express, the chart definitions and the data modules are imported by the pages that use
+# them, so the server starts and the Home page loads without them
 
 ###Page Setup
 st.set_page_config(
@@ -22,13 +18,136 @@ st.set_page_config(
 
 
 
+# Reference tables of the map chart, read from app_files, with the URL they are published at
+# (countries.csv is bundled; worldcities.csv is not, and is downloaded once per process, see reference_csv)
 url_cities = "https://raw.githubusercontent.com/benR24/dashlit_studio/refs/heads/main/app_files/worldcities.csv"
 
-world_cities = pd.read_csv(url_cities)
-
 url_countries = "https://raw.githubusercontent.com/benR24/dashlit_studio/refs/heads/main/app_files/countries.csv"
 
-world_countries = pd.read_csv(url_countries)
+
+logger = logging.getLogger(__name__)
+
+
+# Images of the pages and the page background, bundled in the static directory (served by Streamlit under
+# app/static, see .streamlit/config.toml) by file name, so the pages load no image from another site
+# (sources and licences of the files are listed in static/LICENSES.md)
+STATIC_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+STATIC_ASSETS = {
+    "background": "background.png",
+    "home_gif": "home.gif",
+    "github": "github.svg",
+    "vscode": "vscode.svg",
+    "python": "python.svg",
+    "plotly": "plotly.svg",
+    "streamlit": "streamlit.svg",
+    "openai": "openai.svg",
+    "shopify": "shopify.svg",
+    "linkedin": "linkedin.svg"
+}
+
+
+@st.cache_resource(show_spinner=False)
+def asset_url(name, inline=True):
+    """
+    Returns the URL of a static asset, computed once per server process.
+
+    Parameters:
+        - name: key of the asset in STATIC_ASSETS.
+        - inline: True for a data URI of the bundled file (base64-encoded), False for its URL under
+          app/static, versioned with a hash of its content so browsers keep it cached (PNG, JPEG, GIF and
+          WebP files only, Streamlit serves other types as plain text).
+    """
+    file_name = STATIC_ASSETS[name]
+    with open(os.path.join(STATIC_DIRECTORY, file_name), "rb") as file:
+        content = file.read()
+    if inline:
+        mime_type = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+        return f"data:{mime_type};base64,{base64.b64encode(content).decode()}"
+    return f"app/static/{file_name}?v={hashlib.blake2b(content, digest_size=8).hexdigest()}"
+
+
+APP_FILES_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app_files")
+
+
+# Sample CSVs offered on the Documentation page, read once per server process
+@st.cache_resource(show_spinner=False)
+def sample_csv(file_name):
+    with open(os.path.join(APP_FILES_DIRECTORY, file_name), "rb") as file:
+        return file.read()
+
+
+def reference_csv(url):
+    # Path of the bundled copy of a reference table, or its URL if the copy is missing
+    path = os.path.join(APP_FILES_DIRECTORY, url.rsplit("/", 1)[-1])
+    if os.path.isfile(path):
+        return path
+    logger.warning("Reference table %s is not bundled, downloading it from %s", path, url)
+    return url
+
+
+# Reference tables of the map chart, read once per server process when the Data Analyzer needs them
+@st.cache_resource(show_spinner="Loading reference data...")
+def load_world_locations():
+    import pandas as pd
+    from definition import prepare_world_locations
+
+    world_cities = pd.read_csv(reference_csv(url_cities))
+    world_countries = pd.read_csv(reference_csv(url_countries))
+
+    # Normalize the reference tables once instead of on every map render
+    return prepare_world_locations(world_cities, world_countries)
+
+# BI adoption pie charts of the Home page, built once and shared by every session (they are only read)
+@st.cache_resource(show_spinner=False)
+def bi_adoption_figures():
+    # Graph objects only, so the Home page does not need pandas and Plotly Express
+    import plotly.graph_objects as go
+
+    # Data for SMEs and Large Enterprises
+    categories = ["Without BI Tools", "With BI Tools"]
+    values_smes = [78, 22]
+    values_enterprises = [20, 80]
+
+    # Define consistent colors for both charts
+    colors = [
+        "#FF5733",  # Bright Red-Orange
+        "#33FF57"   # Bright Green
+    ]
+
+    # SMEs Pie Chart
+    fig_smes = go.Figure(go.Pie(
+        labels=categories,
+        values=values_smes,
+        marker=dict(colors=colors),
+        textinfo='percent+label',
+        hovertemplate="Category=%{label}<br>Values=%{value}<extra></extra>"
+    ))
+    fig_smes.update_layout(title="SMEs BI Tools Adoption")
+    fig_smes.update_layout(
+    template='plotly_dark',
+    title_x=0.5,
+    plot_bgcolor='rgba(0,0,0,0)',  # Transparent plot background
+    paper_bgcolor='rgba(0,0,0,0)'  # Transparent paper background
+)
+
+    # Large Enterprises Pie Chart
+    fig_enterprises = go.Figure(go.Pie(
+        labels=categories,
+        values=values_enterprises,
+        marker=dict(colors=colors),
+        textinfo='percent+label',
+        hovertemplate="Category=%{label}<br>Values=%{value}<extra></extra>"
+    ))
+    fig_enterprises.update_layout(title="Large Enterprises BI Tools Adoption")
+    fig_enterprises.update_layout(
+    template='plotly_dark',
+    title_x=0.5,
+    plot_bgcolor='rgba(0,0,0,0)',  # Transparent plot background
+    paper_bgcolor='rgba(0,0,0,0)'  # Transparent paper background
+)
+
+    return fig_smes, fig_enterprises
+
 
 # Defintiion of the Navigation Pages
 def main():
@@ -83,56 +202,8 @@ def main():
         "The following pie chart illustrates the adoption rates of Business Intelligence (BI) tools in "
         "Small and Medium Enterprises (SMEs) versus Large Enterprises."
     )
-    # Replace Mermaid charts with Plotly pie charts
-    # Data for SMEs and Large Enterprises
-    data_smes = pd.DataFrame({
-        "Category": ["Without BI Tools", "With BI Tools"],
-        "Values": [78, 22]
-    })
-    data_enterprises = pd.DataFrame({
-        "Category": ["Without BI Tools", "With BI Tools"],
-        "Values": [20, 80]
-    })
-
-    # Define consistent colors for both charts
-    color_discrete_map = {
-        "Without BI Tools": "#FF5733",  # Bright Red-Orange
-        "With BI Tools": "#33FF57"     # Bright Green
-    }
-
-    # SMEs Pie Chart
-    fig_smes = px.pie(
-        data_smes,
-        names="Category",
-        values="Values",
-        title="SMEs BI Tools Adoption",
-        color="Category",
-        color_discrete_map=color_discrete_map
-    )
-    fig_smes.update_traces(textinfo='percent+label')
-    fig_smes.update_layout(
-    template='plotly_dark',
-    title_x=0.5,
-    plot_bgcolor='rgba(0,0,0,0)',  # Transparent plot background
-    paper_bgcolor='rgba(0,0,0,0)'  # Transparent paper background
-)
-
-    # Large Enterprises Pie Chart
-    fig_enterprises = px.pie(
-        data_enterprises,
-        names="Category",
-        values="Values",
-        title="Large Enterprises BI Tools Adoption",
-        color="Category",
-        color_discrete_map=color_discrete_map
-    )
-    fig_enterprises.update_traces(textinfo='percent+label')
-    fig_enterprises.update_layout(
-    template='plotly_dark',
-    title_x=0.5,
-    plot_bgcolor='rgba(0,0,0,0)',  # Transparent plot background
-    paper_bgcolor='rgba(0,0,0,0)'  # Transparent paper background
-)
+    # Replace Mermaid charts with Plotly pie charts (built once per server process)
+    fig_smes, fig_enterprises = bi_adoption_figures()
 
     # Display the charts side by side
     col1, col2 = st.columns(2)
@@ -173,7 +244,7 @@ def main():
 
         """)
 
-    st.image("https://y.yarn.co/e2d0eefa-60d4-4f91-a473-4eee8522eb6c_text.gif", caption="When your friend realizes you built a tool that does all the work for you! 😂🚀")
+    st.image(asset_url("home_gif"), caption="When your friend realizes you built a tool that does all the work for you! 😂🚀")
 
     st.markdown(
         """
@@ -203,6 +274,8 @@ def documentation_page():
     2. Upload the **two CSV files** using the file upload options in the sidebar or interface on the Sales Data Analyzer Page.
     3. Select the type of analysis you want from the drop down menus - sales, product or regional analysis.
 
+    Data split into several files (e.g. monthly exports) can be uploaded together, also compressed (`.gz`, `.zst`, `.bz2`, `.xz`, `.zip`).
+
     ---
     """)
     
@@ -228,6 +301,7 @@ def documentation_page():
         - `total_sales_revenue` (Numeric) - Revenue generated from the line-item product.
         - `location` (String) - The city or country(iso2) where the order was placed (e.g., 'London', 'Berlin', 'New York' or 'GB', 'US', 'DE').
         - `discount_code` (String) - The discount code applied to the order (if any).
+        - `customer_id` (String/Numeric, optional) - The customer who placed the order, links sales to the customer data.
         """)
 
     with col2:
@@ -283,33 +357,19 @@ def documentation_page():
     Below are links to download a sample sales & customer data as CSV file in order to test the tool:
     """)
 
-    # Define URLs for the sample CSV files
-    url_sales_sample = "https://raw.githubusercontent.com/benR24/dashlit_studio/refs/heads/main/app_files/sample_sales_data.csv"
-    url_customer_sample = "https://raw.githubusercontent.com/benR24/dashlit_studio/refs/heads/main/app_files/sample_customer_data.csv"
-
-    # Fetch the content of the sales sample CSV file from the URL
-    sales_sample_response = requests.get(url_sales_sample)
-    if sales_sample_response.status_code == 200:
-        st.download_button(
-            label="Download Sample Sales CSV",
-            data=sales_sample_response.content,
-            file_name="sample_sales_data.csv",
-            mime="text/csv"
-        )
-    else:
-        st.warning("Failed to load Sample Sales CSV. Please try again later.")
-
-    # Fetch the content of the customer sample CSV file from the URL
-    customer_sample_response = requests.get(url_customer_sample)
-    if customer_sample_response.status_code == 200:
-        st.download_button(
-            label="Download Sample Customer CSV",
-            data=customer_sample_response.content,
-            file_name="sample_customer_data.csv",
-            mime="text/csv"
-        )
-    else:
-        st.warning("Failed to load Sample Customer CSV. Please try again later.")
+    # The sample CSV files are bundled with the app
+    st.download_button(
+        label="Download Sample Sales CSV",
+        data=sample_csv("sample_sales_data.csv"),
+        file_name="sample_sales_data.csv",
+        mime="text/csv"
+    )
+    st.download_button(
+        label="Download Sample Customer CSV",
+        data=sample_csv("sample_customer_data.csv"),
+        file_name="sample_customer_data.csv",
+        mime="text/csv"
+    )
 
     # Title for the section
     # Title for the section
@@ -378,6 +438,7 @@ def documentation_page():
         st.write("**3. Retention Rate**")
         st.latex(r" \text{Retention Rate} = \frac{\text{Returning Customers}}{\text{Total Customers}} \times 100 ")
         st.write("Code-Block: `(Returning Customers ÷ Total Customers) * 100`")
+        st.write("Customers with an empty `returning_customer` value are left out of both counts, and shown as 'Unknown' in the new vs. returning chart.")
 
         st.markdown("""
         ---
@@ -389,7 +450,76 @@ def documentation_page():
 
 
 
+# Uploads parsed in the background, by kind
+UPLOAD_LABELS = {
+    "sales": "Sales data",
+    "customers": "Customer data",
+    "sales_append": "Appended sales data"
+}
+
+
+@st.fragment(run_every=0.5)
+def upload_progress(tasks):
+    """
+    Shows the progress of uploads being parsed in the background, refreshed every half second, and
+    reruns the page as soon as one of them is done so its data is shown.
+
+    Parameters:
+        - tasks: dict of upload kind -> UploadTask, not done when the page was drawn.
+    """
+    if any(task.done() for task in tasks.values()):
+        st.rerun()
+    for kind, task in tasks.items():
+        progress = task.progress
+        st.progress(
+            progress.fraction(),
+            text=f"{UPLOAD_LABELS[kind]}: {progress.step} "
+                 f"({progress.bytes_read / 1e6:,.1f} of {progress.total_bytes / 1e6:,.1f} MB read)"
+        )
+        # What is known about the data before it is ready
+        details = progress.details
+        if "rows" in details:
+            summary = f"📄 {details['rows']:,} rows"
+            if "first_date" in details:
+                summary += f", orders from {details['first_date']:%Y-%m-%d} to {details['last_date']:%Y-%m-%d}"
+            st.caption(summary)
+
+
+def sales_preview(sales_data):
+    """
+    Shows the size and date range of the sales data and the first chart that needs nothing else,
+    before the customer data is available.
+    """
+    from definition import TABS, SHARED_AGGREGATES, charts_for_tab
+    from schema import available_columns
+
+    st.subheader("Sales Data Preview")
+    summary = f"📄 {len(sales_data):,} rows"
+    if "order_date" in available_columns(sales_data) and len(sales_data):
+        summary += f", orders from {sales_data['order_date'].min():%Y-%m-%d} to {sales_data['order_date'].max():%Y-%m-%d}"
+    st.caption(summary)
+
+    available = {"sales": available_columns(sales_data)}
+    for spec in charts_for_tab(TABS[0]):
+        if spec.datasets == ["sales"] and not spec.controls and not spec.missing_inputs(available):
+            for aggregate in spec.aggregates:
+                SHARED_AGGREGATES[aggregate][1](sales_data)
+            st.plotly_chart(spec.function(sales_data), key="preview_chart")
+            break
+
+
 def data_analyzer_page():
+    # Importing the defintions back from definition.py
+    from definition import TABS, CHART_REGISTRY, SHARED_AGGREGATES, charts_for_tab, control_options
+    from filters import FilteredAggregates, filtered_sales, selection_values, selection_key, combine_selections, filter_options
+    from figure_cache import cached_figure
+    from precompute import aggregate_key, precompute_datasets
+
+    # Uploaded datasets are held once per server process and shared between sessions
+    from data_store import DATASET_STORE, UploadTask, content_key, load_sales_data, load_customer_data, append_sales_data
+    from data_store import UPLOAD_TYPES, dataset_hash
+    from schema import available_columns, validation_report
+
     st.title("Data Analyzer")
     st.sidebar.title("Upload Your Data")
     
@@ -403,31 +533,151 @@ def data_analyzer_page():
     if "customer_data" not in st.session_state:
         st.session_state.customer_data = None
 
-    
+    # Uploads parsed in background tasks that are not done yet in this run, by kind
+    loading = {}
+
+    def cancel_upload(kind):
+        task = st.session_state.pop(f"{kind}_task", None)
+        if task is not None:
+            task.cancel()
+
+    # Parse the upload in a background task, or return its result once the task is done (None until then)
+    def finish_upload(kind, key, loader, files, file_id):
+        task = st.session_state.get(f"{kind}_task")
+        if task is None or task.key != key:
+            # A different upload replaces the one still being parsed
+            cancel_upload(kind)
+            task = st.session_state[f"{kind}_task"] = UploadTask(
+                DATASET_STORE, key, loader, file_id=file_id,
+                total_bytes=sum(len(payload) for _, payload in files)
+            )
+        if not task.done():
+            loading[kind] = task
+            return None
+        # A failed task is kept, so its error is shown again without parsing the files again
+        new_lease = task.lease()
+        del st.session_state[f"{kind}_task"]
+        return new_lease
+
+    # Attach the session to the shared copy of the uploaded files (parsed only once per content)
+    def attach_upload(kind, uploaded_files, loader):
+        file_ids = tuple(uploaded_file.file_id for uploaded_file in uploaded_files)
+        lease = st.session_state.get(f"{kind}_lease")
+        if lease is not None and lease.file_id == file_ids:
+            cancel_upload(kind)
+            return lease.value
+        task = st.session_state.get(f"{kind}_task")
+        if task is not None and task.file_id == file_ids:
+            # Do not hash the files again on every rerun while they are parsed
+            key, files = task.key, []
+        else:
+            files = [(uploaded_file.name, uploaded_file.getvalue()) for uploaded_file in uploaded_files]
+            key = content_key(kind, *[payload for _, payload in files])
+        new_lease = finish_upload(kind, key, lambda progress: loader(files, progress), files, file_ids)
+        if new_lease is None:
+            return None
+        if lease is not None:
+            lease.release()
+        st.session_state[f"{kind}_lease"] = new_lease
+        st.session_state[f"{kind}_appended"] = []
+        return new_lease.value
+
+    # Append mode: merge recent orders into the current sales data, updating the cached aggregates incrementally
+    # (the current data is shown until they are merged)
+    def append_upload(uploaded_files):
+        appended = st.session_state.setdefault("sales_appended", [])
+        lease = st.session_state["sales_lease"]
+        new_files = [uploaded_file for uploaded_file in uploaded_files if uploaded_file.file_id not in appended]
+        if not new_files:
+            cancel_upload("sales_append")
+            return lease.value
+        files = [(uploaded_file.name, uploaded_file.getvalue()) for uploaded_file in new_files]
+        base = lease.value
+        key = content_key("sales", lease.key.encode(), *[payload for _, payload in files])
+        new_lease = finish_upload(
+            "sales_append", key, lambda progress: append_sales_data(base, files, progress), files, lease.file_id
+        )
+        if new_lease is None:
+            return lease.value
+        lease.release()
+        st.session_state["sales_lease"] = new_lease
+        appended.extend(uploaded_file.file_id for uploaded_file in new_files)
+        return new_lease.value
 
 
     # File upload logic with dynamic key (UPDATED)
+    # Several files (e.g. monthly exports) and compressed CSVs are accepted and combined into one dataset
     uploaded_sales = st.sidebar.file_uploader(
-        "Upload Sales Data CSV", type=["csv"], key=f"sales_{st.session_state.upload_key}"
+        "Upload Sales Data CSV", type=UPLOAD_TYPES, accept_multiple_files=True,
+        key=f"sales_{st.session_state.upload_key}"
     )
     uploaded_customers = st.sidebar.file_uploader(
-        "Upload Customer Data CSV", type=["csv"], key=f"customers_{st.session_state.upload_key}"
+        "Upload Customer Data CSV", type=UPLOAD_TYPES, accept_multiple_files=True,
+        key=f"customers_{st.session_state.upload_key}"
+    )
+    uploaded_sales_append = st.sidebar.file_uploader(
+        "Append New Sales Data CSV", type=UPLOAD_TYPES, accept_multiple_files=True,
+        key=f"sales_append_{st.session_state.upload_key}",
+        help="Adds recent orders to the uploaded sales data without reprocessing the full history."
     )
 
-    # Save uploaded files into session_state
-    if uploaded_sales:
-        st.session_state.sales_data = pd.read_csv(uploaded_sales)
-    if uploaded_customers:
-        st.session_state.customer_data = pd.read_csv(uploaded_customers)
+    # Save uploaded files into session_state (as references into the shared dataset store)
+    # Removing the files of an upload stops parsing them
+    try:
+        if uploaded_sales:
+            st.session_state.sales_data = attach_upload("sales", uploaded_sales, load_sales_data)
+            if uploaded_sales_append and st.session_state.sales_data is not None:
+                st.session_state.sales_data = append_upload(uploaded_sales_append)
+            else:
+                cancel_upload("sales_append")
+        else:
+            cancel_upload("sales")
+            cancel_upload("sales_append")
+        if uploaded_customers:
+            st.session_state.customer_data = attach_upload("customers", uploaded_customers, load_customer_data)
+        else:
+            cancel_upload("customers")
+    except Exception as e:
+        st.error(f"An error occurred while loading your data: {e}")
+
+    # Progress of the uploads still being parsed, until the page reruns with their data
+    if loading:
+        upload_progress(loading)
 
     # Check if session_state has data
     if st.session_state.sales_data is not None and st.session_state.customer_data is not None:
         try:
-            # Process data
-            st.session_state.sales_data['order_date'] = pd.to_datetime(
-                st.session_state.sales_data['order_date'], errors='coerce', utc=True
+            world_cities, world_countries = load_world_locations()
+
+            # Columns that passed validation decide which charts can be drawn
+            available = {
+                "sales": available_columns(st.session_state.sales_data),
+                "customers": available_columns(st.session_state.customer_data)
+            }
+
+            # Aggregates of every tab are precomputed in the background while the first charts are drawn
+            precomputation = precompute_datasets(
+                {
+                    "sales": st.session_state.sales_data,
+                    "customers": st.session_state.customer_data,
+                    "world_cities": world_cities,
+                    "world_countries": world_countries
+                },
+                available
             )
-            st.session_state.sales_data = st.session_state.sales_data.dropna(subset=['order_date'])
+
+            # Summarize values that could not be read as the documented types
+            reports = {
+                "Sales Data": validation_report(st.session_state.sales_data),
+                "Customer Data": validation_report(st.session_state.customer_data)
+            }
+            for name, report in reports.items():
+                if report is None:
+                    continue
+                issues = report[(report["bad_rows"] > 0) | ~report["available"]]
+                if not issues.empty:
+                    with st.sidebar.expander(f"⚠️ {name}: validation issues"):
+                        st.dataframe(issues)
 
             # Display raw data if checkbox is selected
             if st.sidebar.checkbox("Show raw data"):
@@ -439,58 +689,187 @@ def data_analyzer_page():
             # Dropdown menu for analysis
             analysis_menu = st.sidebar.selectbox(
                 "Choose Analysis",
-                ["Sales Analysis", "Product Analysis", "Demographic Analysis"]
+                TABS
             )
 
-            # Helper function to safely plot charts
-            def safe_plot(chart_function, *args, **kwargs):
+            # The filter options are read from the aggregates the background worker computes first
+            precomputation.wait("sales_aggregates", [st.session_state.sales_data])
+
+            # Global filters: apply to every sales chart (keyed by dataset so they reset for new data)
+            global_filter = {}
+            options = filter_options(st.session_state.sales_data)
+            filter_key = id(st.session_state.sales_data)
+            with st.sidebar.expander("Filters"):
+                months = [str(month) for month in options["month"]]
+                if len(months) > 1:
+                    start, end = st.select_slider(
+                        "Date range (months)",
+                        options=months,
+                        value=(months[0], months[-1]),
+                        key=f"filter_months_{filter_key}"
+                    )
+                    if (start, end) != (months[0], months[-1]):
+                        global_filter["month"] = selection_values("month", months[months.index(start):months.index(end) + 1])
+                for dimension, label in [("location", "Location"), ("sales_channel", "Sales Channel"), ("product_name", "Product")]:
+                    if options[dimension] and dimension in available["sales"]:
+                        selected = st.multiselect(label, options[dimension], key=f"filter_{dimension}_{filter_key}")
+                        if selected:
+                            global_filter[dimension] = selected
+                if global_filter:
+                    st.caption("Filters apply to the sales charts; customer charts show all customers.")
+
+            # Cross-filtering: points selected in a chart filter every other chart of the tab
+            cross_filter = {}
+            for spec in CHART_REGISTRY.values():
+                chart_state = st.session_state.get(f"select_{spec.name}") if spec.selection else None
+                points = chart_state["selection"]["points"] if chart_state else []
+                if points:
+                    cross_filter[spec.selection] = selection_values(spec.selection, {point["x"] for point in points})
+            if cross_filter:
+                st.info(
+                    "Filtered by chart selection: "
+                    + "; ".join(f"{dimension} = {', '.join(map(str, values))}" for dimension, values in cross_filter.items())
+                    + ". Double-click a chart to clear its selection."
+                )
+
+            # Selection a chart's sales data is filtered by: the global filters and the selections in the other charts
+            def selection_for(spec):
+                return combine_selections(
+                    global_filter,
+                    {dimension: values for dimension, values in cross_filter.items() if dimension != spec.selection}
+                )
+
+            # Sales data for a chart: the aggregates filtered by its selection
+            def sales_for(spec):
+                view = filtered_sales(st.session_state.sales_data, selection_for(spec))
+                if spec.row_level and isinstance(view, FilteredAggregates):
+                    return view.lines
+                return view
+
+            # Datasets passed to a chart, in the order of its declaration
+            def datasets_for(spec):
+                datasets = {
+                    "sales": lambda: sales_for(spec),
+                    "customers": lambda: st.session_state.customer_data,
+                    "world_cities": lambda: world_cities,
+                    "world_countries": lambda: world_countries
+                }
+                return {name: datasets[name]() for name in spec.datasets}
+
+            # Key of the data passed to a chart, in the order of its declaration: the dataset hashes (and filters)
+            def dataset_keys_for(spec):
+                keys = {
+                    "sales": lambda: (dataset_hash(st.session_state.sales_data), selection_key(selection_for(spec))),
+                    "customers": lambda: dataset_hash(st.session_state.customer_data),
+                    "world_cities": lambda: dataset_hash(world_cities),
+                    "world_countries": lambda: dataset_hash(world_countries)
+                }
+                return tuple(keys[name]() for name in spec.datasets)
+
+            # Charts of the selected tab (cheap ones first) whose input columns are all available
+            st.subheader(analysis_menu)
+            specs = []
+            for spec in charts_for_tab(analysis_menu):
+                missing = spec.missing_inputs(available)
+                if missing:
+                    st.info(f"Skipped chart {spec.name}: missing columns {', '.join(missing)}")
+                else:
+                    specs.append(spec)
+
+            # Shared aggregates are computed once per dataset they are built from, before any chart reads them
+            # (taken from the background precomputation when it already has them)
+            # A failing aggregate only fails the charts built from it, the other charts are still drawn
+            prepared = {}
+            failed_charts = {}
+            with st.spinner("Preparing aggregates..."):
+                for spec in specs:
+                    datasets = datasets_for(spec)
+                    for aggregate in spec.aggregates:
+                        names, build = SHARED_AGGREGATES[aggregate]
+                        arguments = [datasets[name] for name in names]
+                        key = aggregate_key(aggregate, arguments)
+                        if key not in prepared:
+                            prepared[key] = None
+                            try:
+                                if not precomputation.wait(aggregate, arguments):
+                                    build(*arguments)
+                            except Exception as e:
+                                prepared[key] = e
+                        if prepared[key] is not None:
+                            failed_charts.setdefault(spec.name, prepared[key])
+
+            # Controls are shown above the first chart using them; their value is shared by every chart of the tab
+            control_values = {}
+
+            def control_value(control):
+                if control not in control_values:
+                    label, options = control_options(control, available)
+                    control_values[control] = st.selectbox(
+                        label, list(options), format_func=options.get, key=f"control_{control}"
+                    ) if options else None
+                return control_values[control]
+
+            for spec in specs:
+                if spec.name in failed_charts:
+                    st.warning(f"Error generating chart {spec.name}: {failed_charts[spec.name]}")
+                    continue
                 try:
-                    st.plotly_chart(chart_function(*args, **kwargs))
+                    kwargs = {argument: control_value(control) for argument, control in spec.controls.items()}
+                    if any(value is None for value in kwargs.values()):
+                        continue
+                    datasets = datasets_for(spec)
+                    # Figures are built once per data and parameters, reruns reuse their JSON
+                    fig = cached_figure(
+                        spec.name, dataset_keys_for(spec), spec.function, *datasets.values(),
+                        time_relative=spec.time_relative, **kwargs
+                    )
+                    # Charts without data to show return no figure (e.g. the map when no location matches)
+                    if fig is None:
+                        continue
+                    if spec.selection:
+                        st.plotly_chart(fig, key=f"select_{spec.name}", on_select="rerun", selection_mode="points")
+                    else:
+                        st.plotly_chart(fig)
+
+                    # Tables behind the chart and downloads are computed from the same data
+                    if spec.details is not None:
+                        for title, table in spec.details(*datasets.values(), **kwargs).items():
+                            with st.expander(title):
+                                st.dataframe(table)
+                    if spec.download is not None:
+                        label, file_name, build = spec.download
+                        st.download_button(
+                            label=label,
+                            data=build(*datasets.values()).to_csv(index=False),
+                            file_name=file_name,
+                            mime="text/csv",
+                            key=f"download_{spec.name}"
+                        )
                 except Exception as e:
-                    st.warning(f"Error generating chart {chart_function.__name__}: {e}")
-
-            # Sales Analysis
-            if analysis_menu == "Sales Analysis":
-                st.subheader("Sales Analysis")
-                safe_plot(plot_total_sales_by_year, st.session_state.sales_data)
-                safe_plot(plot_total_sales_revenue_by_month, st.session_state.sales_data)
-                safe_plot(plot_total_sales_by_quarter_with_filter, st.session_state.sales_data)
-                safe_plot(plot_sales_growth_rate_by_month, st.session_state.sales_data)
-                safe_plot(plot_aov_by_month, st.session_state.sales_data)
-                safe_plot(plot_total_orders_by_quarter, st.session_state.sales_data)
-                safe_plot(plot_avg_discounted_amount, st.session_state.sales_data)
-                safe_plot(plot_discount_usage_rate, st.session_state.sales_data)
-                safe_plot(plot_top_discounts, st.session_state.sales_data, top_n=10)
-                safe_plot(plot_average_daily_and_hourly_sales_last_90_days, st.session_state.sales_data)
-
-            # Product Analysis
-            elif analysis_menu == "Product Analysis":
-                st.subheader("Product Analysis")
-                safe_plot(plot_top_selling_products, st.session_state.sales_data, top_n=10)
-                safe_plot(plot_combined_product_sales_with_labels, st.session_state.sales_data, top_n=10)
-                safe_plot(segment_by_spend_level, st.session_state.customer_data)
-                safe_plot(plot_refund_rate_with_threshold_label, st.session_state.sales_data)
-                safe_plot(plot_fulfilled_order_rate_all_orders, st.session_state.sales_data)
-                safe_plot(segment_by_order_frequency, st.session_state.customer_data)
-
-            # Regional Analysis
-            elif analysis_menu == "Demographic Analysis":
-                st.subheader("Demographic Analysis")
-                safe_plot(plot_sales_by_region, st.session_state.sales_data)
-                safe_plot(plot_region_sales_growth, st.session_state.sales_data)
-                safe_plot(segment_by_location, st.session_state.customer_data)
-                safe_plot(plot_customer_retention_rate_as_gauge, st.session_state.customer_data)
-                safe_plot(visualize_customer_distribution_city, st.session_state.customer_data, world_cities, world_countries)
-                safe_plot(plot_new_vs_returning_customers, st.session_state.customer_data)
+                    st.warning(f"Error generating chart {spec.name}: {e}")
 
         except Exception as e:
             st.error(f"An error occurred while processing your data: {e}")
-    else:
+    elif st.session_state.sales_data is not None:
+        # First results while the customer data is missing or still being parsed
+        try:
+            sales_preview(st.session_state.sales_data)
+        except Exception as e:
+            st.warning(f"Error generating the sales preview: {e}")
+        if "customers" not in loading:
+            st.info("Please upload all datasets (Sales and Customers) to proceed.")
+    elif not loading:
         st.info("Please upload all datasets (Sales and Customers) to proceed.")
 
     # SECTION 2: Reset button logic with upload_key reset (NEW)
     # Reset button
     if st.sidebar.button("Clear Files and Reset"):
+        # Stop parsing uploads and release the shared datasets so they are evicted once no other session uses them
+        for kind in UPLOAD_LABELS:
+            cancel_upload(kind)
+        for kind in ("sales", "customers"):
+            if st.session_state.get(f"{kind}_lease") is not None:
+                st.session_state[f"{kind}_lease"].release()
         st.session_state.clear()  # Clear all session state variables
         st.session_state["upload_key"] = 1  # Re-initialize upload_key
         st.sidebar.success("Uploaded files and session data have been cleared!")
@@ -516,7 +895,7 @@ def about_this_page():
     col1, col2 = st.columns(2)
 
     with col1: 
-        st.markdown("""
+        st.markdown(f"""
         ## 💻 Explore the Code on GitHub  
         ---
         Curious to see how it works under the hood?  
@@ -527,7 +906,7 @@ def about_this_page():
 
         <div style="text-align: center;">
             <a href="https://github.com/benR24/final_project" target="_blank">
-                <img src="https://uxwing.com/wp-content/themes/uxwing/download/brands-and-social-media/github-white-icon.png" 
+                <img src="{asset_url("github")}" 
                 alt="GitHub" width="60" style="margin: 10px;">
             </a>
             <p>Click the logo to visit our project repository</p>
@@ -561,25 +940,25 @@ def about_this_page():
     col1, col2, col3 = st.columns(3)
 
     with col1:
-        st.markdown("""
+        st.markdown(f"""
         <div style="text-align: center;">
-            <img src="https://upload.wikimedia.org/wikipedia/commons/9/9a/Visual_Studio_Code_1.35_icon.svg" alt="VS Code" width="130">
+            <img src="{asset_url("vscode")}" alt="VS Code" width="130">
             <p>VS Code</p>
         </div>
         """, unsafe_allow_html=True)
 
     with col2:
-        st.markdown("""
+        st.markdown(f"""
         <div style="text-align: center;">
-            <img src="https://upload.wikimedia.org/wikipedia/commons/c/c3/Python-logo-notext.svg" alt="Python" width="130">
+            <img src="{asset_url("python")}" alt="Python" width="130">
             <p>Python</p>
         </div>
         """, unsafe_allow_html=True)
 
     with col3:
-        st.markdown("""
+        st.markdown(f"""
         <div style="text-align: center;">
-            <img src="https://dash.plotly.com/assets/images/plotly_logo_dark.png" alt="Plotly" width="350">
+            <img src="{asset_url("plotly")}" alt="Plotly" width="350">
             <p>Plotly</p>
         </div>
         """, unsafe_allow_html=True)
@@ -587,25 +966,25 @@ def about_this_page():
     col4, col5, col6 = st.columns(3)
 
     with col4:
-        st.markdown("""
+        st.markdown(f"""
         <div style="text-align: center;">
-            <img src="https://streamlit.io/images/brand/streamlit-mark-color.png" alt="Streamlit" width="150">
+            <img src="{asset_url("streamlit")}" alt="Streamlit" width="150">
             <p>Streamlit</p>
         </div>
         """, unsafe_allow_html=True)
 
     with col5:
-        st.markdown("""
+        st.markdown(f"""
         <div style="text-align: center;">
-            <img src="https://ai.ls/assets/openai-logos/PNGs/openai-white-lockup.png" alt="OpenAI" width="300">
+            <img src="{asset_url("openai")}" alt="OpenAI" width="300">
             <p>OpenAI</p>
         </div>
         """, unsafe_allow_html=True)
 
     with col6:
-        st.markdown("""
+        st.markdown(f"""
         <div style="text-align: center;">
-            <img src="https://cdn.prod.website-files.com/5e8cd99ef9ea7c76500188b4/60782ef6dafd1509c3258abc_kreativbox-shopify-partners-agentur.png" alt="Shopify" width="300">
+            <img src="{asset_url("shopify")}" alt="Shopify" width="300">
             <p>Shopify Sales & Customer Data</p>
         </div>
         """, unsafe_allow_html=True)
@@ -643,7 +1022,7 @@ def about_this_page():
         st.markdown(
             f"""
             <a href="{linkedin_url}" target="_blank">
-            <img src="https://upload.wikimedia.org/wikipedia/commons/c/ca/LinkedIn_logo_initials.png" alt="LinkedIn" width="50" style="margin: 10px;">
+            <img src="{asset_url("linkedin")}" alt="LinkedIn" width="50" style="margin: 10px;">
             </a>
             """,
             unsafe_allow_html=True,
@@ -654,7 +1033,7 @@ def about_this_page():
         st.markdown(
             f"""
             <a href="{linkedin_url}" target="_blank">
-            <img src="https://upload.wikimedia.org/wikipedia/commons/c/ca/LinkedIn_logo_initials.png" alt="LinkedIn" width="50" style="margin: 10px;">
+            <img src="{asset_url("linkedin")}" alt="LinkedIn" width="50" style="margin: 10px;">
             </a>
             """,
             unsafe_allow_html=True,
@@ -678,16 +1057,16 @@ elif page == "Data Analyzer":
 elif page == "About this project":
     about_this_page()
 
-# Inject custom CSS for background
+# Inject custom CSS for background (served as a cached static file, it is sent on every rerun of every page)
 st.markdown(
-    """
+    f"""
     <style>
-    .stApp {
-        background-image: url("https://i.postimg.cc/PJvs5bcM/bitmap2.png");
+    .stApp {{
+        background-image: url("{asset_url("background", inline=False)}");
         background-size: cover;
         background-position: center;
         background-attachment: fixed;
-    }
+    }}
     </style>
     """,
     unsafe_allow_html=True
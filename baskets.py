@@ -0,0 +1,73 @@
+## This page finds products that are bought together in the same order
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from aggregates import FrameCache, normalize_labels
+
+
+def order_product_matrix(sales_data):
+    """
+    Returns the sparse order x product incidence matrix of the sales data (1 if the order contains the
+    product) and the product names of its columns. Orders without a product are left out.
+    """
+    order_codes, _ = pd.factorize(sales_data['order_id'])
+    products = normalize_labels(sales_data['product_name'], lower=False)
+    product_codes = products.cat.codes.to_numpy()
+    valid = (order_codes >= 0) & (product_codes >= 0)
+
+    # Renumber the orders that have a product so there are no empty rows
+    orders, order_rows = np.unique(order_codes[valid], return_inverse=True)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(order_rows), dtype=np.int32), (order_rows, product_codes[valid])),
+        shape=(len(orders), len(products.cat.categories))
+    )
+    # Products listed on several lines of the same order count once
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    return matrix, products.cat.categories
+
+
+# Product pair statistics are cached per sales frame
+_PAIRS = FrameCache()
+
+
+def product_pairs(sales_data, min_orders=2):
+    """
+    Returns every pair of products bought together in at least min_orders orders (cached per sales frame).
+
+    Pair counts come from a single sparse matrix product of the incidence matrix with itself, so no
+    dense order x product or product x product matrix is ever built.
+
+    Returns:
+        - DataFrame with 'product_a', 'product_b', 'orders' (orders containing both), 'support' (share of all
+          orders), 'confidence' (share of product_a's orders that contain product_b, and the reverse as
+          'confidence_reverse') and 'lift' (how much more often the pair is bought together than if the
+          products were bought independently), sorted by lift.
+    """
+    cached = _PAIRS.get(sales_data)
+    if cached is not None and cached[0] == min_orders:
+        return cached[1]
+
+    matrix, products = order_product_matrix(sales_data)
+    total_orders = matrix.shape[0]
+    co_occurrence = (matrix.T @ matrix).tocsr()
+    product_orders = co_occurrence.diagonal()
+
+    # Each pair once (upper triangle without the diagonal)
+    pairs = sparse.triu(co_occurrence, k=1).tocoo()
+    keep = pairs.data >= min_orders
+    a, b, together = pairs.row[keep], pairs.col[keep], pairs.data[keep].astype(np.int64)
+
+    result = pd.DataFrame({
+        'product_a': products[a],
+        'product_b': products[b],
+        'orders': together,
+        'support': together / total_orders if total_orders else np.nan,
+        'confidence': together / product_orders[a],
+        'confidence_reverse': together / product_orders[b],
+        'lift': together * total_orders / (product_orders[a].astype(np.float64) * product_orders[b])
+    }).sort_values(['lift', 'orders'], ascending=False, kind='stable').reset_index(drop=True)
+    _PAIRS.set(sales_data, (min_orders, result))
+    return result
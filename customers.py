@@ -0,0 +1,243 @@
+## This page links sales line items to customers and builds customer-level rollups
+
+import weakref
+
+import numpy as np
+import pandas as pd
+
+from aggregates import FrameCache, normalize_labels
+
+
+class CustomerIndex:
+    """
+    Lookup from customer_id to the row of the customer in the customer data.
+
+    Both sides are dictionary-encoded: sales customer ids are matched against the index once per
+    distinct id and rows are then mapped through their integer codes, so attaching customer
+    attributes never merges on object strings row by row.
+
+    The index is cached per customer frame and only refers to it weakly, so it does not keep the frame alive.
+    """
+
+    def __init__(self, customer_data):
+        self._customer_data = weakref.ref(customer_data)
+        ids = normalize_labels(customer_data['customer_id'], lower=False)
+        codes = ids.cat.codes.to_numpy()
+
+        # Row position of the first customer row per distinct id (-1 if the id has no row)
+        rows = np.flatnonzero(codes >= 0)
+        self.ids = ids.cat.categories
+        self.positions = np.full(len(self.ids), -1, dtype=np.int64)
+        self.positions[codes[rows][::-1]] = rows[::-1]
+
+    def rows_for_ids(self, customer_ids):
+        """
+        Returns the customer row position for each distinct customer id (-1 for unknown customers).
+        """
+        matched = self.ids.get_indexer(pd.Index(customer_ids).astype(str))
+        return np.where(matched >= 0, self.positions[np.maximum(matched, 0)], -1)
+
+    def rows_for(self, customer_ids):
+        """
+        Returns the customer row position for every value of a customer_id Series (-1 for unknown customers).
+        """
+        customer_ids = normalize_labels(customer_ids, lower=False)
+        category_rows = self.rows_for_ids(customer_ids.cat.categories)
+        codes = customer_ids.cat.codes.to_numpy()
+        if not len(category_rows):
+            return np.full(len(codes), -1, dtype=np.int64)
+        return np.where(codes >= 0, category_rows[codes], -1)
+
+    def attributes(self, rows, columns):
+        """
+        Returns the given customer columns for the given row positions; unknown rows (-1) get missing values.
+        """
+        return self._customer_data()[columns].reset_index(drop=True).reindex(rows)
+
+
+# Customer indexes and per-customer sales rollups are cached per frame
+_INDEXES = FrameCache()
+_ROLLUPS = FrameCache()
+
+
+def customer_index(customer_data):
+    """
+    Returns the (cached) CustomerIndex of a customer frame.
+    """
+    index = _INDEXES.get(customer_data)
+    if index is None:
+        index = CustomerIndex(customer_data)
+        _INDEXES.set(customer_data, index)
+    return index
+
+
+def attach_customer_attributes(sales_data, customer_data, columns):
+    """
+    Returns the customer attributes (e.g. 'iso2', 'returning_customer') of every sales line item.
+
+    Parameters:
+        - sales_data: DataFrame with a 'customer_id' column.
+        - customer_data: DataFrame with 'customer_id' and the requested columns.
+        - columns: List of customer columns to attach.
+
+    Returns:
+        - DataFrame aligned with sales_data's index; line items of unknown customers get missing values.
+    """
+    index = customer_index(customer_data)
+    attributes = index.attributes(index.rows_for(sales_data['customer_id']), columns)
+    return attributes.set_axis(sales_data.index)
+
+
+def customer_sales_rollup(sales_data):
+    """
+    Returns one row per customer_id found in the sales data with its revenue, number of line items,
+    number of orders and the dates of its first and last order (cached per sales frame).
+    """
+    rollup = _ROLLUPS.get(sales_data)
+    if rollup is None:
+        customer_ids = normalize_labels(sales_data['customer_id'], lower=False)
+        rollup = sales_data.groupby(customer_ids, observed=True).agg(
+            product_revenue=('product_revenue', 'sum'),
+            lines=('product_revenue', 'size'),
+            orders=('order_id', 'nunique'),
+            first_order=('order_date', 'min'),
+            last_order=('order_date', 'max')
+        )
+        rollup.index = rollup.index.astype(object).rename('customer_id')
+        _ROLLUPS.set(sales_data, rollup)
+    return rollup
+
+
+def sales_by_customer_attribute(sales_data, customer_data, attribute):
+    """
+    Returns revenue, orders and customer counts per value of a customer attribute
+    (a column of customer_data, or a Series aligned with it such as a spend level segmentation).
+
+    The sales data is rolled up per customer first, so the join runs over distinct customers only.
+    """
+    rollup = customer_sales_rollup(sales_data)
+    index = customer_index(customer_data)
+    if isinstance(attribute, str):
+        attribute = customer_data[attribute]
+    segments = attribute.reset_index(drop=True).reindex(index.rows_for_ids(rollup.index)).set_axis(rollup.index)
+
+    summary = rollup.groupby(segments, observed=True).agg(
+        product_revenue=('product_revenue', 'sum'),
+        orders=('orders', 'sum'),
+        customers=('orders', 'size')
+    )
+    return summary.rename_axis(attribute.name or 'segment').reset_index()
+
+
+# Cohort matrices are cached per sales frame
+_COHORTS = FrameCache()
+
+
+def cohort_matrix(sales_data):
+    """
+    Returns the number of active customers per first-purchase month (rows) and months since the
+    first purchase (columns), computed from the sales line items (cached per sales frame).
+
+    Months are handled as integer codes (year * 12 + month) and the distinct (customer, month)
+    activity pairs are found with a single sort, so there is no per-customer Python loop.
+    Cells after the last month of the data are missing.
+    """
+    matrix = _COHORTS.get(sales_data)
+    if matrix is not None:
+        return matrix
+
+    customer_codes = normalize_labels(sales_data['customer_id'], lower=False).cat.codes.to_numpy().astype(np.int64)
+    order_date = sales_data['order_date']
+    valid = (customer_codes >= 0) & order_date.notna().to_numpy()
+    month_codes = (order_date.dt.year * 12 + order_date.dt.month - 1).to_numpy()[valid].astype(np.int64)
+    customer_codes = customer_codes[valid]
+
+    if not len(month_codes):
+        matrix = pd.DataFrame(dtype='float64')
+        _COHORTS.set(sales_data, matrix)
+        return matrix
+
+    first_month = month_codes.min()
+    span = int(month_codes.max() - first_month + 1)
+
+    # One sort: distinct activity pairs ordered by customer, then month
+    pairs = np.sort(customer_codes * span + (month_codes - first_month))
+    pairs = pairs[np.r_[True, pairs[1:] != pairs[:-1]]]
+    customers, months = pairs // span, pairs % span
+
+    # The first pair of every customer is its cohort month
+    starts = np.flatnonzero(np.r_[True, customers[1:] != customers[:-1]])
+    cohorts = np.repeat(months[starts], np.diff(np.r_[starts, len(pairs)]))
+    ages = months - cohorts
+
+    counts = np.bincount(cohorts * span + ages, minlength=span * span).reshape(span, span).astype('float64')
+
+    # Hide the months a cohort has not reached yet and drop months in which no cohort started
+    counts[np.arange(span)[:, None] + np.arange(span)[None, :] >= span] = np.nan
+    cohort_rows = counts[:, 0] > 0
+    cohort_months = pd.PeriodIndex.from_ordinals(
+        ordinals=(np.arange(span) + first_month - 1970 * 12)[cohort_rows], freq='M'
+    )
+    matrix = pd.DataFrame(counts[cohort_rows], index=cohort_months, columns=pd.RangeIndex(span, name='months_since'))
+    matrix.index.name = 'cohort'
+    _COHORTS.set(sales_data, matrix)
+    return matrix
+
+
+def cohort_retention(sales_data):
+    """
+    Returns the cohort matrix as the percentage of each cohort still active after n months.
+    """
+    matrix = cohort_matrix(sales_data)
+    return matrix.div(matrix[0], axis=0) * 100 if not matrix.empty else matrix
+
+
+# Segment names by recency (R) and frequency (F) score, checked in order
+RFM_SEGMENTS = [
+    ('Champions', lambda r, f: (r >= 4) & (f >= 4)),
+    ('Loyal Customers', lambda r, f: (r >= 3) & (f >= 3)),
+    ('New Customers', lambda r, f: (r >= 4) & (f <= 2)),
+    ('At Risk', lambda r, f: (r <= 2) & (f >= 3)),
+    ('Lost', lambda r, f: (r <= 2) & (f <= 2))
+]
+
+
+def _quantile_scores(values, bins):
+    # Percentile rank mapped to 1..bins, ties share the same score
+    return np.ceil(values.rank(method='average', pct=True) * bins).clip(1, bins).astype('int8')
+
+
+def rfm_scores(sales_data, bins=5):
+    """
+    Returns the RFM (recency, frequency, monetary) scores of every customer in the sales data.
+
+    Uses the cached per-customer rollup (one grouped pass over the line items) and scores each
+    measure by its quantile: recency in days since the customer's last order (relative to the last
+    order in the data), frequency as number of orders and monetary as product revenue.
+
+    Returns:
+        - DataFrame with 'customer_id', 'recency_days', 'frequency', 'monetary', the scores 'R', 'F', 'M'
+          (1 = worst, bins = best), the combined 'rfm_score' and a named 'segment'.
+    """
+    rollup = customer_sales_rollup(sales_data)
+    recency_days = (rollup['last_order'].max() - rollup['last_order']).dt.days
+
+    recency = _quantile_scores(-recency_days, bins)
+    frequency = _quantile_scores(rollup['orders'], bins)
+    monetary = _quantile_scores(rollup['product_revenue'], bins)
+
+    segment = np.select(
+        [condition(recency, frequency) for _, condition in RFM_SEGMENTS],
+        [name for name, _ in RFM_SEGMENTS],
+        default='Potential'
+    )
+    return pd.DataFrame({
+        'recency_days': recency_days,
+        'frequency': rollup['orders'],
+        'monetary': rollup['product_revenue'],
+        'R': recency,
+        'F': frequency,
+        'M': monetary,
+        'rfm_score': recency.astype(str) + frequency.astype(str) + monetary.astype(str),
+        'segment': segment
+    }).reset_index()
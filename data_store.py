@@ -0,0 +1,429 @@
+## This page holds the uploaded datasets, shared between all sessions of the app
+
+import hashlib
+import io
+import os
+import threading
+import weakref
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from aggregates import FrameCache, normalize_labels, remember_aggregates, sales_aggregates
+from schema import SALES_SCHEMA, CUSTOMER_SCHEMA, validate_data, combine_reports, remember_report, validation_report
+
+# Stored frames are shared by every session and must never be modified in place: copy-on-write is enabled
+# once per process, when the store is first imported and before any upload is read, so derived frames stay
+# cheap and safe
+pd.set_option("mode.copy_on_write", True)
+
+
+class _StoreEntry:
+    def __init__(self):
+        self.value = None
+        self.refcount = 0
+        self.lock = threading.Lock()
+
+
+class DatasetStore:
+    """
+    Process-wide store of uploaded datasets keyed by a hash of their content.
+
+    Every session that uploads the same file attaches to the same entry, so the data is held
+    in memory once no matter how many analysts look at it. Entries are evicted as soon as
+    no session references them anymore. Stored frames are shared and must never be mutated.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def attach(self, key, loader):
+        """
+        Returns the dataset stored under key, loading it with loader() if it is not stored yet.
+        Every call must be paired with a call to release(key).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _StoreEntry()
+            entry.refcount += 1
+
+        # Load outside the store lock so other datasets are not blocked, but only once per key
+        with entry.lock:
+            if entry.value is None:
+                try:
+                    entry.value = loader()
+                except Exception:
+                    self.release(key)
+                    raise
+                _DATASET_HASHES.set(entry.value, key)
+        return entry.value
+
+    def release(self, key):
+        """
+        Drops one reference to key and evicts the dataset once nobody references it.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.refcount -= 1
+            if entry.refcount <= 0:
+                del self._entries[key]
+
+    def stats(self):
+        """
+        Returns a DataFrame with one row per stored dataset, its reference count and memory usage.
+        """
+        with self._lock:
+            entries = list(self._entries.items())
+        rows = []
+        for key, entry in entries:
+            value = entry.value
+            memory = value.memory_usage(deep=True).sum() if isinstance(value, pd.DataFrame) else 0
+            rows.append({'key': key, 'sessions': entry.refcount, 'memory_bytes': memory})
+        return pd.DataFrame(rows, columns=['key', 'sessions', 'memory_bytes'])
+
+
+# One store per server process, shared by every session
+DATASET_STORE = DatasetStore()
+
+
+class DatasetLease:
+    """
+    A session's reference to a dataset in the store.
+
+    The reference is released when release() is called or when the lease is garbage collected,
+    e.g. because the session ended or its session_state was cleared.
+    """
+
+    def __init__(self, store, key, loader, file_id=None):
+        self.key = key
+        self.file_id = file_id
+        self.value = store.attach(key, loader)
+        self._finalizer = weakref.finalize(self, store.release, key)
+
+    def release(self):
+        self._finalizer()
+
+
+# Background threads parsing uploads, owned by the server process and shared by all sessions
+UPLOAD_WORKERS = os.cpu_count() or 1
+_UPLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix='upload')
+
+
+class UploadTask:
+    """
+    An upload being loaded into the store in a background thread, so the page can keep rendering
+    its progress (and react to the user) while it is parsed.
+
+    The loader is called as loader(progress) with the task's UploadProgress; cancelling the task
+    stops the loader at its next read and releases the dataset if it was loaded meanwhile.
+    """
+
+    def __init__(self, store, key, loader, file_id=None, total_bytes=0):
+        self.key = key
+        self.file_id = file_id
+        self.progress = UploadProgress(total_bytes)
+        self._future = _UPLOAD_EXECUTOR.submit(DatasetLease, store, key, lambda: loader(self.progress), file_id)
+
+    def done(self):
+        return self._future.done()
+
+    def lease(self):
+        """
+        Returns the DatasetLease of the loaded dataset, raising the loader's error if it failed.
+        """
+        return self._future.result()
+
+    def cancel(self):
+        self.progress.cancel()
+        if not self._future.cancel():
+            self._future.add_done_callback(_release_cancelled)
+
+
+def _release_cancelled(future):
+    if future.exception() is None:
+        future.result().release()
+
+
+def content_key(kind, *payloads):
+    """
+    Returns the store key for uploaded files: the dataset kind plus a hash of the raw bytes.
+    """
+    content_hash = hashlib.blake2b(digest_size=20)
+    for payload in payloads:
+        content_hash.update(payload)
+    return f"{kind}:{content_hash.hexdigest()}"
+
+
+# Content hashes of datasets, kept per frame for as long as the frame is alive
+_DATASET_HASHES = FrameCache()
+
+
+def dataset_hash(data):
+    """
+    Returns a hash of a frame's content: its store key for stored datasets, otherwise a hash of its
+    values computed once per frame.
+    """
+    key = _DATASET_HASHES.get(data)
+    if key is None:
+        key = content_key('frame', pd.util.hash_pandas_object(data).to_numpy().tobytes(), ','.join(map(str, data.columns)).encode())
+        _DATASET_HASHES.set(data, key)
+    return key
+
+
+# File types accepted by the uploaders and the compression pandas decompresses them with (in memory)
+UPLOAD_COMPRESSION = {
+    '.csv': None,
+    '.gz': 'gzip',
+    '.bz2': 'bz2',
+    '.zip': 'zip',
+    '.xz': 'xz',
+    '.zst': 'zstd'
+}
+UPLOAD_TYPES = [extension.lstrip('.') for extension in UPLOAD_COMPRESSION]
+
+
+class UploadCancelled(Exception):
+    """
+    Raised in a loader when the upload it is loading was cancelled.
+    """
+
+
+class UploadProgress:
+    """
+    Progress of an upload being loaded: the raw bytes read so far, the current step and what is
+    already known about the data (e.g. rows, first and last order date).
+
+    Updated by the thread loading the upload and read by the page; every update raises
+    UploadCancelled once the upload was cancelled, so loaders stop at the next read.
+    """
+
+    def __init__(self, total_bytes=0):
+        self.total_bytes = total_bytes
+        self.bytes_read = 0
+        self.step = 'Reading files'
+        self.details = {}
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+
+    def read(self, size):
+        # Files are parsed in parallel threads
+        with self._lock:
+            self.bytes_read += size
+        self.check()
+
+    def update(self, step, **details):
+        """
+        Starts the next step of the loader, publishing what it learnt about the data so far.
+        """
+        self.check()
+        self.step = step
+        self.details = {**self.details, **details}
+
+    def check(self):
+        if self._cancelled.is_set():
+            raise UploadCancelled()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def fraction(self):
+        """
+        Returns the share of the raw bytes read, between 0 and 1.
+        """
+        return min(self.bytes_read / self.total_bytes, 1.0) if self.total_bytes else 0.0
+
+
+class _ProgressReader(io.RawIOBase):
+    # Raw bytes of an uploaded file, counting what the parser (or decompressor) reads from them
+    def __init__(self, payload, progress):
+        self._payload = io.BytesIO(payload)
+        self._progress = progress
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._payload.seek(offset, whence)
+
+    def tell(self):
+        return self._payload.tell()
+
+    def readinto(self, buffer):
+        size = self._payload.readinto(buffer)
+        self._progress.read(size)
+        return size
+
+
+def _csv_members(archive):
+    # CSV files of a zip archive in name order (e.g. one per month), without folders and OS metadata
+    return sorted(
+        (
+            member for member in archive.infolist()
+            if not member.is_dir()
+            and member.filename.lower().endswith('.csv')
+            and not member.filename.startswith('__MACOSX/')
+            and not os.path.basename(member.filename).startswith('.')
+        ),
+        key=lambda member: member.filename
+    )
+
+
+def _read_csv_file(name, payload, progress):
+    compression = UPLOAD_COMPRESSION.get(os.path.splitext(name.lower())[1])
+    if compression != 'zip':
+        return pd.read_csv(_ProgressReader(payload, progress), compression=compression)
+
+    # A zip archive may hold several CSV files, they are parsed one after the other and concatenated
+    with zipfile.ZipFile(_ProgressReader(payload, progress)) as archive:
+        members = _csv_members(archive)
+        if not members:
+            raise ValueError(f"No CSV file found in {name}")
+        frames = []
+        for member in members:
+            with archive.open(member) as file:
+                frames.append(pd.read_csv(file))
+    return frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+
+
+def read_csv_files(files, progress=None):
+    """
+    Parses uploaded CSV files, optionally compressed, and concatenates them into one frame.
+
+    Parameters:
+        - files: list of (file name, raw bytes); the compression is taken from the file extension, zip
+          archives may hold several CSV files.
+        - progress: UploadProgress counting the raw bytes read (and stopping the parsers when cancelled).
+
+    Several files are parsed in parallel threads (the CSV tokenizer and the decompressors release
+    the GIL). Columns missing from some of the files are filled with missing values.
+    """
+    progress = progress or UploadProgress()
+    if len(files) == 1:
+        return _read_csv_file(*files[0], progress)
+    with ThreadPoolExecutor(max_workers=min(len(files), os.cpu_count() or 1)) as executor:
+        frames = list(executor.map(lambda file: _read_csv_file(*file, progress), files))
+    return pd.concat(frames, ignore_index=True)
+
+
+# Label columns that are dictionary-encoded at ingestion, and whether they are lowercased as well
+SALES_LABEL_COLUMNS = {
+    'location': True,
+    'discount_code': True,
+    'fulfillment_status': True,
+    'product_name': False,
+    'sales_channel': False,
+    'customer_id': False
+}
+CUSTOMER_LABEL_COLUMNS = {
+    'customer_id': False,
+    'location': True,
+    'iso2': True
+}
+
+
+# Customer columns no chart reads, dropped at ingestion (they stay in the validation report)
+CUSTOMER_UNUSED_COLUMNS = ['email']
+
+
+def normalize_label_columns(data, label_columns):
+    """
+    Dictionary-encodes the label columns of a frame, normalizing each distinct value only once.
+    """
+    return data.assign(**{
+        column: normalize_labels(data[column], lower=lower)
+        for column, lower in label_columns.items()
+        if column in data.columns
+    })
+
+
+def load_sales_data(files, progress=None):
+    """
+    Parses uploaded sales CSV files (list of (file name, raw bytes)) and prepares them once for all charts.
+    Steps, row count and date range are reported to progress (an UploadProgress) as soon as they are known.
+    """
+    progress = progress or UploadProgress()
+    raw_data = read_csv_files(files, progress)
+    progress.update('Validating columns', rows=len(raw_data))
+    sales_data, report = validate_data(raw_data, SALES_SCHEMA)
+
+    # Rows without a valid order date cannot be placed on any time axis
+    if report.loc['order_date', 'present']:
+        sales_data = sales_data.dropna(subset=['order_date']).reset_index(drop=True)
+    if report.loc['order_date', 'present'] and len(sales_data):
+        progress.update(
+            'Encoding labels',
+            rows=len(sales_data),
+            first_date=sales_data['order_date'].min(),
+            last_date=sales_data['order_date'].max()
+        )
+    else:
+        progress.update('Encoding labels', rows=len(sales_data))
+
+    sales_data = normalize_label_columns(sales_data, SALES_LABEL_COLUMNS)
+    remember_report(sales_data, report)
+    return sales_data
+
+
+def load_customer_data(files, progress=None):
+    """
+    Parses uploaded customer CSV files (list of (file name, raw bytes)) and normalizes their location labels.
+    """
+    progress = progress or UploadProgress()
+    raw_data = read_csv_files(files, progress)
+    progress.update('Validating columns', rows=len(raw_data))
+    customer_data, report = validate_data(raw_data, CUSTOMER_SCHEMA)
+    progress.update('Encoding labels')
+    customer_data = compact_customer_data(normalize_label_columns(customer_data, CUSTOMER_LABEL_COLUMNS))
+    remember_report(customer_data, report)
+    return customer_data
+
+
+def compact_customer_data(customer_data):
+    """
+    Returns validated customer data in its compact in-memory form: unused columns dropped, order counts
+    as the smallest integer type holding them (when none is missing), and returning_customer as a
+    nullable boolean (missing values stay unknown, they are neither new nor returning customers).
+    Label columns are categorical already.
+    """
+    total_orders = customer_data['total_orders']
+    if total_orders.notna().all() and (total_orders % 1 == 0).all():
+        total_orders = pd.to_numeric(total_orders, downcast='integer')
+    return customer_data.drop(columns=[column for column in CUSTOMER_UNUSED_COLUMNS if column in customer_data.columns]).assign(
+        total_orders=total_orders,
+        returning_customer=customer_data['returning_customer'].astype('boolean')
+    )
+
+
+def append_sales_data(sales_data, files, progress=None):
+    """
+    Returns sales_data with the orders of uploaded CSV files (list of (file name, raw bytes)) appended.
+
+    The cached aggregates of sales_data are updated with the new rows only and registered for the
+    combined frame, so the charts do not reprocess the full history after a daily refresh.
+    """
+    progress = progress or UploadProgress()
+    new_rows = load_sales_data(files, progress)
+    progress.update('Updating aggregates')
+
+    # Concatenating categoricals with different dictionaries falls back to strings: both frames get the
+    # merged dictionaries first, so the label columns are concatenated as codes
+    dtypes = {
+        column: union_categoricals([sales_data[column], new_rows[column]], sort_categories=True).dtype
+        for column in SALES_LABEL_COLUMNS
+        if column in sales_data.columns and column in new_rows.columns
+        and sales_data[column].dtype != new_rows[column].dtype
+    }
+    combined = pd.concat([sales_data.astype(dtypes), new_rows.astype(dtypes)], ignore_index=True)
+    remember_aggregates(combined, sales_aggregates(sales_data).append(new_rows))
+    if validation_report(sales_data) is not None:
+        remember_report(combined, combine_reports(validation_report(sales_data), validation_report(new_rows)))
+    return combined
@@ -6,24 +6,284 @@ import requests
 import plotly.graph_objects as go
 import streamlit as st
 
-# Sales Analysis Definitions (Dropdown)
+from aggregates import FrameCache, normalize_labels, sales_aggregates, safe_ratio, breakdown_metrics, period_comparison, RATE_METRICS
+from customers import sales_by_customer_attribute, cohort_retention, rfm_scores, customer_sales_rollup, cohort_matrix, customer_index
+from forecast import revenue_forecast
+from anomalies import ANOMALY_MEASURES, anomaly_scores, daily_anomalies
+from baskets import product_pairs
+from process_pool import in_process
+
+# Tabs of the Data Analyzer page, in menu order
+TABS = ['Sales Analysis', 'Product Analysis', 'Demographic Analysis']
+
+# Cost classes in drawing order: expensive charts are drawn last, so cheap ones show up first
+COST_CLASSES = ['light', 'medium', 'heavy']
+
+# Metrics of the channel breakdown charts and their axis titles
+CHANNEL_METRICS = {
+    'product_revenue': 'Revenue ($)',
+    'orders': 'Orders',
+    'aov': 'Average Order Value ($)',
+    'refund_rate': 'Refund Rate (%)'
+}
+
+# Metrics of the period comparison chart and their axis titles
+COMPARISON_METRICS = {**CHANNEL_METRICS, 'discount_rate': 'Discount Rate (%)'}
 
-def plot_total_sales_revenue_by_month(sales_data):
+# Period comparisons: title and lag in months
+COMPARISONS = {
+    'yoy': ('Year-over-Year', 12),
+    'mom': ('Month-over-Month', 1)
+}
+
+# Every channel breakdown is a roll-up of this one pivot of the monthly cube
+CHANNEL_PIVOT = ['sales_channel', 'month', 'fulfillment_status']
+
+# Customer locations matched to coordinates are cached per customer frame
+_GEOCODES = FrameCache()
+
+
+def geocode_customer_locations(customer_data, world_cities, world_countries):
     """
-    Plots total sales revenue (sum of product revenue) by month with a simple checkbox legend for year selection.
+    Matches customer locations to coordinates, as cities if at least half of the customers match a city,
+    otherwise as countries (cached per customer frame, the reference tables are the same for the whole app).
+
+    Returns:
+    - (location_summary, match_type): customers and total spent per matched location with its 'lat' and 'lng',
+      and 'city' or 'country' (None, with an empty summary, if no location matches).
     """
+    cached = _GEOCODES.get(customer_data)
+    if cached is not None:
+        return cached
+
+    # Summarize customers per distinct location and ISO2 code, so matching only touches the distinct pairs
+    customer_locations = pd.DataFrame({
+        'location': normalize_labels(customer_data['location']),
+        'iso2': normalize_labels(customer_data['iso2']),
+        'customer_id': customer_data['customer_id'],
+        'total_spent': customer_data['total_spent']
+    }).groupby(['location', 'iso2'], observed=True).agg(
+        customers=('customer_id', 'count'),
+        rows=('customer_id', 'size'),
+        spent=('total_spent', 'sum')
+    ).reset_index()
+    customer_locations = customer_locations.astype({'location': object, 'iso2': object})
+
+    # Attempt to match as cities first
+    city_matches = pd.merge(
+        customer_locations,
+        world_cities,
+        left_on=['location', 'iso2'],
+        right_on=['city_ascii', 'iso2'],
+        how='inner'
+    )
+
+    # Calculate match percentage for cities
+    city_match_percentage = city_matches['rows'].sum() / len(customer_data) if len(customer_data) > 0 else 0
+
+    # Set a threshold for city match acceptance (e.g., 50%)
+    city_match_threshold = 0.5
+
+    if city_match_percentage >= city_match_threshold:
+        # If city matches exceed the threshold, use city matches
+        combined_matches = city_matches
+        match_type = 'city'
+    else:
+        # Fallback to country matches
+        country_matches = pd.merge(
+            customer_locations,
+            world_countries,
+            left_on=['location', 'iso2'],
+            right_on=['country', 'iso2'],
+            how='inner'
+        )
+
+        if len(country_matches) > 0:
+            combined_matches = country_matches
+            match_type = 'country'
+        else:
+            no_matches = (pd.DataFrame(columns=['location', 'lat', 'lng', 'total_customers', 'total_spent']), None)
+            _GEOCODES.set(customer_data, no_matches)
+            return no_matches
+
+    # Aggregate customer data by location (city or country)
+    location_summary = combined_matches.groupby(['location', 'lat', 'lng']).agg(
+        total_customers=('customers', 'sum'),
+        total_spent=('spent', 'sum')
+    ).reset_index()
+
+    _GEOCODES.set(customer_data, (location_summary, match_type))
+    return location_summary, match_type
+
+
+# Shared aggregates charts can declare: the datasets they are computed from and how (all of them are cached).
+# Aggregations over the line items run in the process pool, which only receives the columns they read
+SHARED_AGGREGATES = {
+    'sales_aggregates': (['sales'], sales_aggregates),
+    'revenue_forecast': (['sales'], revenue_forecast),
+    'region_forecast': (['sales'], lambda sales_data: revenue_forecast(sales_data, by='location')),
+    'revenue_anomalies': (['sales'], lambda sales_data: [
+        anomaly_scores(sales_data, 'revenue', by) for by in (None, 'product_name', 'location')
+    ]),
+    'customer_rollup': (['sales'], in_process(
+        customer_sales_rollup, '_ROLLUPS', [['customer_id', 'order_id', 'order_date', 'product_revenue']]
+    )),
+    'cohort_matrix': (['sales'], in_process(cohort_matrix, '_COHORTS', [['customer_id', 'order_date']])),
+    'product_pairs': (['sales'], in_process(product_pairs, '_PAIRS', [['order_id', 'product_name']])),
+    'customer_index': (['customers'], customer_index),
+    'customer_geocodes': (
+        ['customers', 'world_cities', 'world_countries'],
+        in_process(geocode_customer_locations, '_GEOCODES', [['location', 'iso2', 'customer_id', 'total_spent'], None, None])
+    )
+}
+
+# Controls (widgets) whose value is passed to the charts using them: label and options (value -> title),
+# or a function of the available columns returning the options
+CHART_CONTROLS = {
+    'comparison': ('Comparison', {comparison: title for comparison, (title, _) in COMPARISONS.items()}),
+    'comparison_metric': ('Comparison metric', COMPARISON_METRICS),
+    'channel_metric': ('Sales channel metric', CHANNEL_METRICS),
+    'anomaly_measure': ('Daily anomaly measure', lambda available: {
+        measure: measure.replace('_', ' ').title()
+        for measure, (_, _, column) in ANOMALY_MEASURES.items()
+        if column in available.get('sales', set())
+    })
+}
+
+
+class ChartSpec:
+    """
+    Registry entry of a chart: everything the Data Analyzer page needs to know to draw it.
+
+    - function: the chart function, called with one positional argument per dataset
+    - tab: tab of the Data Analyzer page the chart is shown on
+    - datasets: datasets passed to the function ('sales', 'customers', 'world_cities', 'world_countries')
+    - inputs: columns needed per dataset ('sales' / 'customers'); the chart is skipped if any is missing
+    - aggregates: shared aggregates the chart reads (see SHARED_AGGREGATES), prepared once per tab
+    - cost: 'light' (cached cubes only), 'medium' (line-level aggregates) or 'heavy' (own computation)
+    - controls: keyword argument -> control (see CHART_CONTROLS) whose value is passed to the function
+    - selection: cross-filter dimension of the chart's clickable points, if any
+    - row_level: whether the chart needs the sales line items rather than the shared aggregates
+    - time_relative: whether the chart depends on the current time (e.g. the last 90 days), so its
+      cached figure is only reused within the hour
+    - details: optional function returning {title: DataFrame}, shown below the chart
+    - download: optional (label, file name, function returning a DataFrame), offered as a CSV download
+    """
+
+    def __init__(self, function, tab, datasets, inputs, aggregates, cost, controls, selection, row_level, time_relative,
+                 details, download):
+        self.function = function
+        self.name = function.__name__
+        self.tab = tab
+        self.datasets = list(datasets)
+        self.inputs = inputs
+        self.aggregates = list(aggregates)
+        self.cost = cost
+        self.controls = controls or {}
+        self.selection = selection
+        self.row_level = row_level
+        self.time_relative = time_relative
+        self.details = details
+        self.download = download
+
+    def missing_inputs(self, available):
+        """
+        Returns the columns the chart needs that are not available.
+
+        Parameters:
+            - available: dict of dataset name ('sales' / 'customers') -> set of usable columns.
+        """
+        return [
+            column
+            for dataset, columns in self.inputs.items()
+            for column in columns
+            if column not in available.get(dataset, set())
+        ]
+
+
+# Chart name -> ChartSpec, filled by the @chart decorator in definition order
+CHART_REGISTRY = {}
+
+
+def chart(tab, inputs, datasets=('sales',), aggregates=(), cost='light', controls=None, selection=None,
+          row_level=False, time_relative=False, details=None, download=None):
+    """
+    Registers the decorated function as a chart of the Data Analyzer page (see ChartSpec for the parameters).
+    """
+    if tab not in TABS or cost not in COST_CLASSES:
+        raise ValueError(f"Unknown tab or cost class: {tab}, {cost}")
+
+    def register(function):
+        CHART_REGISTRY[function.__name__] = ChartSpec(
+            function, tab, datasets, inputs, aggregates, cost, controls, selection, row_level, time_relative,
+            details, download
+        )
+        return function
+    return register
+
+
+def charts_for_tab(tab):
+    """
+    Returns the chart specs of a tab in drawing order: by cost class, then in order of definition.
+    """
+    specs = [spec for spec in CHART_REGISTRY.values() if spec.tab == tab]
+    return sorted(specs, key=lambda spec: COST_CLASSES.index(spec.cost))
+
+
+def control_options(control, available):
+    """
+    Returns the label and the options (value -> title) of a chart control for the available columns.
+    """
+    label, options = CHART_CONTROLS[control]
+    return label, options(available) if callable(options) else options
+
+
+def missing_chart_inputs(chart_name, available):
+    """
+    Returns the columns a chart needs that are not available.
+
+    Parameters:
+        - chart_name: Name of the chart function.
+        - available: dict of dataset name ('sales' / 'customers') -> set of usable columns.
+    """
+    spec = CHART_REGISTRY.get(chart_name)
+    return spec.missing_inputs(available) if spec is not None else []
 
-    # Extract year and month
-    sales_data['Year'] = sales_data['order_date'].dt.year
-    sales_data['Month'] = sales_data['order_date'].dt.month
-    sales_data['Month-Year'] = sales_data['order_date'].dt.strftime('%b-%Y')  # e.g., "Jan-2024"
 
-    # Group by year and month, and sum the product revenue
-    monthly_sales = sales_data.groupby(['Year', 'Month-Year'], as_index=False)['product_revenue'].sum()
+def anomaly_tables(sales_data, measure='revenue'):
+    """
+    Returns the most anomalous days of a daily measure per product and per location.
+    """
+    return {
+        f"Anomalous days by {by.replace('_', ' ')}": daily_anomalies(sales_data, measure, by=by).head(50)
+        for by in ('product_name', 'location')
+    }
+
+
+def product_pair_table(sales_data):
+    """
+    Returns the product pairs bought together most often relative to chance.
+    """
+    return {'Products bought together': product_pairs(sales_data).head(100)}
 
-    # Sort data by Year and Month
-    monthly_sales['Month-Year-Sort'] = pd.to_datetime(monthly_sales['Month-Year'], format='%b-%Y')
-    monthly_sales = monthly_sales.sort_values('Month-Year-Sort')
+# Sales Analysis Definitions (Dropdown)
+
+@chart('Sales Analysis', {'sales': ['order_date', 'product_revenue']}, aggregates=['sales_aggregates', 'revenue_forecast'])
+def plot_total_sales_revenue_by_month(sales_data, forecast_months=3):
+    """
+    Plots total sales revenue (sum of product revenue) by month with a simple checkbox legend for year selection,
+    and a seasonal exponential smoothing forecast for the next forecast_months months (0 to hide it).
+    """
+
+    # Sum of product revenue per month from the shared monthly cube (already sorted by month)
+    monthly_revenue = sales_aggregates(sales_data).monthly_totals()['product_revenue']
+
+    # Extract year and month
+    monthly_sales = pd.DataFrame({
+        'Year': monthly_revenue.index.year,
+        'Month-Year': monthly_revenue.index.strftime('%b-%Y'),  # e.g., "Jan-2024"
+        'product_revenue': monthly_revenue.to_numpy()
+    })
 
     # Initialize the figure
     fig = go.Figure()
@@ -41,6 +301,19 @@ def plot_total_sales_revenue_by_month(sales_data):
             textposition='outside'
         ))
 
+    # Forecast overlay from the cached model of the monthly revenue series
+    model = revenue_forecast(sales_data) if forecast_months else None
+    if model is not None:
+        forecast = model.predict(forecast_months).iloc[0]
+        fig.add_trace(go.Scatter(
+            x=forecast.index.strftime('%b-%Y'),
+            y=forecast.to_numpy(),
+            name='Forecast',
+            mode='lines+markers',
+            line=dict(dash='dash'),
+            hovertemplate='Forecast: $%{y:.2f}<extra></extra>'
+        ))
+
     # Update layout for a simple checkbox-style legend
     fig.update_layout(
         title="Total Sales Revenue by Month",
@@ -64,6 +337,7 @@ def plot_total_sales_revenue_by_month(sales_data):
     st.caption("This graph shows the total sales revenue grouped by month, with comparisons across selected years.")
     return fig
 
+@chart('Sales Analysis', {'sales': ['order_date', 'product_revenue']}, aggregates=['sales_aggregates'])
 def plot_total_sales_by_quarter_with_filter(sales_data): 
     """
     Plots total sales revenue by quarter with a simple checkbox-style legend for year selection.
@@ -72,16 +346,16 @@ def plot_total_sales_by_quarter_with_filter(sales_data):
         - sales_data: DataFrame containing sales data with 'order_date' and 'product_revenue'.
     """
 
-    # Extract year and quarter
-    sales_data['Year'] = sales_data['order_date'].dt.year
-    sales_data['Quarter'] = sales_data['order_date'].dt.to_period('Q').astype(str)
-
-    # Group by year and quarter, and sum the product revenue
-    quarterly_sales = sales_data.groupby(['Year', 'Quarter'], as_index=False)['product_revenue'].sum()
+    # Roll the monthly revenue up to quarters (sorted by quarter)
+    monthly_revenue = sales_aggregates(sales_data).monthly_totals()['product_revenue']
+    quarterly_revenue = monthly_revenue.groupby(monthly_revenue.index.asfreq('Q')).sum()
 
-    # Sort data by Year and Quarter using Period objects
-    quarterly_sales['Quarter-Sort'] = pd.PeriodIndex(quarterly_sales['Quarter'], freq='Q')
-    quarterly_sales = quarterly_sales.sort_values(['Quarter-Sort'])
+    # Extract year and quarter
+    quarterly_sales = pd.DataFrame({
+        'Year': quarterly_revenue.index.year,
+        'Quarter': quarterly_revenue.index.astype(str),
+        'product_revenue': quarterly_revenue.to_numpy()
+    })
 
     # Initialize the figure
     fig = go.Figure()
@@ -120,26 +394,15 @@ def plot_total_sales_by_quarter_with_filter(sales_data):
     st.caption("🔍 Total sales revenue grouped by quarters, filtered by selected years.")
     return fig
 
+@chart('Sales Analysis', {'sales': ['order_date', 'product_revenue']}, aggregates=['sales_aggregates'], selection='year')
 def plot_total_sales_by_year(sales_data):
     """
     Plots total sales revenue by year using the provided sales data structure.
     Ensures the x-axis only displays full years.
     """
-    # Drop rows with invalid or missing dates
-    sales_data = sales_data.dropna(subset=['order_date'])
-
-    # Verify if the column is properly converted to datetime
-    if not pd.api.types.is_datetime64_any_dtype(sales_data['order_date']):
-        raise ValueError(
-            "The 'order_date' column is not in datetime format even after conversion. "
-            "Ensure all dates are valid and properly formatted in the source data."
-        )
-    
-    # Extract year from the date column
-    sales_data['year'] = sales_data['order_date'].dt.year
-    
-    # Calculate total sales revenue by year
-    yearly_sales = sales_data.groupby('year', as_index=False)['product_revenue'].sum()
+    # Calculate total sales revenue by year from the monthly totals
+    monthly_revenue = sales_aggregates(sales_data).monthly_totals()['product_revenue']
+    yearly_sales = monthly_revenue.groupby(monthly_revenue.index.year).sum().rename_axis('year').reset_index()
 
     # Convert year to string to ensure the x-axis only displays full years
     yearly_sales['year'] = yearly_sales['year'].astype(str)
@@ -165,12 +428,14 @@ def plot_total_sales_by_year(sales_data):
     st.caption("📊 This chart shows total sales revenue aggregated for each year.")
     return fig
 
+@chart('Sales Analysis', {'sales': ['order_date', 'product_revenue']}, aggregates=['sales_aggregates'])
 def plot_sales_growth_rate_by_month(sales_data):
-    # Extract year and month for grouping
-    sales_data['year_month'] = sales_data['order_date'].dt.to_period('M').astype(str)
-    
-    # Calculate total sales by year and month
-    monthly_sales = sales_data.groupby('year_month', as_index=False)['product_revenue'].sum()
+    # Total sales by year and month from the monthly totals
+    monthly_revenue = sales_aggregates(sales_data).monthly_totals()['product_revenue']
+    monthly_sales = pd.DataFrame({
+        'year_month': monthly_revenue.index.astype(str),
+        'product_revenue': monthly_revenue.to_numpy()
+    })
     
     # Calculate the percentage change in total_sales_revenue (growth rate)
     monthly_sales['sales_growth_rate'] = monthly_sales['product_revenue'].pct_change() * 100
@@ -193,16 +458,16 @@ def plot_sales_growth_rate_by_month(sales_data):
     st.caption("📈 Monthly growth rate of sales revenue to identify trends over time.")
     return fig
 
+@chart('Sales Analysis', {'sales': ['order_date', 'product_revenue']}, aggregates=['sales_aggregates'])
 def plot_aov_by_month(sales_data):
 
-    # Extract year and month for grouping
-    sales_data['year_month'] = sales_data['order_date'].dt.to_period('M').astype(str)
-    
-    # Calculate total total_sales_revenue and number of orders by month
-    monthly_data = sales_data.groupby('year_month', as_index=False).agg(
-        total_sales=('product_revenue', 'sum'),
-        num_orders=('product_revenue', 'count')
-    )
+    # Total revenue and number of orders by month from the monthly totals
+    monthly_totals = sales_aggregates(sales_data).monthly_totals()
+    monthly_data = pd.DataFrame({
+        'year_month': monthly_totals.index.astype(str),
+        'total_sales': monthly_totals['product_revenue'].to_numpy(),
+        'num_orders': monthly_totals['revenue_lines'].to_numpy()
+    })
     
     # Calculate AOV
     monthly_data['aov'] = monthly_data['total_sales'] / monthly_data['num_orders']
@@ -225,18 +490,14 @@ def plot_aov_by_month(sales_data):
     st.caption("💡 Displays the average revenue per order on a monthly basis.")
     return fig
     
+@chart('Sales Analysis', {'sales': ['order_id', 'order_date']}, aggregates=['sales_aggregates'], cost='medium')
 def plot_total_orders_by_quarter(sales_data):
     """
     Plots the total number of orders placed by quarter.
     """
-    # Drop rows with invalid dates after conversion
-    sales_data = sales_data.dropna(subset=['order_date'])
-    
-    # Extract the year and quarter from the order_date
-    sales_data['Year_Quarter'] = sales_data['order_date'].dt.to_period('Q')
-    
-    # Group by Year_Quarter and count unique orders
-    quarterly_orders = sales_data.groupby('Year_Quarter')['order_id'].nunique().reset_index()
+    # Count unique orders per quarter from the order rollup (one row per order_id)
+    orders = sales_aggregates(sales_data).orders
+    quarterly_orders = orders.groupby(orders['month'].dt.asfreq('Q')).size().reset_index()
     quarterly_orders.columns = ['Quarter', 'Total Orders']
     
     # Sort the data by quarter
@@ -264,15 +525,18 @@ def plot_total_orders_by_quarter(sales_data):
     st.caption("🛒 Total number of orders grouped by quarters for all years.")
     return fig
 
+@chart('Sales Analysis', {'sales': ['discount_amount']}, aggregates=['sales_aggregates'])
 def plot_avg_discounted_amount(sales_data):
     """
     Plots the average amount discounted for orders where a discount code was used.
     """
-    # Filter for orders where a discount code was used (discount_amount > 0)
-    discounted_orders = sales_data[sales_data['discount_amount'] > 0]
+    # Sum and count the discounts of orders where a discount code was used (discount_amount > 0)
+    monthly_totals = sales_aggregates(sales_data).monthly_totals()
     
     # Calculate the average discount amount
-    avg_discount = round(discounted_orders['discount_amount'].mean(),2)
+    avg_discount = round(
+        safe_ratio(monthly_totals['discounted_amount'].sum(), monthly_totals['discounted_lines'].sum()), 2
+    )
     
     # Prepare a DataFrame for visualization
     discount_summary = pd.DataFrame({
@@ -299,15 +563,17 @@ def plot_avg_discounted_amount(sales_data):
     st.caption("🎟️ Shows the average discount amount for orders with a discount code.")
     return fig
 
+@chart('Sales Analysis', {'sales': ['order_id', 'discount_amount']}, aggregates=['sales_aggregates'], cost='medium')
 def plot_discount_usage_rate(sales_data):
     """
     Plots the Discount Usage Rate as a gauge chart.
     Formula: (Orders with Discounts / Total Orders) x 100
     """
+    orders = sales_aggregates(sales_data).orders
     # Total orders
-    total_orders = sales_data['order_id'].nunique()
+    total_orders = len(orders)
     # Orders with discounts (discount_amount > 0)
-    discounted_orders = sales_data[sales_data['discount_amount'] > 0]['order_id'].nunique()
+    discounted_orders = int(orders['discounted'].sum())
     # Calculate discount usage rate
     discount_rate = round((discounted_orders / total_orders) * 100, 2) if total_orders > 0 else 0
     # Create the gauge chart
@@ -346,6 +612,7 @@ def plot_discount_usage_rate(sales_data):
     st.caption("🎯 Proportion of orders where a discount code was applied.")
     return fig
 
+@chart('Sales Analysis', {'sales': ['order_date', 'product_revenue']}, aggregates=['sales_aggregates'], cost='medium', time_relative=True)
 def plot_average_daily_and_hourly_sales_last_90_days(sales_data):
     """
     Plots the average sum of product revenue per day of the week and hourly sales trends
@@ -354,15 +621,18 @@ def plot_average_daily_and_hourly_sales_last_90_days(sales_data):
     Parameters:
         - sales_data: DataFrame containing sales data with 'order_date' and 'product_revenue'.
     """
-    # Filter data for the last 90 days
+    # Filter the hourly revenue for the last 90 days
     last_90_days = pd.Timestamp.utcnow() - pd.Timedelta(days=90)
-    sales_data = sales_data[sales_data['order_date'] >= last_90_days]
-
+    hourly = sales_aggregates(sales_data).hourly
+    hourly = hourly[hourly.index >= last_90_days.floor('h')]
 
     # Extract day of week, hour, and week
-    sales_data['day_of_week'] = sales_data['order_date'].dt.day_name()
-    sales_data['hour'] = sales_data['order_date'].dt.hour
-    sales_data['week'] = sales_data['order_date'].dt.to_period('W')
+    sales_data = pd.DataFrame({
+        'day_of_week': hourly.index.day_name(),
+        'hour': hourly.index.hour,
+        'week': _naive_index(hourly.index).to_period('W'),
+        'product_revenue': hourly.to_numpy()
+    })
 
     # Aggregate by day of the week to calculate the average sum of product revenue
     daily_sales = sales_data.groupby(['day_of_week']).agg({'product_revenue': 'sum'}).reset_index()
@@ -415,6 +685,7 @@ def plot_average_daily_and_hourly_sales_last_90_days(sales_data):
     st.caption("📅 Highlights average daily and hourly sales performance for the last 90 days.")
     return fig
 
+@chart('Sales Analysis', {'sales': ['discount_code']}, aggregates=['sales_aggregates'])
 def plot_top_discounts(sales_data, top_n=10):
     """
     Plots the top N most-used discounts based on the number of orders using each discount.
@@ -423,19 +694,8 @@ def plot_top_discounts(sales_data, top_n=10):
         - sales_data: DataFrame containing sales data with a 'discount_code' column.
         - top_n: Number of top discounts to display (default is 10).
     """
-    # Check if 'discount_code' column exists
-    if 'discount_code' not in sales_data.columns:
-        raise ValueError("The 'discount_code' column is missing from the dataset.")
-
-    # Filter rows where discounts were used (non-null discount codes)
-    discount_data = sales_data[sales_data['discount_code'].notnull()]
-
-    # Normalize the discount codes to lowercase and trim whitespace
-    discount_data['discount_code'] = discount_data['discount_code'].str.strip().str.lower()
-
-    # Count the occurrences of each discount code
-    discount_usage = discount_data.groupby('discount_code', as_index=False).size()
-    discount_usage.rename(columns={'size': 'count'}, inplace=True)
+    # Occurrences of each normalized discount code (non-null codes only)
+    discount_usage = sales_aggregates(sales_data).discount_codes.rename('count').reset_index()
 
     # Sort by usage count in descending order
     discount_usage = discount_usage.sort_values(by='count', ascending=False)
@@ -466,9 +726,10 @@ def plot_top_discounts(sales_data, top_n=10):
 
 # Order/ Product Analysis Definitions (Dropdown)
 
+@chart('Product Analysis', {'sales': ['product_name', 'product_revenue']}, aggregates=['sales_aggregates'], selection='product_name')
 def plot_top_selling_products(sales_data,top_n=10):
-    # Calculate total revenue for each product in the sales data
-    product_revenue = sales_data.groupby('product_name', as_index=False)['product_revenue'].sum()
+    # Total revenue for each product in the sales data
+    product_revenue = sales_aggregates(sales_data).product_totals[['product_revenue']].reset_index()
     
     # Sort by revenue in descending order
     top_products = product_revenue.sort_values(by='product_revenue', ascending=False).head(top_n)
@@ -496,6 +757,7 @@ def plot_top_selling_products(sales_data,top_n=10):
     st.caption(f"🛍️ Top {top_n} products ranked by total sales revenue.")
     return fig
 
+@chart('Product Analysis', {'sales': ['product_name', 'product_revenue']}, aggregates=['sales_aggregates'])
 def plot_combined_product_sales_with_labels(sales_data, top_n=10):
     """
     Plots a combined bar graph showing percentage shares of sales volume (order counts)
@@ -505,15 +767,16 @@ def plot_combined_product_sales_with_labels(sales_data, top_n=10):
         - sales_data: DataFrame containing sales data with 'product_name' and 'product_revenue'.
         - top_n: Number of top products to include.
     """
+    product_totals = sales_aggregates(sales_data).product_totals
+
     # Calculate total sales volume (order counts) for each product
-    product_sales_volume = sales_data.groupby('product_name', as_index=False)['product_revenue'].count()
-    product_sales_volume.rename(columns={'product_revenue': 'order_count'}, inplace=True)
+    product_sales_volume = product_totals['revenue_lines'].rename('order_count').reset_index()
     product_sales_volume['percentage_volume'] = (
         product_sales_volume['order_count'] / product_sales_volume['order_count'].sum() * 100
     )
     
     # Calculate total sales revenue for each product
-    product_sales_revenue = sales_data.groupby('product_name', as_index=False)['product_revenue'].sum()
+    product_sales_revenue = product_totals[['product_revenue']].reset_index()
     product_sales_revenue['percentage_revenue'] = (
         product_sales_revenue['product_revenue'] / product_sales_revenue['product_revenue'].sum() * 100
     )
@@ -566,10 +829,22 @@ def plot_combined_product_sales_with_labels(sales_data, top_n=10):
     st.caption("🔄 Comparison of product sales volume and total revenue impact for top products.")
     return fig
 
-def segment_by_spend_level(customer_data):
+# Spend levels are cached per customer frame (categorical, so stored as small integer codes)
+_SPEND_LEVELS = FrameCache()
+
+
+def spend_levels(customer_data):
     """
-    Segments customers based on total spending and visualizes the distribution as a bar chart.
+    Segments customers based on total spending, returns the spend level of every customer as a categorical Series.
     """
+    levels = _SPEND_LEVELS.get(customer_data)
+    if levels is None:
+        levels = _spend_levels(customer_data)
+        _SPEND_LEVELS.set(customer_data, levels)
+    return levels
+
+
+def _spend_levels(customer_data):
     # Calculate dynamic bins
     max_total_spent = customer_data['total_spent'].max()
     min_total_spent = customer_data['total_spent'].min()
@@ -591,15 +866,20 @@ def segment_by_spend_level(customer_data):
             labels.append(f'{bins[i]}-{bins[i+1]}')
 
     # Segment customers based on spend levels
-    customer_data['spend_level'] = pd.cut(
+    return pd.cut(
         customer_data['total_spent'],
         bins=bins,
         labels=labels,
         include_lowest=True
-    )
+    ).rename('spend_level')
 
-    # Group and prepare data for visualization
-    spend_summary = customer_data.groupby('spend_level').size().reset_index(name='customer_count')
+@chart('Product Analysis', {'customers': ['total_spent']}, datasets=['customers'])
+def segment_by_spend_level(customer_data):
+    """
+    Segments customers based on total spending and visualizes the distribution as a bar chart.
+    """
+    # Count customers per spend level (every level, in order)
+    spend_summary = spend_levels(customer_data).value_counts(sort=False).reset_index(name='customer_count')
 
     # Create a bar chart
     fig = px.bar(
@@ -619,19 +899,22 @@ def segment_by_spend_level(customer_data):
     st.caption("💰 Groups customers into spending levels.")
     return fig
 
+@chart('Product Analysis', {'sales': ['order_id', 'refund_amount']}, aggregates=['sales_aggregates'], cost='medium')
 def plot_refund_rate_with_threshold_label(sales_data):
     """
     Plots the Refund Rate as a gauge chart with a pastel-colored legend and a threshold label.
     Formula: (Refunded Orders / Total Orders) x 100
     """
+    orders = sales_aggregates(sales_data).orders
+
     # Count total orders
-    total_orders = sales_data['order_id'].nunique()
+    total_orders = len(orders)
     
     # Count refunded orders (unique `refund_amount` greater than 0)
-    refunded_orders = sales_data[sales_data['refund_amount'] > 0]['order_id'].nunique()
+    refunded_orders = int(orders['refunded'].sum())
     
     # Calculate refund rate
-    refund_rate = round((refunded_orders / total_orders) * 100, 2)
+    refund_rate = round((refunded_orders / total_orders) * 100, 2) if total_orders > 0 else 0
     
     # Create the gauge chart
     fig = go.Figure(go.Indicator(
@@ -669,21 +952,19 @@ def plot_refund_rate_with_threshold_label(sales_data):
     st.caption("🔄 Percentage of orders refunded based on total orders.")
     return fig
 
+@chart('Product Analysis', {'sales': ['order_id', 'fulfillment_status']}, aggregates=['sales_aggregates'], cost='medium')
 def plot_fulfilled_order_rate_all_orders(sales_data):
     """
     Plots the Fulfilled Order Rate as a gauge chart for all orders.
     Formula: (Fulfilled Orders / Total Orders) x 100
     """
+    orders = sales_aggregates(sales_data).orders
+
     # Total orders
-    total_orders = sales_data['order_id'].nunique()
+    total_orders = len(orders)
     
-    # Check for null or empty values in the 'fulfillment_status' column
-    if sales_data['fulfillment_status'].nunique() == 0 or sales_data['fulfillment_status'].isnull().all():
-        fulfilled_orders = 0
-    else:
-        # Fulfilled orders (fulfillment_status == 'fulfilled')
-        fulfilled_orders = sales_data[
-            sales_data['fulfillment_status'].str.lower() == 'fulfilled']['order_id'].nunique()
+    # Fulfilled orders (fulfillment_status == 'fulfilled', no fulfilled orders if the column is empty)
+    fulfilled_orders = int(orders['fulfilled'].sum())
     
     # Calculate fulfilled order rate
     fulfilled_rate = round((fulfilled_orders / total_orders) * 100, 2) if total_orders > 0 else 0
@@ -726,6 +1007,7 @@ def plot_fulfilled_order_rate_all_orders(sales_data):
     st.caption("✅ Displays the percentage of successfully fulfilled orders.")
     return fig
 
+@chart('Product Analysis', {'customers': ['total_orders']}, datasets=['customers'])
 def segment_by_order_frequency(customer_data):
     """
     Segments customers based on the total number of orders and visualizes the distribution.
@@ -751,15 +1033,15 @@ def segment_by_order_frequency(customer_data):
             labels.append(f'{bins[i]}-{bins[i+1]} Orders')
 
     # Bin the data
-    customer_data['order_frequency'] = pd.cut(
+    order_frequency = pd.cut(
         customer_data['total_orders'],
         bins=bins,
         labels=labels,
         include_lowest=True
-    )
+    ).rename('order_frequency')
 
     # Create the frequency summary
-    frequency_summary = customer_data.groupby('order_frequency').size().reset_index(name='customer_count')
+    frequency_summary = order_frequency.value_counts(sort=False).reset_index(name='customer_count')
 
     # Plot the results
     fig = px.bar(
@@ -775,69 +1057,44 @@ def segment_by_order_frequency(customer_data):
 
 # Customer/ Regional & Other Analysis Definitions (Dropdown)
 
+def prepare_world_locations(world_cities, world_countries):
+    """
+    Normalizes the city and country reference tables once, so they can be matched against customer locations.
+
+    Returns:
+    - The world_cities and world_countries DataFrames with lowercased names and ISO2 codes.
+    """
+    world_cities = world_cities.assign(
+        city_ascii=world_cities['city_ascii'].str.lower(),
+        country=world_cities['country'].str.lower(),
+        iso2=world_cities['iso2'].str.lower()
+    )
+    world_countries = world_countries.assign(
+        country=world_countries['country'].str.lower(),
+        iso2=world_countries['iso2'].str.lower()
+    )
+    return world_cities, world_countries
+
+@chart('Demographic Analysis', {'customers': ['customer_id', 'location', 'iso2', 'total_spent']}, datasets=['customers', 'world_cities', 'world_countries'], aggregates=['customer_geocodes'], cost='heavy')
 def visualize_customer_distribution_city(customer_data, world_cities, world_countries):
     """
     Visualizes customer distribution as a scatter plot on a map using either city or country names in the 'location' column.
 
     Parameters:
     - customer_data: DataFrame containing customer data with 'location' (city or country) and 'iso2' columns.
-    - world_cities: DataFrame with city, country, latitude, longitude, and ISO2 code information for cities.
-    - world_countries: DataFrame with country, latitude, longitude, and ISO2 code information for countries.
+    - world_cities: DataFrame with city, country, latitude, longitude, and ISO2 code information for cities
+      (normalized with prepare_world_locations).
+    - world_countries: DataFrame with country, latitude, longitude, and ISO2 code information for countries
+      (normalized with prepare_world_locations).
 
     Returns:
     - A Plotly scatter map visualization.
     """
 
-    # Normalize location names and ISO2 codes for consistent matching
-    customer_data['location'] = customer_data['location'].str.lower()
-    customer_data['iso2'] = customer_data['iso2'].str.lower()
-    world_cities['city_ascii'] = world_cities['city_ascii'].str.lower()
-    world_cities['country'] = world_cities['country'].str.lower()
-    world_cities['iso2'] = world_cities['iso2'].str.lower()
-    world_countries['country'] = world_countries['country'].str.lower()
-    world_countries['iso2'] = world_countries['iso2'].str.lower()
-
-    # Attempt to match as cities first
-    city_matches = pd.merge(
-        customer_data,
-        world_cities,
-        left_on=['location', 'iso2'],
-        right_on=['city_ascii', 'iso2'],
-        how='inner'
-    )
-
-    # Calculate match percentage for cities
-    city_match_percentage = len(city_matches) / len(customer_data) if len(customer_data) > 0 else 0
-
-    # Set a threshold for city match acceptance (e.g., 50%)
-    city_match_threshold = 0.5
-
-    if city_match_percentage >= city_match_threshold:
-        # If city matches exceed the threshold, use city matches
-        combined_matches = city_matches
-        match_type = 'city'
-    else:
-        # Fallback to country matches
-        country_matches = pd.merge(
-            customer_data,
-            world_countries,
-            left_on=['location', 'iso2'],
-            right_on=['country', 'iso2'],
-            how='inner'
-        )
-
-        if len(country_matches) > 0:
-            combined_matches = country_matches
-            match_type = 'country'
-        else:
-            print("No matching data found for the provided locations. Please check your input.")
-            return
-
-    # Aggregate customer data by location (city or country)
-    location_summary = combined_matches.groupby(['location', 'lat', 'lng']).agg(
-        total_customers=('customer_id', 'count'),
-        total_spent=('total_spent', 'sum')
-    ).reset_index()
+    location_summary, match_type = geocode_customer_locations(customer_data, world_cities, world_countries)
+    if match_type is None:
+        print("No matching data found for the provided locations. Please check your input.")
+        return
 
     if location_summary.empty:
         print("No data to display after aggregation. Please check your input data.")
@@ -868,17 +1125,20 @@ def visualize_customer_distribution_city(customer_data, world_cities, world_coun
     st.caption("🌍 Geographic distribution of customers based on city or country.")
     return fig
 
+@chart('Demographic Analysis', {'customers': ['returning_customer']}, datasets=['customers'])
 def plot_customer_retention_rate_as_gauge(customer_data):
     """
     Plots the Customer Retention Rate as a gauge chart.
     Formula: (Repeat Customers / Total Customers) x 100
     """
-    # Convert the 'returning_customer' column to numeric (1 for 'Yes', 0 for 'No')
-    customer_data['returning_customer_numeric'] = customer_data['returning_customer'].apply(lambda x: 1 if x == 'yes' else 0)
-    
-    # Calculate total customers and repeat customers
-    total_customers = customer_data.shape[0]
-    repeat_customers = customer_data['returning_customer_numeric'].sum()
+    # Calculate total customers and repeat customers ('returning_customer' is a nullable boolean column,
+    # customers with an unknown status are left out of both)
+    known_status = customer_data['returning_customer'].dropna()
+    total_customers = known_status.shape[0]
+    if total_customers == 0:
+        return
+    repeat_customers = int(known_status.sum())
+    unknown_customers = customer_data.shape[0] - total_customers
     
     # Calculate retention rate
     retention_rate = round((repeat_customers / total_customers) * 100, 2)
@@ -908,26 +1168,21 @@ def plot_customer_retention_rate_as_gauge(customer_data):
         title=f"Customer Retention Rate: {retention_rate}%",
         height=400
     )
-    st.caption("🔄 Proportion of customers who returned for additional purchases.")
+    st.caption("🔄 Proportion of customers who returned for additional purchases." + (
+        f" {unknown_customers:,} customers with an unknown returning status are left out." if unknown_customers else ""
+    ))
     return fig
 
+@chart('Demographic Analysis', {'customers': ['returning_customer']}, datasets=['customers'])
 def plot_new_vs_returning_customers(customer_data):
     """
     Plots the proportion of new vs. returning customers based on the 'returning_customer' column.
     """
-    # Normalize 'returning_customer' to 'Returning' or 'New'
-    def classify_customer(value):
-        if isinstance(value, str):  # Handle string inputs
-            return 'Returning' if value.lower() == 'yes' else 'New'
-        elif isinstance(value, bool):  # Handle boolean inputs
-            return 'Returning' if value else 'New'
-        else:  # Handle unexpected cases
-            return 'New'  # Default to 'New' if value is None or unrecognized
-
-    customer_data['Customer Type'] = customer_data['returning_customer'].apply(classify_customer)
+    # Map the nullable boolean 'returning_customer' column to 'Returning', 'New' or 'Unknown' (missing status)
+    customer_type = customer_data['returning_customer'].map({True: 'Returning', False: 'New'}).fillna('Unknown').rename('Customer Type')
     
     # Calculate counts for new and returning customers
-    customer_summary = customer_data['Customer Type'].value_counts().reset_index()
+    customer_summary = customer_type.value_counts().reset_index()
     customer_summary.columns = ['Customer Type', 'Count']
     
     # Calculate proportions
@@ -948,6 +1203,7 @@ def plot_new_vs_returning_customers(customer_data):
     st.caption("👥 Compares the proportion of new customers to returning customers.")
     return fig
 
+@chart('Demographic Analysis', {'sales': ['location', 'product_revenue']}, aggregates=['sales_aggregates'], selection='location')
 def plot_sales_by_region(sales_data, top_n=10):
     """
     Plots total sales revenue by region (city), filtered to the top N cities based on revenue.
@@ -956,11 +1212,8 @@ def plot_sales_by_region(sales_data, top_n=10):
         - sales_data: DataFrame containing sales data with 'location' and 'total_sales_revenue'.
         - top_n: Number of top cities to display (default is 10).
     """
-    # Normalize the 'location' column
-    sales_data['location'] = sales_data['location'].str.strip().str.lower()
-
-    # Aggregate total sales revenue by location
-    location_sales = sales_data.groupby('location', as_index=False)['product_revenue'].sum()
+    # Total sales revenue by (normalized) location
+    location_sales = sales_aggregates(sales_data).location_totals[['product_revenue']].reset_index()
 
     # Filter for the top N cities by total sales revenue
     top_locations = location_sales.sort_values(by='product_revenue', ascending=False).head(top_n)
@@ -986,41 +1239,33 @@ def plot_sales_by_region(sales_data, top_n=10):
     st.caption(f"📍 Displays the top {top_n} regions based on total sales revenue.")
     return fig
 
-def plot_region_sales_growth(sales_data, top_n=10):
+@chart('Demographic Analysis', {'sales': ['order_date', 'location', 'product_revenue']}, aggregates=['sales_aggregates', 'region_forecast'], cost='medium')
+def plot_region_sales_growth(sales_data, top_n=10, forecast_months=3):
     """
-    Plots sales growth trends for the top N regions based on total revenue.
+    Plots sales growth trends for the top N regions based on total revenue, with a forecast per region.
 
     Parameters:
         - sales_data: DataFrame containing sales data with columns 'order_date', 'location', and 'product_revenue'.
         - top_n: Number of top regions (cities) to display (default is 10).
+        - forecast_months: Number of months to forecast per region (0 to hide the forecast).
     """
-    # Ensure 'order_date' is in datetime format
-    sales_data['order_date'] = pd.to_datetime(sales_data['order_date'], errors='coerce', utc=True)
-    
-    # Verify if the column is properly converted to datetime
-    if not pd.api.types.is_datetime64_any_dtype(sales_data['order_date']):
-        raise ValueError("The 'order_date' column is not in datetime format.")
-    
-    # Extract year and month for grouping
-    sales_data['year_month'] = sales_data['order_date'].dt.to_period('M').astype(str)
-
-    # Normalize the 'location' column
-    sales_data['location'] = sales_data['location'].str.strip().str.lower()
+    aggregates = sales_aggregates(sales_data)
 
-    # Aggregate total sales revenue by region (city)
-    total_region_sales = sales_data.groupby('location', as_index=False)['product_revenue'].sum()
+    # Total sales revenue by region (city)
+    total_region_sales = aggregates.location_totals[['product_revenue']].reset_index()
 
     # Filter for the top N regions by total sales revenue
     top_regions = total_region_sales.sort_values(by='product_revenue', ascending=False).head(top_n)['location']
 
-    # Filter the sales data to include only the top N regions
-    filtered_sales_data = sales_data[sales_data['location'].isin(top_regions)]
-
-    # Aggregate sales by region and time
-    region_time_sales = filtered_sales_data.groupby(['location', 'year_month'], as_index=False)['product_revenue'].sum()
+    # Aggregate sales by region and time from the monthly cube, only for the top N regions
+    cube_revenue = aggregates.monthly_cube['product_revenue']
+    cube_revenue = cube_revenue[cube_revenue.index.get_level_values('location').isin(top_regions)]
+    region_time_sales = cube_revenue.groupby(level=['location', 'month'], observed=True).sum().reset_index()
+    region_time_sales = region_time_sales.rename(columns={'month': 'year_month'})
+    region_time_sales['year_month'] = region_time_sales['year_month'].astype(str)
 
     # Calculate percentage change (growth rate) within each region
-    region_time_sales['growth_rate'] = region_time_sales.groupby('location')['product_revenue'].pct_change() * 100
+    region_time_sales['growth_rate'] = region_time_sales.groupby('location', observed=True)['product_revenue'].pct_change() * 100
 
     # Plot sales trends for each region
     fig = px.line(
@@ -1033,22 +1278,47 @@ def plot_region_sales_growth(sales_data, top_n=10):
         markers=True,
         color_discrete_sequence=px.colors.qualitative.Set3  # Use a predefined color palette
     )
+
+    # Dashed forecast per region, continuing from the last month; all regions are fitted together once per dataset
+    model = revenue_forecast(sales_data, by='location') if forecast_months else None
+    if model is not None:
+        forecasts = model.predict(forecast_months)
+        last_month = str(model.last_month)
+        for trace in list(fig.data):
+            if trace.name not in forecasts.index:
+                continue
+            forecast = forecasts.loc[trace.name]
+            x, y = list(forecast.index.astype(str)), list(forecast.to_numpy())
+            if last_month in trace.x:
+                x, y = [last_month] + x, [trace.y[list(trace.x).index(last_month)]] + y
+            fig.add_trace(go.Scatter(
+                x=x,
+                y=y,
+                name=f"{trace.name} (forecast)",
+                legendgroup=trace.legendgroup,
+                showlegend=False,
+                mode='lines',
+                line=dict(color=trace.line.color, dash='dash')
+            ))
+
     fig.update_layout(
         template='plotly_white',
         xaxis_title="Year-Month",
         yaxis_title="Sales",
         hovermode="x unified"
     )
-    st.caption(f"📈 Sales growth trends for the top {top_n} regions.")
+    st.caption(f"📈 Sales growth trends for the top {top_n} regions, dashed lines show the forecast.")
     return fig
 
+@chart('Demographic Analysis', {'customers': ['location']}, datasets=['customers'])
 def segment_by_location(customer_data):
     """
     Visualizes the top 10 locations by customer count.
     """
-    # Normalize the 'location' column
-    customer_data['location'] = customer_data['location'].str.strip().str.lower()
-    location_summary = customer_data.groupby('location').size().reset_index(name='customer_count')
+    # Count customers per normalized location (normalized once per distinct location)
+    locations = normalize_labels(customer_data['location'])
+    location_summary = locations.groupby(locations, observed=True).size().reset_index(name='customer_count')
+    location_summary['location'] = location_summary['location'].astype(object)
     top_10_locations = location_summary.nlargest(10, 'customer_count')
     fig = px.bar(
         top_10_locations,
@@ -1060,4 +1330,361 @@ def segment_by_location(customer_data):
     )
     st.caption("📌 Highlights the top 10 locations with the highest customer counts.")
     return fig
-   
+
+
+@chart(
+    'Demographic Analysis',
+    {'sales': ['customer_id', 'order_id', 'product_revenue'], 'customers': ['customer_id', 'total_spent']},
+    datasets=['sales', 'customers'],
+    aggregates=['customer_rollup', 'customer_index'],
+    cost='heavy',
+    row_level=True
+)
+def plot_revenue_by_customer_segment(sales_data, customer_data):
+    """
+    Plots sales revenue and number of orders per customer spend level, linking the sales line items
+    to the customer data through their 'customer_id'.
+
+    Parameters:
+        - sales_data: DataFrame containing sales data with 'customer_id', 'order_id' and 'product_revenue'.
+        - customer_data: DataFrame containing customer data with 'customer_id' and 'total_spent'.
+    """
+    # Join per distinct customer (indexed lookup on customer_id) and sum by spend level
+    segment_sales = sales_by_customer_attribute(sales_data, customer_data, spend_levels(customer_data))
+
+    # Spend levels go through object: with copy-on-write, pandas cannot cast an empty categorical straight to str
+    fig = go.Figure()
+    fig.add_trace(go.Bar(
+        x=segment_sales['spend_level'].astype(object).astype(str),
+        y=segment_sales['product_revenue'],
+        name='Revenue',
+        text=segment_sales['product_revenue'],
+        texttemplate='$%{text:.2s}',
+        textposition='outside',
+        customdata=segment_sales[['orders', 'customers']],
+        hovertemplate='Spend Level: %{x}<br>Revenue: $%{y:.2f}<br>Orders: %{customdata[0]}<br>Customers: %{customdata[1]}'
+    ))
+    fig.update_layout(
+        title="Sales Revenue by Customer Spend Level",
+        xaxis_title="Spend Level",
+        yaxis_title="Total Revenue ($)",
+        template='plotly_dark'
+    )
+    st.caption("🧩 Sales revenue of each customer spend level, sales without a known customer are left out.")
+    return fig
+
+@chart('Demographic Analysis', {'sales': ['customer_id', 'order_date']}, aggregates=['cohort_matrix'], cost='heavy', row_level=True)
+def plot_cohort_retention_heatmap(sales_data):
+    """
+    Plots a cohort retention heatmap: for customers grouped by the month of their first purchase,
+    the percentage that placed an order again 1, 2, 3, ... months later.
+
+    Parameters:
+        - sales_data: DataFrame containing sales data with 'customer_id' and 'order_date'.
+    """
+    # First-purchase month x months-since matrix (cached per dataset)
+    retention = cohort_retention(sales_data)
+
+    fig = go.Figure(go.Heatmap(
+        z=retention.to_numpy(),
+        x=retention.columns,
+        y=retention.index.astype(str),
+        colorscale='Blues',
+        zmin=0,
+        zmax=100,
+        text=retention.round(1).to_numpy(),
+        texttemplate='%{text}',
+        hovertemplate='Cohort: %{y}<br>Months Since First Purchase: %{x}<br>Active Customers: %{z:.1f}%<extra></extra>',
+        colorbar=dict(title='Retention (%)')
+    ))
+    fig.update_layout(
+        title="Customer Cohort Retention",
+        xaxis_title="Months Since First Purchase",
+        yaxis_title="Cohort (First Purchase Month)",
+        yaxis=dict(autorange='reversed'),
+        template='plotly_dark',
+        height=700
+    )
+    st.caption("🔁 Share of each monthly customer cohort that purchased again in the following months.")
+    return fig
+
+@chart(
+    'Demographic Analysis',
+    {'sales': ['customer_id', 'order_id', 'order_date', 'product_revenue']},
+    aggregates=['customer_rollup'],
+    cost='heavy',
+    row_level=True,
+    download=('Download RFM Scores CSV', 'rfm_scores.csv', rfm_scores)
+)
+def plot_rfm_segments(sales_data):
+    """
+    Plots the number of customers and their revenue per RFM (recency, frequency, monetary) segment.
+
+    Parameters:
+        - sales_data: DataFrame containing sales data with 'customer_id', 'order_id', 'order_date' and 'product_revenue'.
+    """
+    # Score every customer and summarize per segment
+    rfm = rfm_scores(sales_data)
+    segment_summary = rfm.groupby('segment', as_index=False).agg(
+        customers=('customer_id', 'count'),
+        revenue=('monetary', 'sum'),
+        avg_recency_days=('recency_days', 'mean')
+    ).sort_values('customers', ascending=False)
+
+    fig = px.bar(
+        segment_summary,
+        x='segment',
+        y='customers',
+        title='Customer RFM Segments',
+        labels={'segment': 'Segment', 'customers': 'Number of Customers'},
+        text='customers',
+        color='segment',
+        color_discrete_sequence=px.colors.qualitative.Set3,
+        hover_data={'revenue': ':.2f', 'avg_recency_days': ':.0f'}
+    )
+    fig.update_layout(
+        template='plotly_dark',
+        xaxis_title="Segment",
+        yaxis_title="Number of Customers",
+        showlegend=False
+    )
+    st.caption("🏅 Customers segmented by recency, frequency and monetary value of their orders.")
+    return fig
+
+@chart(
+    'Sales Analysis',
+    {'sales': ['order_date']},
+    aggregates=['sales_aggregates', 'revenue_anomalies'],
+    cost='heavy',
+    controls={'measure': 'anomaly_measure'},
+    details=anomaly_tables
+)
+def plot_daily_anomalies(sales_data, measure='revenue', window=28, threshold=3.5):
+    """
+    Plots a daily measure with its rolling median baseline and highlights the anomalous days.
+
+    Parameters:
+        - sales_data: DataFrame containing sales data with 'order_date' and the column the measure is derived from.
+        - measure: 'revenue', 'refund_rate' or 'discount_rate' (share of line items refunded / discounted).
+        - window: Number of preceding days the baseline is computed from.
+        - threshold: Robust z-score above which a day is flagged.
+    """
+    values, baseline, scores = anomaly_scores(sales_data, measure, window=window)
+    daily = pd.DataFrame({
+        'day': values.columns,
+        'value': values.iloc[0].to_numpy() if len(values) else [],
+        'baseline': baseline.iloc[0].to_numpy() if len(values) else [],
+        'score': scores.iloc[0].to_numpy() if len(values) else []
+    })
+    anomalies = daily[daily['score'].abs() > threshold]
+
+    title = measure.replace('_', ' ').title()
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(
+        x=daily['day'],
+        y=daily['value'],
+        name=title,
+        mode='lines',
+        line=dict(color='lightblue', width=1)
+    ))
+    fig.add_trace(go.Scatter(
+        x=daily['day'],
+        y=daily['baseline'],
+        name=f'{window}-Day Median',
+        mode='lines',
+        line=dict(color='orange', dash='dot')
+    ))
+    fig.add_trace(go.Scatter(
+        x=anomalies['day'],
+        y=anomalies['value'],
+        name='Anomaly',
+        mode='markers',
+        marker=dict(color='red', size=9, symbol='circle-open', line=dict(width=2)),
+        customdata=anomalies['score'],
+        hovertemplate='%{x|%Y-%m-%d}<br>Value: %{y:.2f}<br>Score: %{customdata:.1f}<extra></extra>'
+    ))
+    fig.update_layout(
+        title=f"Daily {title} with Anomalies",
+        xaxis_title="Date",
+        yaxis_title=title,
+        template='plotly_dark',
+        hovermode='x unified'
+    )
+    st.caption(f"🚨 {len(anomalies)} anomalous days: more than {threshold} robust deviations from the median of the previous {window} days.")
+    return fig
+
+@chart(
+    'Product Analysis',
+    {'sales': ['order_id', 'product_name']},
+    aggregates=['product_pairs'],
+    cost='heavy',
+    row_level=True,
+    details=product_pair_table
+)
+def plot_product_pairs_by_lift(sales_data, top_n=10, min_orders=2):
+    """
+    Plots the top N product pairs bought together in the same order, ranked by lift.
+
+    Parameters:
+        - sales_data: DataFrame containing sales data with 'order_id' and 'product_name'.
+        - top_n: Number of pairs to display (default is 10).
+        - min_orders: Minimum number of orders a pair must appear in together (default is 2).
+    """
+    top_pairs = product_pairs(sales_data, min_orders=min_orders).head(top_n)
+    top_pairs = top_pairs.assign(pair=top_pairs['product_a'] + ' + ' + top_pairs['product_b'])
+
+    fig = px.bar(
+        top_pairs.iloc[::-1],
+        x='lift',
+        y='pair',
+        orientation='h',
+        title=f'Top {top_n} Products Bought Together (by Lift)',
+        labels={'lift': 'Lift', 'pair': 'Product Pair', 'orders': 'Orders Together'},
+        text='lift',
+        color='orders',
+        color_continuous_scale='Teal',
+        hover_data={'orders': True, 'confidence': ':.1%', 'confidence_reverse': ':.1%'}
+    )
+    fig.update_traces(texttemplate='%{text:.2f}', textposition='outside')
+    fig.update_layout(
+        template='plotly_dark',
+        xaxis_title="Lift",
+        yaxis_title="Product Pair"
+    )
+    st.caption(f"🛒 Product pairs bought together in at least {min_orders} orders; a lift above 1 means they sell together more often than by chance.")
+    return fig
+
+def _channel_breakdown(sales_data, dimensions):
+    # Roll the cached channel pivot up to the requested dimensions and derive the metrics
+    pivot = sales_aggregates(sales_data).rollup(CHANNEL_PIVOT)
+    measures = pivot.groupby(level=dimensions, dropna=False, observed=True).sum()
+    breakdown = breakdown_metrics(measures).reset_index()
+    # Labels go through object: with copy-on-write, pandas cannot cast an empty categorical straight to str
+    for dimension in dimensions:
+        breakdown[dimension] = breakdown[dimension].astype(object).astype(str).where(breakdown[dimension].notna(), 'unknown')
+    return breakdown
+
+
+@chart(
+    'Sales Analysis',
+    {'sales': ['order_id', 'order_date', 'sales_channel', 'product_revenue']},
+    aggregates=['sales_aggregates'],
+    controls={'metric': 'channel_metric'}
+)
+def plot_channel_sales_by_month(sales_data, metric='product_revenue'):
+    """
+    Plots a monthly metric per sales channel.
+
+    Parameters:
+        - sales_data: DataFrame containing sales data with 'order_id', 'order_date', 'sales_channel' and 'product_revenue'.
+        - metric: 'product_revenue', 'orders', 'aov' (average order value) or 'refund_rate' (% of orders with a refunded line).
+    """
+    channel_months = _channel_breakdown(sales_data, ['sales_channel', 'month'])
+
+    fig = px.line(
+        channel_months,
+        x='month',
+        y=metric,
+        color='sales_channel',
+        title=f'{CHANNEL_METRICS[metric]} by Sales Channel and Month',
+        labels={'month': 'Year-Month', metric: CHANNEL_METRICS[metric], 'sales_channel': 'Sales Channel'},
+        markers=True,
+        color_discrete_sequence=px.colors.qualitative.Set2
+    )
+    fig.update_layout(
+        template='plotly_dark',
+        xaxis_title="Year-Month",
+        yaxis_title=CHANNEL_METRICS[metric],
+        hovermode="x unified"
+    )
+    st.caption("🛍️ Monthly performance of each sales channel.")
+    return fig
+
+
+@chart(
+    'Sales Analysis',
+    {'sales': ['order_id', 'sales_channel', 'fulfillment_status', 'product_revenue']},
+    aggregates=['sales_aggregates'],
+    controls={'metric': 'channel_metric'},
+    selection='sales_channel'
+)
+def plot_channel_fulfillment_breakdown(sales_data, metric='product_revenue'):
+    """
+    Plots a metric per sales channel, split by fulfillment status.
+
+    Parameters:
+        - sales_data: DataFrame containing sales data with 'order_id', 'sales_channel', 'fulfillment_status' and 'product_revenue'.
+        - metric: 'product_revenue', 'orders', 'aov' (average order value) or 'refund_rate' (% of orders with a refunded line).
+    """
+    channel_status = _channel_breakdown(sales_data, ['sales_channel', 'fulfillment_status'])
+
+    fig = px.bar(
+        channel_status,
+        x='sales_channel',
+        y=metric,
+        color='fulfillment_status',
+        barmode='group',
+        title=f'{CHANNEL_METRICS[metric]} by Sales Channel and Fulfillment Status',
+        labels={'sales_channel': 'Sales Channel', metric: CHANNEL_METRICS[metric], 'fulfillment_status': 'Fulfillment Status'},
+        text=metric,
+        color_discrete_sequence=px.colors.qualitative.Pastel
+    )
+    fig.update_traces(texttemplate='%{text:.2f}', textposition='outside')
+    fig.update_layout(
+        template='plotly_dark',
+        xaxis_title="Sales Channel",
+        yaxis_title=CHANNEL_METRICS[metric]
+    )
+    st.caption("📦 Each sales channel split by the fulfillment status of its orders.")
+    return fig
+
+@chart(
+    'Sales Analysis',
+    {'sales': ['order_id', 'order_date', 'product_revenue']},
+    aggregates=['sales_aggregates'],
+    controls={'comparison': 'comparison', 'metric': 'comparison_metric'}
+)
+def plot_period_comparison(sales_data, comparison='yoy', metric='product_revenue'):
+    """
+    Plots the year-over-year or month-over-month change of a monthly metric.
+
+    Parameters:
+        - sales_data: DataFrame containing sales data with 'order_id', 'order_date' and 'product_revenue'.
+        - comparison: 'yoy' (same month one year earlier) or 'mom' (previous month).
+        - metric: 'product_revenue', 'orders', 'aov', 'refund_rate' (% of orders with a refunded line) or
+          'discount_rate' (% of line items discounted).
+    """
+    comparison_title, lag = COMPARISONS[comparison]
+    table = period_comparison(sales_data, lag)
+
+    # Only months that have a previous period to compare with
+    table = table[table[f'{metric}_previous'].notna() & table[f'{metric}_change'].notna()]
+    monthly_change = pd.DataFrame({
+        'year_month': table.index.astype(str),
+        'current': table[metric].to_numpy(),
+        'previous': table[f'{metric}_previous'].to_numpy(),
+        'change': table[f'{metric}_change'].to_numpy()
+    })
+    is_rate = metric in RATE_METRICS
+    change_title = 'Change (percentage points)' if is_rate else 'Change (%)'
+
+    fig = go.Figure(go.Bar(
+        x=monthly_change['year_month'],
+        y=monthly_change['change'],
+        marker_color=monthly_change['change'].ge(0).map({True: 'seagreen', False: 'indianred'}),
+        customdata=monthly_change[['current', 'previous']],
+        hovertemplate='%{x}<br>Current: %{customdata[0]:.2f}<br>Previous: %{customdata[1]:.2f}<br>Change: %{y:.2f}<extra></extra>'
+    ))
+    fig.update_layout(
+        title=f"{COMPARISON_METRICS[metric]}: {comparison_title} Change",
+        xaxis_title="Year-Month",
+        yaxis_title=change_title,
+        template='plotly_dark',
+        xaxis=dict(tickangle=-45)
+    )
+    st.caption(f"🔁 {comparison_title} change of {COMPARISON_METRICS[metric].lower()} per month.")
+    return fig
+
+def _naive_index(index):
+    # Periods carry no timezone, drop it (after converting to UTC) before converting timestamps
+    return index.tz_convert(None) if index.tz is not None else index
@@ -0,0 +1,141 @@
+## This page computes the shared sales aggregates with SQL in an embedded DuckDB database
+
+import os
+import tempfile
+import threading
+
+import duckdb
+import numpy as np
+import pandas as pd
+
+from aggregates import DAILY_MEASURES, encoded_lines, renumber_codes, assemble_aggregates
+
+# Measures of the monthly cube, their SQL and the sales column they sum (None for counts);
+# sums default to 0 like pandas sums over missing values
+_CUBE_MEASURES = {
+    'product_revenue': ('coalesce(sum(product_revenue), 0)', 'product_revenue'),
+    'revenue_lines': ('count(product_revenue)', None),
+    'total_sales_revenue': ('coalesce(sum(total_sales_revenue), 0)', 'total_sales_revenue'),
+    'discounted_amount': ('coalesce(sum(discount_amount) FILTER (discount_amount > 0), 0)', 'discounted_amount'),
+    'discounted_lines': ('count(*) FILTER (discount_amount > 0)', None),
+    'refund_amount': ('coalesce(sum(refund_amount), 0)', 'refund_amount'),
+    'refunded_lines': ('count(*) FILTER (refund_amount > 0)', None),
+    'quantity_sold': ('coalesce(sum(quantity_sold), 0)', 'quantity_sold'),
+    'lines': ('count(*)', None),
+    'orders': ('count(first_lines.line)', None),
+    'refunded_orders': ('count(first_refunds.line)', None)
+}
+
+# Data that does not fit in memory is spilled to this directory
+SPILL_DIRECTORY = os.path.join(tempfile.gettempdir(), 'dashlit_duckdb')
+
+_DATABASE = None
+_DATABASE_LOCK = threading.Lock()
+
+
+def _connection():
+    # One in-memory database per process (using every core); each call gets its own connection to it,
+    # so sessions running in parallel threads do not share a connection
+    global _DATABASE
+    with _DATABASE_LOCK:
+        if _DATABASE is None:
+            _DATABASE = duckdb.connect(config={'temp_directory': SPILL_DIRECTORY})
+    return _DATABASE.cursor()
+
+
+def _sort_orders(connection, order_ids):
+    # Order of the distinct order ids; DuckDB sorts them much faster than NumPy sorts Python strings
+    connection.register('order_ids', pd.DataFrame({'order_id': order_ids, 'code': np.arange(len(order_ids))}))
+    return connection.execute("SELECT code FROM order_ids ORDER BY order_id").fetchnumpy()['code']
+
+
+def _measure_types(sales_data):
+    # SQL type of every measure: counts and sums of integer columns are BIGINT (DuckDB sums integers
+    # as 128-bit integers), other sums DOUBLE, matching the dtypes of the pandas sums.
+    # Discounted amounts are floats in pandas (masked with where), whatever the column type.
+    return {
+        name: 'BIGINT' if column is None or (column in sales_data and pd.api.types.is_integer_dtype(sales_data[column])) else 'DOUBLE'
+        for name, (_, column) in _CUBE_MEASURES.items()
+    }
+
+
+def duckdb_aggregates(sales_data, existing_orders=None, refunded_orders=None):
+    """
+    Builds the same SalesAggregates as SalesAggregates.from_frame, with every aggregation over the line
+    items expressed as SQL and run by DuckDB (multi-threaded, spilling to disk when memory runs out).
+
+    The sales columns are scanned in place, without a copy into the database.
+    """
+    columns, categories, order_ids = encoded_lines(sales_data)
+    frame = pd.DataFrame(columns)
+    fulfilled = categories['fulfillment_status'].get_indexer(['fulfilled'])[0]
+    fulfilled_sql = f'fulfillment_status = {fulfilled}' if fulfilled >= 0 else 'false'
+    types = _measure_types(sales_data)
+    measures = ',\n'.join(f"CAST({sql} AS {types[name]}) AS {name}" for name, (sql, _) in _CUBE_MEASURES.items())
+    daily_measures = ', '.join(f'CAST(sum({name}) AS {types[name]}) AS {name}' for name in DAILY_MEASURES)
+
+    connection = _connection()
+    try:
+        order = _sort_orders(connection, order_ids)
+        frame['order_id'] = renumber_codes(frame['order_id'].to_numpy(), order)
+        order_ids = order_ids[order]
+        connection.register('sales', frame)
+        for name, orders in [('existing_orders', existing_orders), ('refunded_orders', refunded_orders)]:
+            codes = pd.Index(order_ids).get_indexer(orders) if orders is not None else np.array([], dtype=np.int64)
+            connection.register(name, pd.DataFrame({'order_id': codes[codes >= 0]}))
+
+        # Lines of the monthly and daily cubes, with the first line and the first refunded line of each
+        # new order
+        connection.execute(f"""
+            CREATE TEMP TABLE cube_lines AS
+            WITH first_lines AS (
+                SELECT min(line) AS line FROM sales
+                WHERE order_id >= 0 AND order_id NOT IN (SELECT order_id FROM existing_orders)
+                GROUP BY order_id
+            ), first_refunds AS (
+                SELECT min(line) AS line FROM sales
+                WHERE order_id >= 0 AND refund_amount > 0 AND order_id NOT IN (SELECT order_id FROM refunded_orders)
+                GROUP BY order_id
+            )
+            SELECT
+                date_trunc('month', order_date) AS month,
+                date_trunc('day', order_date) AS day,
+                location, product_name, sales_channel, fulfillment_status,
+                {measures}
+            FROM sales LEFT JOIN first_lines USING (line) LEFT JOIN first_refunds USING (line)
+            GROUP BY ALL
+        """)
+        monthly = connection.execute(f"""
+            SELECT month, location, product_name, sales_channel, fulfillment_status,
+                {', '.join(f'CAST(sum({name}) AS {types[name]}) AS {name}' for name in _CUBE_MEASURES)}
+            FROM cube_lines GROUP BY ALL
+        """).df()
+        daily = connection.execute(f"""
+            SELECT day, location, product_name, sales_channel, {daily_measures}
+            FROM cube_lines GROUP BY ALL
+        """).df()
+        hourly = connection.execute(f"""
+            SELECT date_trunc('hour', order_date) AS hour_start,
+                CAST(coalesce(sum(product_revenue), 0) AS {types['product_revenue']}) AS product_revenue
+            FROM sales WHERE order_date IS NOT NULL
+            GROUP BY ALL ORDER BY hour_start
+        """).df()
+        orders = connection.execute(f"""
+            SELECT
+                order_id,
+                min(date_trunc('month', order_date)) AS month,
+                coalesce(bool_or(discount_amount > 0), false) AS discounted,
+                coalesce(bool_or(refund_amount > 0), false) AS refunded,
+                coalesce(bool_or({fulfilled_sql}), false) AS fulfilled
+            FROM sales WHERE order_id >= 0
+            GROUP BY order_id ORDER BY order_id
+        """).df()
+        discount_codes = connection.execute("""
+            SELECT discount_code, count(*) AS lines FROM sales
+            WHERE discount_code >= 0
+            GROUP BY ALL ORDER BY discount_code
+        """).df()
+    finally:
+        connection.close()
+
+    return assemble_aggregates(sales_data, monthly, daily, hourly, orders, discount_codes, categories, order_ids)
@@ -0,0 +1,53 @@
+## This page caches the serialized figures of the charts, so reruns with unchanged data do not build them again
+
+import json
+from datetime import datetime, timezone
+
+import plotly.graph_objects as go
+import plotly.io
+import streamlit as st
+
+# Serialized figures kept per server process, shared by all sessions (least recently used dropped first)
+FIGURE_CACHE_ENTRIES = 512
+
+# Charts that depend on the current time (e.g. the last 90 days) are keyed by the current UTC hour,
+# the resolution of their time window
+TIME_KEY_FORMAT = '%Y-%m-%d %H'
+
+
+class _NoFigure(Exception):
+    # Raised when a chart returns no figure, so nothing is cached for it
+    pass
+
+
+@st.cache_data(max_entries=FIGURE_CACHE_ENTRIES, show_spinner=False)
+def _figure_json(key, _build):
+    # The captions a chart writes while it is built are recorded with the figure and replayed on cache hits
+    fig = _build()
+    if fig is None:
+        raise _NoFigure()
+    return plotly.io.to_json(fig, validate=False)
+
+
+def cached_figure(chart_name, dataset_keys, function, *datasets, time_relative=False, **kwargs):
+    """
+    Returns the figure of function(*datasets, **kwargs), built only the first time the chart is drawn
+    for the same data and parameters (None, not cached, if the chart returns no figure).
+
+    Parameters:
+        - chart_name: name of the chart.
+        - dataset_keys: hashable key of the datasets (e.g. their dataset hashes and the filters of a view).
+        - function: chart function returning a go.Figure.
+        - time_relative: whether the chart depends on the current time; its figure is then rebuilt every hour.
+        - kwargs: parameters of the chart (e.g. control values), part of the key.
+
+    Cached figures are decoded into a go.Figure without validating them again (they were valid when built).
+    """
+    key = (chart_name, dataset_keys, tuple(sorted(kwargs.items())))
+    if time_relative:
+        key += (datetime.now(timezone.utc).strftime(TIME_KEY_FORMAT),)
+    try:
+        figure_json = _figure_json(key, lambda: function(*datasets, **kwargs))
+    except _NoFigure:
+        return None
+    return go.Figure(json.loads(figure_json), _validate=False)
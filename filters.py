@@ -0,0 +1,300 @@
+## This page filters the sales aggregates through bitmap indexes on their dimensions
+
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from aggregates import (
+    CUBE_DIMENSIONS, FrameCache, SalesAggregates, sales_aggregates, remember_aggregates, normalize_labels,
+    cube_dimensions, first_order_lines, first_refund_lines, hourly_revenue, order_flags, discount_code_counts, totals_by,
+    _naive_utc
+)
+
+# Dimensions a selection can filter on; values are years (int), months (Period) or normalized labels
+FILTER_DIMENSIONS = ['year', 'month', 'location', 'product_name', 'sales_channel']
+
+# Label dimensions and whether they are lowercased, as normalized in the aggregates
+_LABEL_DIMENSIONS = {'location': True, 'product_name': False, 'sales_channel': False}
+
+# Filtered views kept per dataset (most recently used first out)
+_VIEWS_PER_DATASET = 16
+
+
+class BitmapIndex:
+    """
+    Row bitmaps per value of a set of dictionary-encoded dimensions.
+
+    Rows are grouped by value once (a stable sort of the codes). The packed bitmap of a value (one
+    bit per row) is built on first use and kept, so a selection costs a few bitwise ORs (values of
+    one dimension) and ANDs (across dimensions) over rows / 8 bytes instead of comparisons over
+    every row.
+    """
+
+    def __init__(self, dimensions):
+        """
+        Parameters:
+            - dimensions: dict of dimension name -> (codes per row, values the codes refer to); code -1 is missing.
+        """
+        self.size = 0
+        self._dimensions = {}
+        for name, (codes, values) in dimensions.items():
+            codes = np.asarray(codes)
+            self.size = len(codes)
+            order = np.argsort(codes, kind='stable')
+            bounds = np.searchsorted(codes[order], np.arange(len(values) + 1))
+            self._dimensions[name] = (pd.Index(values), order, bounds)
+        self._bitmaps = {}
+
+    def bitmap(self, name, value):
+        """
+        Returns the packed bitmap of the rows where dimension name has the given value.
+        """
+        key = (name, value)
+        if key not in self._bitmaps:
+            values, order, bounds = self._dimensions[name]
+            position = values.get_indexer([value])[0]
+            rows = np.zeros(self.size, dtype=bool)
+            if position >= 0:
+                rows[order[bounds[position]:bounds[position + 1]]] = True
+            self._bitmaps[key] = np.packbits(rows)
+        return self._bitmaps[key]
+
+    def select(self, selection):
+        """
+        Returns the boolean row mask of a selection (dict of dimension -> allowed values).
+        """
+        packed = np.full((self.size + 7) // 8, 255, dtype=np.uint8)
+        for name, values in selection.items():
+            packed &= np.bitwise_or.reduce(
+                [self.bitmap(name, value) for value in values] or [np.zeros_like(packed)]
+            )
+        return np.unpackbits(packed, count=self.size).astype(bool)
+
+
+def _month_dimensions(month_codes, months):
+    # Month and year dimensions from month codes and the months (Periods) they refer to
+    months = pd.PeriodIndex(months, freq='M')
+    year_codes, years = pd.factorize(months.year)
+    month_codes = np.asarray(month_codes)
+    return {
+        'month': (month_codes, months),
+        'year': (np.where(month_codes >= 0, year_codes[np.maximum(month_codes, 0)], -1) if len(months) else month_codes, years)
+    }
+
+
+def _level_dimension(index, level):
+    # Codes and values of one level of a MultiIndex
+    position = index.names.index(level)
+    return index.codes[position], index.levels[position]
+
+
+def cube_bitmap_index(cube, month_level):
+    """
+    Returns a BitmapIndex over the rows of a cube (monthly or daily) for every filter dimension.
+    """
+    dimensions = {name: _level_dimension(cube.index, name) for name in _LABEL_DIMENSIONS}
+    codes, values = _level_dimension(cube.index, month_level)
+    if month_level == 'day':
+        # Days are mapped onto their month
+        day_months, months = pd.factorize(pd.DatetimeIndex(values).to_period('M'))
+        codes = np.where(codes >= 0, day_months[np.maximum(codes, 0)], -1) if len(values) else codes
+        values = months
+    dimensions.update(_month_dimensions(codes, values))
+    return BitmapIndex(dimensions)
+
+
+def row_bitmap_index(sales_data):
+    """
+    Returns a BitmapIndex over the sales line items for every filter dimension.
+    """
+    month_codes, months = pd.factorize(_naive_utc(sales_data['order_date']).dt.to_period('M'))
+    dimensions = _month_dimensions(month_codes, months)
+    for name, lower in _LABEL_DIMENSIONS.items():
+        labels = normalize_labels(sales_data[name], lower=lower)
+        dimensions[name] = (labels.cat.codes.to_numpy(), labels.cat.categories)
+    return BitmapIndex(dimensions)
+
+
+# Bitmap indexes are cached per sales frame (line items) and per aggregates object (cubes)
+_ROW_INDEXES = FrameCache()
+_CUBE_INDEXES = FrameCache()
+
+
+def _row_index(sales_data):
+    index = _ROW_INDEXES.get(sales_data)
+    if index is None:
+        index = row_bitmap_index(sales_data)
+        _ROW_INDEXES.set(sales_data, index)
+    return index
+
+
+def _cube_indexes(aggregates):
+    indexes = _CUBE_INDEXES.get(aggregates)
+    if indexes is None:
+        indexes = (cube_bitmap_index(aggregates.monthly_cube, 'month'), cube_bitmap_index(aggregates.daily_cube, 'day'))
+        _CUBE_INDEXES.set(aggregates, indexes)
+    return indexes
+
+
+class FilteredAggregates(SalesAggregates):
+    """
+    SalesAggregates restricted to a selection, usable by every chart in place of the sales data.
+
+    The cubes and the product and location totals are filtered through the bitmap indexes of the cubes,
+    which costs time proportional to the size of the cubes. Only the order and refunded order counts of the
+    monthly cube are counted again, from the line items of the selection, on first use: an order is counted
+    in the cell of its first (refunded) line, which may fall outside the selection. The line items are also taken from the sales data
+    when a chart needs a line-level aggregate (hourly revenue, order flags, discount codes) or the rows
+    themselves (lines).
+
+    The view only holds a weak reference to the sales data (it is cached per sales frame), dropped once
+    the line items of the selection are taken from it.
+    """
+
+    def __init__(self, sales_data, selection):
+        aggregates = sales_aggregates(sales_data)
+        monthly_index, daily_index = _cube_indexes(aggregates)
+        self.selection = selection
+        # Measures other than the order counts add up, they are taken from the filtered cube cells
+        self._selected_cells = aggregates.monthly_cube[monthly_index.select(selection)]
+        self.daily_cube = aggregates.daily_cube[daily_index.select(selection)]
+        self.product_totals = totals_by(self._selected_cells, 'product_name')
+        self.location_totals = totals_by(self._selected_cells, 'location')
+        self._monthly_cube = None
+        self._monthly_totals = None
+        self._rollups = {}
+        self._sales_data = weakref.ref(sales_data)
+        self._lines = None
+        self._lines_lock = threading.Lock()
+        self._line_aggregates = {}
+
+    @property
+    def monthly_cube(self):
+        """
+        The cells of the monthly cube in the selection, orders counted on their first selected line and
+        refunded orders on their first refunded selected line.
+        """
+        if self._monthly_cube is None:
+            counts = {}
+            for measure, first_lines in [('orders', first_order_lines), ('refunded_orders', first_refund_lines)]:
+                lines = self.lines[first_lines(self.lines)]
+                counts[measure] = cube_dimensions(lines).groupby(CUBE_DIMENSIONS, dropna=False, observed=True).size()
+            # The first selected line of an order is in one of the selected cells
+            self._monthly_cube = self._selected_cells.assign(**{
+                measure: count.reindex(self._selected_cells.index, fill_value=0).astype(self._selected_cells[measure].dtype)
+                for measure, count in counts.items()
+            })
+        return self._monthly_cube
+
+    @property
+    def lines(self):
+        """
+        The sales line items of the selection (selected through the row bitmap index).
+        """
+        # Views are shared by sessions, the rows are taken once before the sales data is let go
+        with self._lines_lock:
+            if self._lines is None:
+                sales_data = self._sales_data()
+                rows = _row_index(sales_data).select(self.selection)
+                self._lines = sales_data[rows].reset_index(drop=True)
+                self._sales_data = None
+                # Charts given the rows instead of the aggregates find this view (weakly: the view holds the rows)
+                remember_aggregates(self._lines, self, weak=True)
+        return self._lines
+
+    def _line_aggregate(self, name, build):
+        if name not in self._line_aggregates:
+            self._line_aggregates[name] = build(self.lines)
+        return self._line_aggregates[name]
+
+    @property
+    def hourly(self):
+        return self._line_aggregate('hourly', hourly_revenue)
+
+    @property
+    def orders(self):
+        return self._line_aggregate('orders', order_flags)
+
+    @property
+    def discount_codes(self):
+        return self._line_aggregate('discount_codes', discount_code_counts)
+
+
+def selection_values(dimension, values):
+    """
+    Converts selected values (e.g. the labels of clicked chart points) to the values of a filter dimension.
+    """
+    if dimension == 'year':
+        return [int(value) for value in values]
+    if dimension == 'month':
+        return [pd.Period(value, freq='M') for value in values]
+    lower = _LABEL_DIMENSIONS[dimension]
+    return [str(value).strip().lower() if lower else str(value).strip() for value in values]
+
+
+def combine_selections(*selections):
+    """
+    Returns the selection matching all given selections: values of a dimension selected in several
+    of them are intersected.
+    """
+    combined = {}
+    for selection in selections:
+        for name, values in selection.items():
+            if name in combined:
+                combined[name] = [value for value in combined[name] if value in set(values)]
+            else:
+                combined[name] = list(values)
+    return combined
+
+
+def filter_options(sales_data):
+    """
+    Returns the values every filter dimension can take in the sales data (from the cached aggregates):
+    months in order, locations, sales channels and products sorted by name.
+    """
+    aggregates = sales_aggregates(sales_data)
+    months = aggregates.monthly_totals().index
+    return {
+        'month': list(months[months.notna()]),
+        'location': sorted(aggregates.location_totals.index.dropna()),
+        'sales_channel': sorted(aggregates.rollup(['sales_channel']).index.dropna().astype(str)),
+        'product_name': sorted(aggregates.product_totals.index.dropna())
+    }
+
+
+# Filtered views are cached per sales frame, so reruns with the same selection are free
+_VIEWS = FrameCache()
+
+
+def selection_key(selection):
+    """
+    Returns a hashable key of a selection (dict of filter dimension -> allowed values), the same
+    whatever the order of the dimensions and values.
+    """
+    return tuple(sorted((name, tuple(sorted(values))) for name, values in selection.items() if values is not None))
+
+
+def filtered_sales(sales_data, selection):
+    """
+    Returns the (cached) FilteredAggregates of a selection (dict of filter dimension -> allowed values),
+    or the sales data itself if nothing is selected.
+    """
+    selection = {name: list(values) for name, values in selection.items() if values is not None}
+    if not selection:
+        return sales_data
+    views = _VIEWS.get(sales_data)
+    if views is None:
+        views = OrderedDict()
+        _VIEWS.set(sales_data, views)
+
+    key = selection_key(selection)
+    if key in views:
+        views.move_to_end(key)
+    else:
+        views[key] = FilteredAggregates(sales_data, selection)
+        if len(views) > _VIEWS_PER_DATASET:
+            views.popitem(last=False)
+    return views[key]
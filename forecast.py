@@ -0,0 +1,126 @@
+## This page fits seasonal exponential smoothing forecasts on the monthly revenue series
+
+import numpy as np
+import pandas as pd
+
+from aggregates import FrameCache, sales_aggregates
+
+SEASON_LENGTH = 12
+
+# Smoothing parameters tried for level (alpha), trend (beta) and season (gamma)
+PARAMETER_GRID = np.linspace(0.1, 0.9, 5)
+
+
+class SeasonalForecast:
+    """
+    Additive Holt-Winters models (level, trend and monthly season) fitted to a batch of monthly series.
+
+    All series are fitted at once: the smoothing recursions run over the months only, with every
+    series and every candidate (alpha, beta, gamma) evaluated as one NumPy array, and each series
+    keeps the candidate with the lowest one-step-ahead squared error. Series shorter than two
+    seasons are fitted without the seasonal component.
+    """
+
+    def __init__(self, series):
+        """
+        Parameters:
+            - series: DataFrame with one row per series and one column per consecutive month (PeriodIndex).
+        """
+        self.keys = series.index
+        self.last_month = series.columns[-1]
+        values = series.to_numpy(dtype='float64')
+        periods = values.shape[1]
+
+        seasonal = periods >= 2 * SEASON_LENGTH
+        season_length = SEASON_LENGTH if seasonal else 1
+        alpha, beta, gamma = np.meshgrid(PARAMETER_GRID, PARAMETER_GRID, PARAMETER_GRID if seasonal else [0.0], indexing='ij')
+        alpha, beta, gamma = alpha.ravel(), beta.ravel(), gamma.ravel()
+
+        # Initial state from the first season (or the first two months without seasonality)
+        if seasonal:
+            first_season = values[:, :season_length].mean(axis=1)
+            second_season = values[:, season_length:2 * season_length].mean(axis=1)
+            level = first_season
+            trend = (second_season - first_season) / season_length
+            season = values[:, :season_length] - first_season[:, None]
+        else:
+            level = values[:, 0]
+            trend = values[:, 1] - values[:, 0] if periods > 1 else np.zeros(len(values))
+            season = np.zeros((len(values), 1))
+
+        # State per (series, candidate) and season slot
+        candidates = len(alpha)
+        level = np.repeat(level[:, None], candidates, axis=1)
+        trend = np.repeat(trend[:, None], candidates, axis=1)
+        season = np.repeat(season[:, None, :], candidates, axis=1)
+        errors = np.zeros_like(level)
+
+        for month in range(periods):
+            slot = month % season_length
+            actual = values[:, month, None]
+            seasonal_part = season[:, :, slot]
+            errors += (actual - (level + trend + seasonal_part)) ** 2
+
+            new_level = alpha * (actual - seasonal_part) + (1 - alpha) * (level + trend)
+            trend = beta * (new_level - level) + (1 - beta) * trend
+            season[:, :, slot] = gamma * (actual - new_level) + (1 - gamma) * seasonal_part
+            level = new_level
+
+        best = errors.argmin(axis=1)
+        rows = np.arange(len(values))
+        self.parameters = pd.DataFrame(
+            {'alpha': alpha[best], 'beta': beta[best], 'gamma': gamma[best], 'sse': errors[rows, best]},
+            index=self.keys
+        )
+        self.level = level[rows, best]
+        self.trend = trend[rows, best]
+        self.season = season[rows, best]
+        self.next_slot = periods % season_length
+
+    def predict(self, horizon):
+        """
+        Returns the forecast of every series for the next horizon months (negative values clipped to 0).
+        """
+        steps = np.arange(1, horizon + 1)
+        slots = (self.next_slot + steps - 1) % self.season.shape[1]
+        values = self.level[:, None] + self.trend[:, None] * steps + self.season[:, slots]
+        months = pd.period_range(self.last_month + 1, periods=horizon, freq='M')
+        return pd.DataFrame(np.clip(values, 0, None), index=self.keys, columns=months)
+
+
+def monthly_revenue_series(sales_data, by=None):
+    """
+    Returns product revenue per month as a DataFrame with one row per value of the cube dimension by
+    (a single 'total' row if by is None) and one column per month, months without sales filled with 0.
+    """
+    aggregates = sales_aggregates(sales_data)
+    if by is None:
+        revenue = aggregates.monthly_totals()['product_revenue'].to_frame('total').T
+    else:
+        revenue = aggregates.monthly_cube['product_revenue'].groupby(level=[by, 'month'], observed=True).sum().unstack('month')
+        revenue.index = revenue.index.astype(object)
+    revenue = revenue.loc[:, revenue.columns.notna()]
+    if revenue.columns.empty:
+        return revenue
+    months = pd.period_range(revenue.columns.min(), revenue.columns.max(), freq='M')
+    return revenue.reindex(columns=months).fillna(0)
+
+
+# Fitted models are cached per dataset (its aggregates) and series dimension
+_FORECASTS = FrameCache()
+
+
+def revenue_forecast(sales_data, by=None):
+    """
+    Returns the (cached) SeasonalForecast of monthly product revenue, in total or per value of a cube
+    dimension such as 'location'. Returns None if there are fewer than two months of data.
+    """
+    aggregates = sales_aggregates(sales_data)
+    models = _FORECASTS.get(aggregates)
+    if models is None:
+        models = {}
+        _FORECASTS.set(aggregates, models)
+    if by not in models:
+        series = monthly_revenue_series(aggregates, by)
+        models[by] = SeasonalForecast(series) if series.shape[1] >= 2 else None
+    return models[by]
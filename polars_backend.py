@@ -0,0 +1,105 @@
+## This page computes the shared sales aggregates as one lazy Polars query plan
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from aggregates import (
+    CUBE_DIMENSIONS, DAILY_DIMENSIONS, DAILY_MEASURES, encoded_lines, renumber_codes, assemble_aggregates
+)
+
+
+def _cube_measures(sales_data):
+    # Measures of the monthly cube per group of line items; sums skip missing values like pandas sums,
+    # counts and sums of integer columns are Int64, other sums Float64 (discounted amounts are masked
+    # with where in pandas, so they are always floats)
+    def total(column):
+        return pl.col(column).sum().cast(pl.Int64 if pd.api.types.is_integer_dtype(sales_data[column]) else pl.Float64)
+
+    return [
+        total('product_revenue').alias('product_revenue'),
+        pl.col('product_revenue').count().cast(pl.Int64).alias('revenue_lines'),
+        total('total_sales_revenue').alias('total_sales_revenue'),
+        pl.col('discount_amount').filter(pl.col('discount_amount') > 0).sum().cast(pl.Float64).alias('discounted_amount'),
+        (pl.col('discount_amount') > 0).sum().cast(pl.Int64).alias('discounted_lines'),
+        total('refund_amount').alias('refund_amount'),
+        (pl.col('refund_amount') > 0).sum().cast(pl.Int64).alias('refunded_lines'),
+        total('quantity_sold').alias('quantity_sold'),
+        pl.len().cast(pl.Int64).alias('lines'),
+        pl.col('first_line').sum().cast(pl.Int64).alias('orders'),
+        pl.col('first_refund').sum().cast(pl.Int64).alias('refunded_orders')
+    ]
+
+
+def _to_pandas(frame):
+    # Column by column through NumPy, so pyarrow is not needed
+    return pd.DataFrame({column: frame[column].to_numpy() for column in frame.columns})
+
+
+def polars_aggregates(sales_data, existing_orders=None, refunded_orders=None):
+    """
+    Builds the same SalesAggregates as SalesAggregates.from_frame from lazy Polars queries that are
+    planned and executed together (collect_all): the line items grouped per day and cube cell are a
+    common subplan computed once for the monthly and daily cubes, each query only reads the columns
+    it uses, and all of them run multi-threaded.
+    """
+    columns, categories, order_ids = encoded_lines(sales_data)
+
+    # Order ids numbered in sorted order (like the index of the pandas order flags), sorted by Polars
+    order = pl.Series(order_ids, dtype=pl.String if order_ids.dtype == object else None).arg_sort().to_numpy()
+    columns['order_id'] = renumber_codes(columns['order_id'], order)
+    order_ids = order_ids[order]
+    existing, refunded = (
+        pd.Index(order_ids).get_indexer(orders) if orders is not None else np.array([], dtype=np.int64)
+        for orders in (existing_orders, refunded_orders)
+    )
+
+    fulfilled = categories['fulfillment_status'].get_indexer(['fulfilled'])[0]
+    is_fulfilled = pl.col('fulfillment_status') == fulfilled if fulfilled >= 0 else pl.lit(False)
+
+    # Missing numbers (NaN in pandas) become nulls, which Polars sums and counts skip
+    lines = pl.LazyFrame(columns, nan_to_null=True).with_columns(
+        month=pl.col('order_date').dt.truncate('1mo'),
+        day=pl.col('order_date').dt.truncate('1d'),
+        # An order is counted on its first line, unless it was counted in the data appended to
+        first_line=(pl.col('order_id') >= 0) & pl.col('order_id').is_first_distinct()
+        & ~pl.col('order_id').is_in(pl.Series(existing[existing >= 0], dtype=pl.Int64).implode()),
+        # A refunded order likewise on its first refunded line, unless it was refunded in the data appended to
+        first_refund=(pl.col('order_id') >= 0) & (pl.col('refund_amount') > 0)
+        & pl.when(pl.col('refund_amount') > 0).then(pl.col('order_id')).is_first_distinct()
+        & ~pl.col('order_id').is_in(pl.Series(refunded[refunded >= 0], dtype=pl.Int64).implode())
+    )
+    cells = lines.group_by(['month', 'day', 'location', 'product_name', 'sales_channel', 'fulfillment_status']).agg(
+        _cube_measures(sales_data)
+    )
+    measure_names = [measure.meta.output_name() for measure in _cube_measures(sales_data)]
+
+    monthly, daily, hourly, orders, discount_codes = pl.collect_all([
+        cells.group_by(CUBE_DIMENSIONS).agg(pl.col(measure_names).sum()),
+        cells.group_by(DAILY_DIMENSIONS).agg(pl.col(DAILY_MEASURES).sum()),
+        lines.filter(pl.col('order_date').is_not_null())
+        .group_by(hour_start=pl.col('order_date').dt.truncate('1h'))
+        .agg(_cube_measures(sales_data)[0])
+        .sort('hour_start'),
+        lines.filter(pl.col('order_id') >= 0)
+        .group_by('order_id')
+        .agg(
+            pl.col('month').min(),
+            (pl.col('discount_amount') > 0).any().alias('discounted'),
+            (pl.col('refund_amount') > 0).any().alias('refunded'),
+            is_fulfilled.any().alias('fulfilled')
+        )
+        .sort('order_id'),
+        lines.filter(pl.col('discount_code') >= 0).group_by('discount_code').agg(lines=pl.len()).sort('discount_code')
+    ])
+
+    return assemble_aggregates(
+        sales_data,
+        _to_pandas(monthly),
+        _to_pandas(daily),
+        _to_pandas(hourly),
+        _to_pandas(orders),
+        _to_pandas(discount_codes),
+        categories,
+        order_ids
+    )
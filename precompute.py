@@ -0,0 +1,120 @@
+## This page precomputes the shared aggregates of uploaded datasets in background threads
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from aggregates import FrameCache
+from definition import TABS, SHARED_AGGREGATES, charts_for_tab
+
+# Background threads owned by the server process, shared by all sessions
+PRECOMPUTE_WORKERS = 2
+_EXECUTOR = ThreadPoolExecutor(max_workers=PRECOMPUTE_WORKERS, thread_name_prefix='precompute')
+
+
+def aggregate_key(aggregate, datasets):
+    """
+    Returns the key of a shared aggregate computed from the given datasets (the frames passed to its builder).
+    """
+    return aggregate, tuple(id(dataset) for dataset in datasets)
+
+
+class Precomputation:
+    """
+    The shared aggregates of every chart of every tab for one upload, computed one after the other in
+    a background thread (tab by tab, cheap charts first) and published to the aggregate caches, so
+    switching tabs does not wait for them.
+
+    Each aggregate has its own future, claimed under a lock by whoever computes it first: the page
+    waits for an aggregate the worker (or another session) is computing, and computes the ones nobody
+    has started yet itself, so nothing is ever computed twice.
+    """
+
+    def __init__(self, datasets, available):
+        """
+        Parameters:
+            - datasets: dict of dataset name ('sales', 'customers', 'world_cities', 'world_countries') -> frame.
+            - available: dict of dataset name -> set of usable columns; charts with missing inputs are left out.
+        """
+        steps = []
+        self._futures = {}
+        self._steps = {}
+        self._lock = threading.Lock()
+        for tab in TABS:
+            for spec in charts_for_tab(tab):
+                if spec.missing_inputs(available):
+                    continue
+                for aggregate in spec.aggregates:
+                    names, build = SHARED_AGGREGATES[aggregate]
+                    arguments = [datasets[name] for name in names]
+                    key = aggregate_key(aggregate, arguments)
+                    if key not in self._futures:
+                        self._futures[key] = Future()
+                        self._steps[key] = (build, arguments)
+                        steps.append(key)
+        self._job = _EXECUTOR.submit(self._run, steps)
+
+    def _claim(self, key):
+        # Marks the aggregate as being computed by the caller, False if someone else already has
+        future = self._futures[key]
+        with self._lock:
+            return not future.running() and not future.done() and future.set_running_or_notify_cancel()
+
+    def _build(self, key):
+        # The step is dropped once claimed: the arguments are the upload's frames, which must not outlive
+        # their leases (the precomputations are cached per sales frame)
+        build, arguments = self._steps.pop(key)
+        future = self._futures[key]
+        try:
+            # The builders publish their results to the caches themselves, the future only signals completion
+            build(*arguments)
+            future.set_result(True)
+        except BaseException as e:
+            # Waiters are released whatever happens; interruptions (e.g. a stopped script) still propagate
+            future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+
+    def _run(self, steps):
+        for key in steps:
+            # Steps a page has claimed are skipped
+            if self._claim(key):
+                self._build(key)
+
+    def wait(self, aggregate, datasets):
+        """
+        Returns True once a shared aggregate is ready in the caches: it is computed in the calling thread
+        if nobody has started it yet, otherwise waited for. Returns False if the caller has to compute it
+        (not scheduled, or failed).
+        """
+        key = aggregate_key(aggregate, datasets)
+        future = self._futures.get(key)
+        if future is None:
+            return False
+        if self._claim(key):
+            self._build(key)
+        return future.exception() is None
+
+    def done(self):
+        """
+        Returns whether every aggregate has been computed (or claimed by a page).
+        """
+        return self._job.done()
+
+
+# Precomputations are kept per sales frame and customer frame, so sessions sharing an upload share them
+_PRECOMPUTATIONS = FrameCache()
+
+
+def precompute_datasets(datasets, available):
+    """
+    Starts the background precomputation of an upload's shared aggregates, or returns the one already
+    started for the same sales and customer frames.
+    """
+    precomputations = _PRECOMPUTATIONS.get(datasets['sales'])
+    if precomputations is None:
+        precomputations = {}
+        _PRECOMPUTATIONS.set(datasets['sales'], precomputations)
+    key = id(datasets['customers'])
+    if key not in precomputations:
+        precomputations[key] = Precomputation(datasets, available)
+    return precomputations[key]
@@ -0,0 +1,249 @@
+## This page runs CPU-heavy aggregations in a process pool, handing the datasets over through shared memory
+
+import importlib
+import multiprocessing
+import os
+import pickle
+import sys
+import threading
+import types
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from aggregates import FrameCache
+
+# Worker processes owned by the server process (0 runs everything in the calling thread instead),
+# configured with the DASHLIT_PROCESS_WORKERS environment variable. The default stays small whatever
+# the machine: every worker holds its own copy of the libraries and of the frames it maps
+DEFAULT_PROCESS_WORKERS = 2
+PROCESS_WORKERS = int(os.environ.get('DASHLIT_PROCESS_WORKERS', DEFAULT_PROCESS_WORKERS))
+
+# Shared frames a worker keeps attached (most recently used first out)
+_ATTACHED_PER_WORKER = 4
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+class SharedFrame:
+    """
+    The columns of a DataFrame copied once into a shared memory block, so worker processes can map
+    them without the frame being pickled.
+
+    Numeric, boolean and datetime columns are stored as their raw values (datetimes with their unit
+    and time zone); categorical and text columns as integer codes, with only their distinct values
+    (categories) pickled into the block.
+    The block is released when the frame it was made from is collected.
+    """
+
+    def __init__(self, data, columns=None):
+        columns = list(data.columns) if columns is None else list(columns)
+        parts, self.layout = [], []
+        offset = 0
+        for column in columns:
+            values, kind, extra = _encode_column(data[column])
+            # Distinct values are pickled into the block too, so handles stay small
+            extra = np.frombuffer(pickle.dumps(extra, protocol=pickle.HIGHEST_PROTOCOL), dtype=np.uint8)
+            locations = []
+            for array in (values, extra):
+                parts.append((array, offset))
+                locations.append((offset, len(array)))
+                # Arrays start on 8-byte boundaries
+                offset += -(-array.nbytes // 8) * 8
+            self.layout.append((column, kind, values.dtype.str, *locations))
+
+        self.memory = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for array, start in parts:
+            np.ndarray(array.shape, dtype=array.dtype, buffer=self.memory.buf, offset=start)[:] = array
+        self.name = self.memory.name
+        self._finalizer = weakref.finalize(data, _release, self.memory)
+
+    def handle(self):
+        """
+        Returns what a worker needs to map the frame: the block name and the column layout (picklable).
+        """
+        return self.name, self.layout
+
+
+def _encode_column(values):
+    # Returns (array to share, kind, what is needed to decode it)
+    dtype = values.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        return values.cat.codes.to_numpy(), 'categorical', (dtype.categories, dtype.ordered)
+    if isinstance(dtype, pd.DatetimeTZDtype):
+        return values.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy().view('int64'), 'datetime', (dtype.unit, str(dtype.tz))
+    if pd.api.types.is_datetime64_dtype(dtype):
+        return values.to_numpy().view('int64'), 'datetime', (np.datetime_data(dtype)[0], None)
+    if pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_extension_array_dtype(dtype):
+        return values.to_numpy(), 'numeric', None
+    codes, uniques = pd.factorize(values)
+    return codes, 'text', pd.Index(uniques)
+
+
+def _decode_column(values, kind, extra):
+    if kind == 'categorical':
+        categories, ordered = extra
+        return pd.Categorical.from_codes(values, categories=categories, ordered=ordered)
+    if kind == 'datetime':
+        unit, tz = extra
+        dates = pd.DatetimeIndex(values.view(f'datetime64[{unit}]'))
+        return dates.tz_localize('UTC').tz_convert(tz) if tz else dates
+    if kind == 'text':
+        return np.where(values >= 0, np.asarray(extra, dtype=object)[np.maximum(values, 0)] if len(extra) else None, None)
+    return values
+
+
+def _release(memory):
+    memory.close()
+    memory.unlink()
+
+
+# Shared copies are made once per frame and column set
+_SHARED = FrameCache()
+
+
+def shared_frame(data, columns=None):
+    """
+    Returns the (cached) SharedFrame of the given columns of a frame.
+    """
+    shared = _SHARED.get(data)
+    if shared is None:
+        shared = {}
+        _SHARED.set(data, shared)
+    key = None if columns is None else tuple(columns)
+    if key not in shared:
+        shared[key] = SharedFrame(data, columns)
+    return shared[key]
+
+
+# Frames mapped in a worker process, by block name
+_ATTACHED = OrderedDict()
+
+
+def attach_frame(handle):
+    """
+    Returns the DataFrame behind a SharedFrame handle, in a worker process. Numeric columns are
+    read-only views on the shared block; the mapped frames are kept for the next tasks.
+    """
+    name, layout = handle
+    if name in _ATTACHED:
+        _ATTACHED.move_to_end(name)
+        return _ATTACHED[name][1]
+
+    # Spawned workers share the server's resource tracker, so attaching does not hand the block over to them:
+    # the server unlinks it when the frame is collected
+    memory = shared_memory.SharedMemory(name=name)
+    columns = {}
+    for column, kind, dtype, (offset, length), (extra_offset, extra_length) in layout:
+        values = np.ndarray((length,), dtype=np.dtype(dtype), buffer=memory.buf, offset=offset)
+        values.flags.writeable = False
+        extra = pickle.loads(memory.buf[extra_offset:extra_offset + extra_length])
+        columns[column] = _decode_column(values, kind, extra)
+    frame = pd.DataFrame(columns, copy=False)
+
+    _ATTACHED[name] = (memory, frame)
+    if len(_ATTACHED) > _ATTACHED_PER_WORKER:
+        _, (old_memory, old_frame) = _ATTACHED.popitem(last=False)
+        del old_frame
+        try:
+            old_memory.close()
+        except BufferError:
+            # Still referenced by a result being returned, unmapped when the process exits
+            pass
+    return frame
+
+
+def _run_task(module_name, function_name, cache_name, handles, args):
+    # Worker side: map the frames, run the function and return what it cached for the first frame
+    module = importlib.import_module(module_name)
+    frames = [attach_frame(handle) for handle in handles]
+    getattr(module, function_name)(*frames, *args)
+    return getattr(module, cache_name).get(frames[0])
+
+
+def _wait_for_workers(started):
+    # Worker initializer: no worker takes a task before all of them are started
+    started.wait()
+
+
+def _started():
+    return os.getpid()
+
+
+def _start_executor():
+    # Streamlit installs the app script as __main__, which spawned workers would run again while
+    # starting up. All workers are started here, once, with __main__ hidden for that moment only:
+    # each warm-up task spawns a worker (none is idle while the others wait in their initializer)
+    # and the pool does not spawn again afterwards (a dead worker breaks it, see in_process)
+    context = multiprocessing.get_context('spawn')
+    main = sys.modules.get('__main__')
+    sys.modules['__main__'] = types.ModuleType('__main__')
+    try:
+        # Spawned workers do not inherit the server's threads and locks
+        executor = ProcessPoolExecutor(
+            max_workers=PROCESS_WORKERS, mp_context=context,
+            initializer=_wait_for_workers, initargs=(context.Barrier(PROCESS_WORKERS),)
+        )
+        warm_up = [executor.submit(_started) for _ in range(PROCESS_WORKERS)]
+    finally:
+        sys.modules['__main__'] = main
+    for task in warm_up:
+        task.result()
+    return executor
+
+
+def _executor():
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = _start_executor()
+    return _EXECUTOR
+
+
+def _reset_executor():
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        _EXECUTOR = None
+
+
+def in_process(function, cache_name, columns, *args):
+    """
+    Returns a builder that runs function(*datasets, *args) in the process pool and publishes the value
+    it caches (the module-level FrameCache cache_name of the function's module) for the first dataset
+    in this process, as if it had run here.
+
+    Parameters:
+        - function: module-level function computing and caching an aggregate from one or more frames.
+        - cache_name: name of the FrameCache the function fills, keyed by its first frame.
+        - columns: list with the columns each dataset needs (None for all of them); only those are shared.
+
+    Without worker processes, or if the pool breaks, the function runs in the calling thread.
+    """
+    module = importlib.import_module(function.__module__)
+
+    def build(*datasets):
+        cache = getattr(module, cache_name)
+        if cache.get(datasets[0]) is None:
+            if PROCESS_WORKERS > 0:
+                try:
+                    handles = [shared_frame(data, needed).handle() for data, needed in zip(datasets, columns)]
+                    task = _executor().submit(
+                        _run_task, function.__module__, function.__name__, cache_name, handles, args
+                    )
+                    value = task.result()
+                    if value is not None:
+                        cache.set(datasets[0], value)
+                except BrokenProcessPool:
+                    # A worker died (e.g. out of memory): start a new pool next time, compute this one here
+                    _reset_executor()
+            if cache.get(datasets[0]) is None:
+                function(*datasets, *args)
+        return cache.get(datasets[0])
+
+    return build
@@ -0,0 +1,86 @@
+## This page profiles the import time of the app, to check what a cold start of the server loads
+
+# Usage: python profile_imports.py [--module app_main] [--top 25] [--runs 3]
+#
+# Runs `python -X importtime -c "import <module>"` in fresh interpreters (the app script runs in bare
+# mode, as on the first page load) and prints the total import time with the slowest modules and
+# top-level packages, using the fastest run of each module so disk caches do not skew the summary.
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Lines written by -X importtime: "import time: self [us] | cumulative | imported package"
+IMPORT_TIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def import_times(module):
+    """
+    Returns the import times of one fresh interpreter importing module, as a list of
+    (module name, self time, cumulative time, nesting depth), times in microseconds.
+
+    Parameters:
+        - module: name of the module to import (from the root of the repository).
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    times = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            times.append((name, int(self_us), int(cumulative_us), (len(indent) - 1) // 2))
+    return times
+
+
+def summarize(runs, module, top):
+    """
+    Prints the total import time of module and its slowest imports over several runs.
+
+    Parameters:
+        - runs: list of import_times results.
+        - module: name of the imported module.
+        - top: number of modules and packages listed.
+    """
+    fastest_self = {}
+    for times in runs:
+        for name, self_us, _, _ in times:
+            fastest_self[name] = min(self_us, fastest_self.get(name, self_us))
+
+    totals = [sum(cumulative_us for _, _, cumulative_us, depth in times if depth == 0) for times in runs]
+    print(f"import {module}: {min(totals) / 1000:.0f} ms (fastest of {len(runs)} runs, "
+          f"slowest {max(totals) / 1000:.0f} ms), {len(fastest_self)} modules")
+
+    print("\nSlowest modules (self time, ms):")
+    for name, self_us in sorted(fastest_self.items(), key=lambda item: -item[1])[:top]:
+        print(f"  {self_us / 1000:8.1f}  {name}")
+
+    # Time of each top-level package: self times of all of its modules
+    packages = defaultdict(int)
+    for name, self_us in fastest_self.items():
+        packages[name.split('.')[0]] += self_us
+    print("\nSlowest top-level packages (self time of all their modules, ms):")
+    for name, self_us in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+        print(f"  {self_us / 1000:8.1f}  {name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profiles the import time of the app")
+    parser.add_argument('--module', default='app_main', help="module to import (default: app_main)")
+    parser.add_argument('--top', type=int, default=25, help="number of modules and packages listed")
+    parser.add_argument('--runs', type=int, default=3, help="fresh interpreters to run")
+    options = parser.parse_args()
+
+    runs = [import_times(options.module) for _ in range(options.runs)]
+    summarize(runs, options.module, options.top)
+
+
+if __name__ == '__main__':
+    main()
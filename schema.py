@@ -0,0 +1,149 @@
+## This page validates uploaded data against the documented sales and customer schemas
+
+import numpy as np
+import pandas as pd
+
+from aggregates import FrameCache, normalize_labels
+
+# Documented columns (see the Documentation page) and the type they are coerced to
+SALES_SCHEMA = {
+    'order_id': 'string',
+    'order_date': 'datetime',
+    'product_name': 'label',
+    'sales_channel': 'label',
+    'fulfillment_status': 'label',
+    'total_sales_revenue': 'numeric',
+    'discount_amount': 'numeric',
+    'refund_amount': 'numeric',
+    'quantity_sold': 'numeric',
+    'product_revenue': 'numeric',
+    'location': 'label',
+    'discount_code': 'label',
+    'customer_id': 'id'
+}
+CUSTOMER_SCHEMA = {
+    'customer_id': 'id',
+    'email': 'string',
+    'total_orders': 'numeric',
+    'total_spent': 'numeric',
+    'location': 'label',
+    'iso2': 'label',
+    'returning_customer': 'boolean'
+}
+
+# Values of boolean columns (stripped and lowercased) and what they are read as, anything else is invalid
+BOOLEAN_VALUES = {'yes': True, 'true': True, 'no': False, 'false': False}
+
+
+def canonical_ids(values):
+    """
+    Returns identifiers as stripped string labels (categorical), the same whatever type the CSV parser
+    gave them: integral numbers lose their decimal part, as a numeric column with blank rows is parsed
+    as floats (1.0 -> '1'). Each distinct value is converted once.
+    """
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        codes, uniques = pd.factorize(values)
+        ids = np.array([str(int(value)) if float(value).is_integer() else str(value) for value in uniques] + [None], dtype=object)
+        values = pd.Series(ids[codes], index=values.index, name=values.name)
+    return normalize_labels(values, lower=False)
+
+
+def _coerce(values, column_type):
+    if column_type == 'id':
+        return canonical_ids(values)
+    if column_type == 'datetime':
+        return pd.to_datetime(values, errors='coerce', utc=True)
+    if column_type == 'numeric' and not pd.api.types.is_numeric_dtype(values):
+        return pd.to_numeric(values, errors='coerce')
+    if column_type == 'boolean' and not pd.api.types.is_bool_dtype(values):
+        # Read once per distinct value
+        labels = normalize_labels(values)
+        flags = pd.array([BOOLEAN_VALUES.get(label) for label in labels.cat.categories], dtype='boolean')
+        return pd.Series(flags.take(labels.cat.codes.to_numpy(), allow_fill=True), index=values.index, name=values.name)
+    return values
+
+
+def validate_data(data, schema):
+    """
+    Checks and coerces a frame against a schema in one vectorized pass per column.
+
+    Parameters:
+        - data: DataFrame as parsed from the upload.
+        - schema: dict of column name -> 'string', 'label', 'id', 'numeric', 'boolean' or 'datetime'.
+
+    Returns:
+        - The coerced DataFrame. Missing schema columns are added as empty columns so every chart can
+          run its aggregation, but they are marked as unavailable in the report.
+        - A report DataFrame (one row per schema column) with the expected type, whether the column was
+          present, how many values could not be coerced and whether the column is usable ('available').
+
+    Raises a ValueError right away if none of the schema columns are present (e.g. the wrong file was uploaded).
+    """
+    present_columns = [column for column in schema if column in data.columns]
+    if not present_columns:
+        raise ValueError(
+            "None of the expected columns were found. Expected: " + ", ".join(schema)
+        )
+
+    coerced = {}
+    rows = []
+    for column, column_type in schema.items():
+        if column not in data.columns:
+            coerced[column] = _coerce(pd.Series(None, index=data.index, dtype='object'), column_type)
+            rows.append({'column': column, 'type': column_type, 'present': False, 'bad_rows': 0, 'available': False})
+            continue
+        original = data[column]
+        values = _coerce(original, column_type)
+        bad_rows = int((original.notna() & values.isna()).sum()) if values is not original else 0
+        coerced[column] = values
+        rows.append({
+            'column': column,
+            'type': column_type,
+            'present': True,
+            'bad_rows': bad_rows,
+            'available': bool(values.notna().any())
+        })
+
+    report = pd.DataFrame(rows).set_index('column')
+    return data.assign(**coerced), report
+
+
+def combine_reports(report, other):
+    """
+    Returns the validation report of two validated datasets concatenated together.
+    """
+    return pd.DataFrame({
+        'type': report['type'],
+        'present': report['present'] | other['present'],
+        'bad_rows': report['bad_rows'] + other['bad_rows'],
+        'available': report['available'] | other['available']
+    })
+
+
+# Validation reports are kept per frame for as long as the frame is alive
+_REPORTS = FrameCache()
+
+
+def remember_report(data, report):
+    """
+    Registers the validation report of a frame.
+    """
+    _REPORTS.set(data, report)
+
+
+def validation_report(data):
+    """
+    Returns the validation report registered for a frame, or None for frames that were not validated.
+    """
+    return _REPORTS.get(data)
+
+
+def available_columns(data):
+    """
+    Returns the set of usable columns of a frame: the available columns of its validation report,
+    or every column that is not entirely missing for frames that were not validated.
+    """
+    report = validation_report(data)
+    if report is not None:
+        return set(report.index[report['available']])
+    return {column for column in data.columns if data[column].notna().any()}
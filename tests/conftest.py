@@ -0,0 +1,83 @@
+## This page provides the sample and generated datasets the tests run on
+
+import io
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# The app modules are flat files at the root of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from data_store import load_customer_data, load_sales_data  # noqa: E402
+
+APP_FILES = os.path.join(ROOT, 'app_files')
+
+
+def sample_file(file_name):
+    """
+    Returns an upload (file name, raw bytes) of a sample CSV of app_files.
+    """
+    with open(os.path.join(APP_FILES, file_name), 'rb') as file:
+        return file_name, file.read()
+
+
+def generated_sales(orders=400, seed=0, start='2023-01-01'):
+    """
+    Returns raw sales rows (as read from a CSV) of orders with one to four lines each, spread over the two
+    years from start and with labels written in several ways, so filters cut through orders. Orders are
+    placed by the customers of the sample customer data (CUST001 to CUST020) and a few unknown ones.
+    """
+    rng = np.random.default_rng(seed)
+    lines_per_order = rng.integers(1, 5, size=orders)
+    order_ids = np.repeat([f"ORD{number:05d}" for number in range(orders)], lines_per_order)
+    order_dates = np.repeat(
+        pd.Timestamp(start) + pd.to_timedelta(rng.integers(0, 730 * 24 * 3600, size=orders), unit='s'),
+        lines_per_order
+    )
+    customer_ids = np.repeat(rng.choice([f"CUST{number:03d}" for number in range(1, 25)], size=orders), lines_per_order)
+    size = len(order_ids)
+    revenue = rng.uniform(5, 500, size=size).round(2)
+    discount = np.where(rng.random(size) < 0.3, rng.uniform(1, 50, size=size).round(2), 0)
+    return pd.DataFrame({
+        'order_id': order_ids,
+        'order_date': pd.DatetimeIndex(order_dates).strftime('%Y-%m-%d %H:%M:%S'),
+        'product_name': rng.choice(['Lamp', 'Desk', 'Chair', 'Shelf', ' Lamp'], size=size),
+        'sales_channel': rng.choice(['Online', 'In-Store', 'Marketplace'], size=size),
+        'fulfillment_status': rng.choice(['fulfilled', 'Unfulfilled', 'partially fulfilled'], size=size),
+        'total_sales_revenue': revenue + discount,
+        'discount_amount': discount,
+        'refund_amount': np.where(rng.random(size) < 0.1, (revenue * 0.5).round(2), 0),
+        'quantity_sold': rng.integers(1, 6, size=size),
+        'product_revenue': revenue,
+        'location': rng.choice(['London', 'london ', 'Paris', 'Berlin', 'New York'], size=size),
+        'discount_code': np.where(discount > 0, rng.choice(['SPRING', 'spring', 'VIP'], size=size), None),
+        'customer_id': customer_ids
+    })
+
+
+def csv_upload(frame, file_name='sales.csv'):
+    """
+    Returns an upload (file name, raw bytes) of a frame written as CSV.
+    """
+    buffer = io.StringIO()
+    frame.to_csv(buffer, index=False)
+    return file_name, buffer.getvalue().encode()
+
+
+@pytest.fixture(scope='session')
+def sample_sales():
+    return load_sales_data([sample_file('sample_sales_data.csv')])
+
+
+@pytest.fixture(scope='session')
+def sample_customers():
+    return load_customer_data([sample_file('sample_customer_data.csv')])
+
+
+@pytest.fixture(scope='session')
+def sales_data():
+    return load_sales_data([csv_upload(generated_sales())])
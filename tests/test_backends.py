@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from aggregates import AGGREGATE_BACKENDS, backend_differences, build_aggregates
+from conftest import csv_upload, generated_sales, sample_file
+from data_store import load_sales_data
+
+# Optional dependencies of the backends, a backend whose dependency is not installed is skipped
+BACKEND_MODULES = {'pandas': 'pandas', 'duckdb': 'duckdb', 'polars': 'polars'}
+
+LABEL_COLUMNS = ['product_name', 'sales_channel', 'fulfillment_status', 'location', 'discount_code']
+
+
+def _empty():
+    return generated_sales().iloc[:0]
+
+
+def _nan_labels():
+    raw = generated_sales()
+    return raw.assign(**{column: np.nan for column in LABEL_COLUMNS})
+
+
+def _mixed_case_labels():
+    raw = generated_sales()
+    every_other = np.arange(len(raw)) % 2 == 0
+    return raw.assign(**{
+        column: raw[column].str.upper().where(every_other, raw[column].str.lower())
+        for column in LABEL_COLUMNS
+    })
+
+
+def _timezone_aware_dates():
+    raw = generated_sales()
+    dates = pd.to_datetime(raw['order_date']).dt.tz_localize('Europe/Paris', ambiguous='NaT', nonexistent='NaT')
+    return raw.assign(order_date=dates.astype(str))
+
+
+def _integer_discounts():
+    raw = generated_sales()
+    return raw.assign(discount_amount=np.arange(1, len(raw) + 1), refund_amount=0)
+
+
+def _missing_order_ids():
+    raw = generated_sales()
+    return raw.assign(order_id=raw['order_id'].where(np.arange(len(raw)) % 5 != 0))
+
+
+DATASETS = {
+    'sample': lambda: load_sales_data([sample_file('sample_sales_data.csv')]),
+    'generated': lambda: load_sales_data([csv_upload(generated_sales())]),
+    'empty': lambda: load_sales_data([csv_upload(_empty())]),
+    'nan_labels': lambda: load_sales_data([csv_upload(_nan_labels())]),
+    'mixed_case_labels': lambda: load_sales_data([csv_upload(_mixed_case_labels())]),
+    'timezone_aware_dates': lambda: load_sales_data([csv_upload(_timezone_aware_dates())]),
+    'local_timezone': lambda: load_sales_data([csv_upload(generated_sales())]).pipe(
+        lambda data: data.assign(order_date=data['order_date'].dt.tz_convert('America/New_York'))
+    ),
+    'integer_discounts': lambda: load_sales_data([csv_upload(_integer_discounts())]),
+    'missing_order_ids': lambda: load_sales_data([csv_upload(_missing_order_ids())])
+}
+
+
+@pytest.mark.parametrize('backend', list(AGGREGATE_BACKENDS))
+@pytest.mark.parametrize('dataset', list(DATASETS))
+def test_backend_matches_pandas(backend, dataset):
+    pytest.importorskip(BACKEND_MODULES[backend])
+    assert backend_differences(DATASETS[dataset](), backend) == {}
+
+
+@pytest.mark.parametrize('backend', list(AGGREGATE_BACKENDS))
+def test_backend_appends_like_pandas(backend):
+    pytest.importorskip(BACKEND_MODULES[backend])
+    raw = generated_sales()
+    # The second part continues orders of the first one
+    history = load_sales_data([csv_upload(raw.iloc[:700])])
+    new_rows = load_sales_data([csv_upload(raw.iloc[700:])])
+    existing = build_aggregates(history, backend='pandas').orders
+    existing_orders, refunded_orders = existing.index, existing.index[existing['refunded']]
+
+    aggregates = build_aggregates(new_rows, existing_orders, refunded_orders, backend=backend)
+    expected = build_aggregates(new_rows, existing_orders, refunded_orders, backend='pandas')
+    pd.testing.assert_frame_equal(aggregates.monthly_cube, expected.monthly_cube, check_exact=False, rtol=1e-9)
+    pd.testing.assert_frame_equal(aggregates.orders, expected.orders)
+
+
+def test_mixed_case_labels_are_grouped_together():
+    aggregates = build_aggregates(DATASETS['mixed_case_labels'](), backend='pandas')
+    assert list(aggregates.location_totals.index) == ['berlin', 'london', 'new york', 'paris']
+    assert set(aggregates.discount_codes.index) == {'spring', 'vip'}
+
+
+def test_unknown_backend_is_rejected(sample_sales):
+    with pytest.raises(ValueError, match='Unknown aggregate backend'):
+        build_aggregates(sample_sales, backend='spark')
@@ -0,0 +1,463 @@
+import io
+import itertools
+import json
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+import plotly.io
+import pytest
+
+from conftest import csv_upload, generated_sales, sample_file
+from data_store import load_customer_data, load_sales_data
+from definition import CHART_REGISTRY, SHARED_AGGREGATES, control_options, prepare_world_locations
+from filters import filtered_sales
+from schema import available_columns
+
+# Every chart is checked against the same numbers computed directly from the line items with pandas,
+# the way the charts computed them before they were built from the shared aggregates
+
+
+@pytest.fixture(scope='module')
+def recent_sales():
+    # Orders up to today, for the charts of the last days
+    return load_sales_data([csv_upload(generated_sales(start=pd.Timestamp.now(tz='UTC').normalize() - pd.Timedelta(days=700)))])
+
+
+@pytest.fixture(scope='module')
+def world_locations():
+    world_cities = pd.DataFrame({
+        'city_ascii': ['Toronto', 'Tokyo', 'London', 'Singapore', 'Berlin', 'Sydney', 'Paris'],
+        'country': ['Canada', 'Japan', 'United Kingdom', 'Singapore', 'Germany', 'Australia', 'France'],
+        'iso2': ['CA', 'JP', 'GB', 'SG', 'DE', 'AU', 'FR'],
+        'lat': [43.7, 35.7, 51.5, 1.3, 52.5, -33.9, 48.9],
+        'lng': [-79.4, 139.7, -0.1, 103.8, 13.4, 151.2, 2.4]
+    })
+    world_countries = world_cities[['iso2', 'lat', 'lng', 'country']]
+    return prepare_world_locations(world_cities, world_countries)
+
+
+def _data(fig):
+    return json.loads(plotly.io.to_json(fig, validate=False))['data']
+
+
+def _points(traces, x='x', y='y'):
+    # Values of the traces by x (or any other pair of trace attributes), missing values as NaN
+    points = {}
+    for trace in traces:
+        points.update(zip(trace[x], trace[y]))
+    return pd.Series(points, dtype='float64').sort_index()
+
+
+def _assert_points(actual, expected):
+    # Points compared by their x labels as shown on the chart
+    actual = actual.set_axis(actual.index.astype(str))
+    expected = pd.Series(expected, dtype='float64')
+    expected.index = expected.index.astype(str)
+    pd.testing.assert_series_equal(actual.sort_index(), expected.sort_index(), check_names=False, check_index_type=False, rtol=1e-9)
+
+
+def _months(sales):
+    return sales['order_date'].dt.tz_convert(None).dt.to_period('M')
+
+
+def _first_lines(sales):
+    return sales[sales['order_id'].notna()].drop_duplicates('order_id')
+
+
+def _first_refunds(sales):
+    return _first_lines(sales[sales['refund_amount'] > 0])
+
+
+def _order_rate(sales, flags):
+    orders = flags.groupby(sales['order_id']).any()
+    return round(orders.sum() / len(orders) * 100, 2)
+
+
+def _keys(sales, dimensions):
+    return [_months(sales) if name == 'month' else sales[name].astype(str) for name in dimensions]
+
+
+def _channel_metrics(sales, dimensions):
+    # Orders are counted on the first line of each order, refunded orders on their first refunded line
+    first_lines, first_refunds = _first_lines(sales), _first_refunds(sales)
+    metrics = pd.DataFrame({
+        'product_revenue': sales.groupby(_keys(sales, dimensions))['product_revenue'].sum(),
+        'orders': first_lines.groupby(_keys(first_lines, dimensions)).size(),
+        'refunded_orders': first_refunds.groupby(_keys(first_refunds, dimensions)).size()
+    }).fillna({'orders': 0, 'refunded_orders': 0})
+    orders = metrics['orders'].where(metrics['orders'] > 0)
+    metrics['aov'] = metrics['product_revenue'] / orders
+    metrics['refund_rate'] = metrics['refunded_orders'] / orders * 100
+    return metrics
+
+
+def check_revenue_by_month(fig, sales, **kwargs):
+    traces = _data(fig)
+    revenue = sales.groupby(_months(sales))['product_revenue'].sum()
+    _assert_points(_points([trace for trace in traces if trace['name'] != 'Forecast']), revenue.set_axis(revenue.index.strftime('%b-%Y')))
+    forecast = [trace for trace in traces if trace['name'] == 'Forecast']
+    assert [trace['x'] for trace in forecast] == [list(pd.period_range(revenue.index.max() + 1, periods=3, freq='M').strftime('%b-%Y'))]
+    assert np.isfinite(forecast[0]['y']).all()
+
+
+def check_revenue_by_quarter(fig, sales, **kwargs):
+    revenue = sales.groupby(_months(sales).dt.asfreq('Q'))['product_revenue'].sum()
+    _assert_points(_points(_data(fig)), revenue.set_axis(revenue.index.astype(str)))
+
+
+def check_revenue_by_year(fig, sales, **kwargs):
+    revenue = sales.groupby(sales['order_date'].dt.year)['product_revenue'].sum()
+    _assert_points(_points(_data(fig)), revenue)
+
+
+def check_growth_rate(fig, sales, **kwargs):
+    revenue = sales.groupby(_months(sales))['product_revenue'].sum()
+    _assert_points(_points(_data(fig)), (revenue.pct_change() * 100).set_axis(revenue.index.astype(str)))
+
+
+def check_aov(fig, sales, **kwargs):
+    monthly = sales.groupby(_months(sales))['product_revenue']
+    _assert_points(_points(_data(fig)), (monthly.sum() / monthly.count()).set_axis(monthly.sum().index.astype(str)))
+
+
+def check_orders_by_quarter(fig, sales, **kwargs):
+    quarters = _months(sales).groupby(sales['order_id']).min().dt.asfreq('Q')
+    orders = quarters.value_counts()
+    _assert_points(_points(_data(fig)), orders.set_axis(orders.index.astype(str)))
+
+
+def check_avg_discount(fig, sales, **kwargs):
+    discount = sales['discount_amount']
+    assert _data(fig)[0]['y'] == [round(discount[discount > 0].mean(), 2)]
+
+
+def check_discount_usage(fig, sales, **kwargs):
+    assert _data(fig)[0]['value'] == _order_rate(sales, sales['discount_amount'] > 0)
+
+
+def check_last_90_days(fig, sales, **kwargs):
+    hours = sales['order_date'].dt.floor('h')
+    recent = sales[hours >= (pd.Timestamp.utcnow() - pd.Timedelta(days=90)).floor('h')]
+    assert len(recent)
+    hours = recent['order_date'].dt.floor('h')
+    weeks = hours.dt.tz_convert(None).dt.to_period('W')
+    daily = recent.groupby(hours.dt.day_name())['product_revenue'].sum() / weeks.nunique()
+    hourly = recent.groupby([hours.dt.hour, weeks])['product_revenue'].sum().groupby(level=0).mean()
+    days, hour_trend = _data(fig)
+    _assert_points(_points([days]), daily)
+    _assert_points(_points([hour_trend]), hourly)
+
+
+def check_top_discounts(fig, sales, **kwargs):
+    codes = sales['discount_code'].dropna().astype(str).str.strip().str.lower().value_counts()
+    _assert_points(_points(_data(fig)), codes.head(10))
+
+
+def check_top_products(fig, sales, **kwargs):
+    revenue = sales.groupby(sales['product_name'].astype(str))['product_revenue'].sum()
+    _assert_points(_points(_data(fig)), revenue.nlargest(10))
+
+
+def check_product_shares(fig, sales, **kwargs):
+    products = sales.groupby(sales['product_name'].astype(str))['product_revenue']
+    volume, revenue = _data(fig)
+    _assert_points(_points([volume]), products.count() / products.count().sum() * 100)
+    _assert_points(_points([revenue]), products.sum() / products.sum().sum() * 100)
+
+
+def _segment_bins(values, intervals):
+    # Bin edges: the minimum, the base intervals, and the maximum if above them
+    return sorted(set([values.min()] + intervals + ([values.max()] if values.max() > intervals[-1] else [])))
+
+
+def _segment_counts(values, intervals, label):
+    bins = _segment_bins(values, intervals)
+    labels = [label(low, high, high == bins[-1]) for low, high in zip(bins[:-1], bins[1:])]
+    return pd.cut(values, bins=bins, labels=labels, include_lowest=True).value_counts(sort=False)
+
+
+def check_spend_levels(fig, customers, **kwargs):
+    expected = _segment_counts(
+        customers['total_spent'], [100, 500, 1000, 1500], lambda low, high, last: f'{low}+' if last else f'{low}-{high}'
+    )
+    _assert_points(_points(_data(fig)), expected)
+
+
+def check_order_frequency(fig, customers, **kwargs):
+    expected = _segment_counts(
+        customers['total_orders'], [1, 5, 10, 20],
+        lambda low, high, last: f'{low}+ Orders' if last else f'{low}-{high} Orders'
+    )
+    _assert_points(_points(_data(fig)), expected)
+
+
+def check_refund_rate(fig, sales, **kwargs):
+    assert _data(fig)[0]['value'] == _order_rate(sales, sales['refund_amount'] > 0)
+
+
+def check_fulfilled_rate(fig, sales, **kwargs):
+    assert _data(fig)[0]['value'] == _order_rate(sales, sales['fulfillment_status'].astype(str) == 'fulfilled')
+
+
+def check_customer_map(fig, customers, world_cities, **kwargs):
+    matched = customers.assign(location=customers['location'].astype(str), iso2=customers['iso2'].astype(str)).merge(
+        world_cities, left_on=['location', 'iso2'], right_on=['city_ascii', 'iso2']
+    )
+    expected = matched.groupby('location').agg(customers=('customer_id', 'count'), spent=('total_spent', 'sum'))
+    (trace,) = _data(fig)
+    actual = pd.DataFrame({'customers': trace['marker']['size'], 'spent': trace['marker']['color']}, index=trace['hovertext'])
+    pd.testing.assert_frame_equal(actual.sort_index(), expected.sort_index(), check_names=False, check_dtype=False)
+
+
+def check_retention_gauge(fig, customers, **kwargs):
+    # Customers with an unknown status are in neither count
+    returning = customers['returning_customer'].dropna()
+    assert _data(fig)[0]['value'] == round(returning.sum() / len(returning) * 100, 2)
+
+
+def check_new_vs_returning(fig, customers, **kwargs):
+    expected = customers['returning_customer'].map({True: 'Returning', False: 'New'}).fillna('Unknown').value_counts()
+    _assert_points(_points(_data(fig)), expected)
+
+
+def check_sales_by_region(fig, sales, **kwargs):
+    revenue = sales.groupby(sales['location'].astype(str).str.strip().str.lower())['product_revenue'].sum()
+    _assert_points(_points(_data(fig)), revenue.nlargest(10))
+
+
+def check_region_growth(fig, sales, **kwargs):
+    locations = sales['location'].astype(str).str.strip().str.lower()
+    revenue = sales.groupby([locations, _months(sales)])['product_revenue'].sum()
+    traces = _data(fig)
+    regions = [trace for trace in traces if not trace['name'].endswith('(forecast)')]
+    assert sorted(trace['name'] for trace in regions) == sorted(revenue.groupby(level=0).sum().nlargest(10).index)
+    for trace in regions:
+        expected = revenue.loc[trace['name']]
+        _assert_points(_points([trace]), expected.set_axis(expected.index.astype(str)))
+    assert {trace['name'] for trace in traces} - {trace['name'] for trace in regions} <= {f"{trace['name']} (forecast)" for trace in regions}
+
+
+def check_customer_locations(fig, customers, **kwargs):
+    counts = customers['location'].astype(str).str.strip().str.lower().value_counts()
+    _assert_points(_points(_data(fig)), counts.nlargest(10))
+
+
+def check_revenue_by_segment(fig, sales, customers, **kwargs):
+    levels = pd.cut(customers['total_spent'], bins=_segment_bins(customers['total_spent'], [100, 500, 1000, 1500]), include_lowest=True)
+    customer_levels = pd.Series(levels.astype(str).to_numpy(), index=customers['customer_id'].astype(str))
+    known = sales[sales['customer_id'].astype(str).isin(customer_levels.index)]
+    level = known['customer_id'].astype(str).map(customer_levels)
+    (trace,) = _data(fig)
+    assert sum(trace['y']) == pytest.approx(known['product_revenue'].sum())
+    assert sorted(trace['y']) == pytest.approx(sorted(known.groupby(level)['product_revenue'].sum()))
+    orders, customer_counts = zip(*trace['customdata'])
+    assert sum(orders) == known.groupby('customer_id', observed=True)['order_id'].nunique().sum()
+    assert sum(customer_counts) == known['customer_id'].nunique()
+
+
+def check_cohorts(fig, sales, **kwargs):
+    months = _months(sales)
+    active = pd.DataFrame({'customer_id': sales['customer_id'].astype(str), 'month': months}).drop_duplicates()
+    cohort = active.groupby('customer_id')['month'].transform('min')
+    age = (active['month'] - cohort).apply(lambda offset: offset.n)
+    counts = active.groupby([cohort, age]).size().unstack(fill_value=0)
+    retention = counts.div(counts[0], axis=0) * 100
+    span = (months.max() - months.min()).n + 1
+    for cohort_month in retention.index:
+        retention.loc[cohort_month, retention.columns >= span - (cohort_month - months.min()).n] = np.nan
+    (trace,) = _data(fig)
+    assert trace['y'] == list(retention.index.astype(str))
+    actual = pd.DataFrame(trace['z'], dtype='float64').iloc[:, :len(retention.columns)]
+    np.testing.assert_allclose(actual.to_numpy(), retention.to_numpy(), rtol=1e-9)
+
+
+def check_rfm(fig, sales, **kwargs):
+    traces = _data(fig)
+    assert sum(sum(trace['y']) for trace in traces) == sales['customer_id'].nunique()
+    revenue = sum(point[0] for trace in traces for point in trace['customdata'])
+    assert revenue == pytest.approx(sales.loc[sales['customer_id'].notna(), 'product_revenue'].sum())
+
+
+def check_anomalies(fig, sales, measure='revenue', **kwargs):
+    days = sales['order_date'].dt.tz_convert(None).dt.floor('D')
+    column = {'revenue': 'product_revenue', 'refund_rate': 'refund_amount', 'discount_rate': 'discount_amount'}[measure]
+    if measure == 'revenue':
+        daily = sales.groupby(days)[column].sum()
+    else:
+        daily = (sales[column] > 0).groupby(days).mean()
+    daily = daily.reindex(pd.date_range(daily.index.min(), daily.index.max(), freq='D'))
+    if measure == 'revenue':
+        daily = daily.fillna(0)
+    values, baseline, anomalies = _data(fig)
+    actual = pd.Series(values['y'], index=pd.to_datetime(values['x']), dtype='float64')
+    pd.testing.assert_series_equal(actual, daily, check_names=False, check_freq=False, rtol=1e-9)
+    assert set(anomalies['x']) <= set(values['x'])
+
+
+def check_product_pairs(fig, sales, **kwargs):
+    baskets = sales.groupby('order_id')['product_name'].agg(lambda products: set(products.astype(str)))
+    product_orders = pd.Series([product for basket in baskets for product in basket]).value_counts()
+    pairs = pd.Series([pair for basket in baskets for pair in combinations(sorted(basket), 2)]).value_counts()
+    pairs = pairs[pairs >= 2]
+    lift = pd.Series({
+        f'{a} + {b}': together * len(baskets) / (product_orders[a] * product_orders[b])
+        for (a, b), together in pairs.items()
+    })
+    actual = _points(_data(fig), 'y', 'x')
+    assert len(actual) == min(10, len(lift))
+    _assert_points(actual, lift[actual.index])
+    if len(lift) > len(actual):
+        assert actual.min() >= lift.drop(actual.index).max()
+
+
+def check_channel_by_month(fig, sales, metric='product_revenue', **kwargs):
+    metrics = _channel_metrics(sales, ['sales_channel', 'month'])[metric]
+    for trace in _data(fig):
+        expected = metrics.loc[trace['name']]
+        _assert_points(_points([trace]), expected.set_axis(expected.index.astype(str)))
+    assert sorted(trace['name'] for trace in _data(fig)) == sorted(metrics.index.get_level_values(0).unique())
+
+
+def check_channel_fulfillment(fig, sales, metric='product_revenue', **kwargs):
+    metrics = _channel_metrics(sales, ['fulfillment_status', 'sales_channel'])[metric]
+    for trace in _data(fig):
+        _assert_points(_points([trace]), metrics.loc[trace['name']])
+    assert sorted(trace['name'] for trace in _data(fig)) == sorted(metrics.index.get_level_values(0).unique())
+
+
+def check_period_comparison(fig, sales, comparison='yoy', metric='product_revenue', **kwargs):
+    months = _months(sales)
+    first_lines, first_refunds = _first_lines(sales), _first_refunds(sales)
+    monthly = pd.DataFrame({
+        'product_revenue': sales.groupby(months)['product_revenue'].sum(),
+        'orders': first_lines.groupby(_months(first_lines)).size(),
+        'refunded_orders': first_refunds.groupby(_months(first_refunds)).size(),
+        'discount_rate': (sales['discount_amount'] > 0).groupby(months).mean() * 100
+    })
+    monthly = monthly.reindex(pd.period_range(months.min(), months.max(), freq='M'))
+    counts = ['product_revenue', 'orders', 'refunded_orders']
+    monthly[counts] = monthly[counts].fillna(0)
+    orders = monthly['orders'].where(monthly['orders'] > 0)
+    monthly['aov'] = monthly['product_revenue'] / orders
+    monthly['refund_rate'] = monthly['refunded_orders'] / orders * 100
+    current = monthly[metric]
+    previous = current.shift({'yoy': 12, 'mom': 1}[comparison])
+    if metric in ('refund_rate', 'discount_rate'):
+        change = current - previous
+    else:
+        change = (current / previous.where(previous != 0) - 1) * 100
+    change = change.dropna()
+    _assert_points(_points(_data(fig)), change.set_axis(change.index.astype(str)))
+
+
+CHECKS = {
+    'plot_total_sales_revenue_by_month': check_revenue_by_month,
+    'plot_total_sales_by_quarter_with_filter': check_revenue_by_quarter,
+    'plot_total_sales_by_year': check_revenue_by_year,
+    'plot_sales_growth_rate_by_month': check_growth_rate,
+    'plot_aov_by_month': check_aov,
+    'plot_total_orders_by_quarter': check_orders_by_quarter,
+    'plot_avg_discounted_amount': check_avg_discount,
+    'plot_discount_usage_rate': check_discount_usage,
+    'plot_average_daily_and_hourly_sales_last_90_days': check_last_90_days,
+    'plot_top_discounts': check_top_discounts,
+    'plot_top_selling_products': check_top_products,
+    'plot_combined_product_sales_with_labels': check_product_shares,
+    'segment_by_spend_level': check_spend_levels,
+    'plot_refund_rate_with_threshold_label': check_refund_rate,
+    'plot_fulfilled_order_rate_all_orders': check_fulfilled_rate,
+    'segment_by_order_frequency': check_order_frequency,
+    'visualize_customer_distribution_city': check_customer_map,
+    'plot_customer_retention_rate_as_gauge': check_retention_gauge,
+    'plot_new_vs_returning_customers': check_new_vs_returning,
+    'plot_sales_by_region': check_sales_by_region,
+    'plot_region_sales_growth': check_region_growth,
+    'segment_by_location': check_customer_locations,
+    'plot_revenue_by_customer_segment': check_revenue_by_segment,
+    'plot_cohort_retention_heatmap': check_cohorts,
+    'plot_rfm_segments': check_rfm,
+    'plot_daily_anomalies': check_anomalies,
+    'plot_product_pairs_by_lift': check_product_pairs,
+    'plot_channel_sales_by_month': check_channel_by_month,
+    'plot_channel_fulfillment_breakdown': check_channel_fulfillment,
+    'plot_period_comparison': check_period_comparison
+}
+
+
+def test_every_chart_is_checked():
+    assert set(CHECKS) == set(CHART_REGISTRY)
+
+
+def _control_values(spec, available):
+    # Every combination of the values of the chart's controls
+    options = {argument: list(control_options(control, available)[1]) for argument, control in spec.controls.items()}
+    return [dict(zip(options, values)) for values in itertools.product(*options.values())]
+
+
+# Deprecation warnings of pandas (e.g. groupby defaults) fail the charts, before a pandas upgrade changes their output
+@pytest.mark.filterwarnings('error::FutureWarning')
+@pytest.mark.parametrize('name', list(CHART_REGISTRY))
+def test_chart_matches_line_items(name, sales_data, recent_sales, sample_customers, world_locations):
+    spec = CHART_REGISTRY[name]
+    sales = recent_sales if name == 'plot_average_daily_and_hourly_sales_last_90_days' else sales_data
+    world_cities, world_countries = world_locations
+    datasets = {'sales': sales, 'customers': sample_customers, 'world_cities': world_cities, 'world_countries': world_countries}
+    available = {'sales': available_columns(sales), 'customers': available_columns(sample_customers)}
+    assert not spec.missing_inputs(available)
+
+    # The shared aggregates are prepared first, as on the Data Analyzer page
+    for aggregate in spec.aggregates:
+        names, build = SHARED_AGGREGATES[aggregate]
+        build(*[datasets[dataset] for dataset in names])
+
+    for kwargs in _control_values(spec, available):
+        fig = spec.function(*[datasets[dataset] for dataset in spec.datasets], **kwargs)
+        assert fig is not None and _data(fig)
+        CHECKS[name](fig, **datasets, **kwargs)
+
+
+@pytest.fixture(scope='module')
+def customers_with_unknown_status():
+    raw = pd.read_csv(io.BytesIO(sample_file('sample_customer_data.csv')[1]))
+    raw.loc[raw.index[::4], 'returning_customer'] = None
+    return load_customer_data([csv_upload(raw, 'customers.csv')])
+
+
+@pytest.mark.parametrize('name', ['plot_customer_retention_rate_as_gauge', 'plot_new_vs_returning_customers'])
+def test_unknown_returning_status_is_kept_apart(name, customers_with_unknown_status):
+    customers = customers_with_unknown_status
+    assert customers['returning_customer'].isna().sum() == 5
+    fig = CHART_REGISTRY[name].function(customers)
+    CHECKS[name](fig, customers=customers)
+
+
+def test_retention_gauge_without_known_status(customers_with_unknown_status):
+    customers = customers_with_unknown_status.assign(returning_customer=pd.NA).astype({'returning_customer': 'boolean'})
+    assert CHART_REGISTRY['plot_customer_retention_rate_as_gauge'].function(customers) is None
+
+
+@pytest.mark.parametrize('name', [
+    'plot_discount_usage_rate', 'plot_refund_rate_with_threshold_label', 'plot_fulfilled_order_rate_all_orders'
+])
+def test_order_rate_gauges_of_an_empty_selection(name, sales_data):
+    fig = CHART_REGISTRY[name].function(filtered_sales(sales_data, {'product_name': []}))
+    assert _data(fig)[0]['value'] == 0
+
+
+@pytest.mark.parametrize('name', list(CHART_REGISTRY))
+def test_chart_of_an_empty_selection(name, sales_data, sample_customers, world_locations):
+    # Sidebar filters and chart selections matching no line item are valid, the charts draw nothing or empty figures
+    spec = CHART_REGISTRY[name]
+    view = filtered_sales(sales_data, {'product_name': []})
+    world_cities, world_countries = world_locations
+    datasets = {
+        'sales': view.lines if spec.row_level else view, 'customers': sample_customers,
+        'world_cities': world_cities, 'world_countries': world_countries
+    }
+    available = {'sales': available_columns(sales_data), 'customers': available_columns(sample_customers)}
+    for aggregate in spec.aggregates:
+        names, build = SHARED_AGGREGATES[aggregate]
+        build(*[datasets[dataset] for dataset in names])
+    for kwargs in _control_values(spec, available):
+        spec.function(*[datasets[dataset] for dataset in spec.datasets], **kwargs)
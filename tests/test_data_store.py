@@ -0,0 +1,108 @@
+import gc
+import io
+import weakref
+import zipfile
+
+import pandas as pd
+import pytest
+
+from aggregates import sales_aggregates
+from conftest import csv_upload, generated_sales, sample_file
+from customers import attach_customer_attributes, customer_index, sales_by_customer_attribute
+from data_store import (
+    SALES_LABEL_COLUMNS, UploadProgress, append_sales_data, load_customer_data, load_sales_data, read_csv_files
+)
+
+
+def _zip_upload(members, file_name='sales.zip'):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for member_name, content in members:
+            archive.writestr(member_name, content)
+    return file_name, buffer.getvalue()
+
+
+def test_zip_with_several_monthly_csvs():
+    raw = generated_sales()
+    months = raw['order_date'].str[:7]
+    monthly = [(f"exports/sales_{month}.csv", csv_upload(rows)[1]) for month, rows in raw.groupby(months)]
+    members = monthly + [
+        ('exports/', b''),
+        ('exports/README.txt', b'Monthly sales exports'),
+        ('__MACOSX/exports/._sales_2023-01.csv', b'\x00\x05\x16\x07')
+    ]
+    upload = _zip_upload(members)
+    progress = UploadProgress(total_bytes=len(upload[1]))
+
+    sales_data = load_sales_data([upload], progress)
+    assert len(sales_data) == len(raw)
+    assert set(sales_data['order_id']) == set(raw['order_id'])
+    assert progress.details['rows'] == len(raw)
+    assert progress.bytes_read > 0
+
+
+def test_zip_members_and_plain_files_are_combined():
+    raw = generated_sales()
+    upload = _zip_upload([('part1.csv', csv_upload(raw.iloc[:300])[1]), ('part2.csv', csv_upload(raw.iloc[300:600])[1])])
+    combined = read_csv_files([upload, csv_upload(raw.iloc[600:])])
+    assert len(combined) == len(raw)
+    assert list(combined['order_id']) == list(raw['order_id'])
+
+
+def test_zip_without_csv_is_rejected():
+    with pytest.raises(ValueError, match='No CSV file found in notes.zip'):
+        read_csv_files([_zip_upload([('notes.txt', b'nothing here')], 'notes.zip')])
+
+
+def test_appending_new_labels_keeps_categoricals():
+    raw = generated_sales()
+    new_rows = raw.iloc[700:].copy()
+    # Labels the history has never seen
+    new_rows.loc[new_rows.index[:10], 'product_name'] = 'Sofa'
+    new_rows.loc[new_rows.index[:10], 'location'] = 'Tokyo'
+    history = load_sales_data([csv_upload(raw.iloc[:700])])
+    sales_aggregates(history)
+
+    combined = append_sales_data(history, [csv_upload(new_rows)])
+    expected = load_sales_data([csv_upload(raw.iloc[:700]), csv_upload(new_rows)])
+    for column in SALES_LABEL_COLUMNS:
+        if column in expected.columns:
+            assert combined[column].dtype == expected[column].dtype
+
+    aggregates, full = sales_aggregates(combined), sales_aggregates(expected)
+    pd.testing.assert_frame_equal(aggregates.monthly_cube, full.monthly_cube, check_exact=False, rtol=1e-9)
+    pd.testing.assert_frame_equal(aggregates.daily_cube, full.daily_cube, check_exact=False, rtol=1e-9)
+
+
+def _numeric_id_uploads():
+    # Customer ids 1 to 20: a blank id in the sales rows makes the CSV parser read them as floats
+    raw = generated_sales(orders=200, seed=6)
+    raw['customer_id'] = raw['customer_id'].str[4:].astype(int)
+    raw['customer_id'] = raw['customer_id'].where(raw.index != 3)
+    customers = pd.read_csv(io.BytesIO(sample_file('sample_customer_data.csv')[1]))
+    customers['customer_id'] = range(1, len(customers) + 1)
+    return csv_upload(raw), csv_upload(customers, 'customers.csv')
+
+
+def test_numeric_customer_ids_match_with_blank_rows():
+    sales_upload, customer_upload = _numeric_id_uploads()
+    sales = load_sales_data([sales_upload])
+    customers = load_customer_data([customer_upload])
+    assert sales['customer_id'].isna().sum() == 1
+    assert set(sales['customer_id'].dropna()) <= {str(number) for number in range(1, 25)}
+
+    iso2 = attach_customer_attributes(sales, customers, ['iso2'])['iso2']
+    known = sales['customer_id'].astype(object).isin(set(customers['customer_id']))
+    assert known.sum() > 0
+    assert iso2[known].notna().all()
+    summary = sales_by_customer_attribute(sales, customers, 'iso2')
+    assert summary['customers'].sum() == sales.loc[known, 'customer_id'].nunique()
+
+
+def test_customer_index_does_not_keep_customers_alive():
+    customers = load_customer_data([sample_file('sample_customer_data.csv')])
+    customer_index(customers)
+    collected = weakref.ref(customers)
+    del customers
+    gc.collect()
+    assert collected() is None
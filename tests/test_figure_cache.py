@@ -0,0 +1,75 @@
+from datetime import datetime, timezone
+
+import plotly.graph_objects as go
+import pytest
+
+import figure_cache
+from figure_cache import cached_figure
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    figure_cache._figure_json.clear()
+    yield
+    figure_cache._figure_json.clear()
+
+
+class Chart:
+    # Chart function counting how often the figure is built
+    def __init__(self, figure=True):
+        self.builds = 0
+        self.figure = figure
+
+    def __call__(self, values, title='Chart'):
+        self.builds += 1
+        if not self.figure:
+            return None
+        return go.Figure(go.Bar(x=['a', 'b'], y=values), layout=dict(title=title))
+
+
+def test_figure_is_built_once_per_data_and_parameters():
+    chart = Chart()
+    first = cached_figure('chart', ('data', 1), chart, [1, 2])
+    again = cached_figure('chart', ('data', 1), chart, [1, 2])
+    assert chart.builds == 1
+    assert first.to_plotly_json() == again.to_plotly_json() == chart([1, 2]).to_plotly_json()
+
+    cached_figure('chart', ('data', 2), chart, [3, 4])
+    cached_figure('chart', ('data', 1), chart, [1, 2], title='Other')
+    assert chart.builds == 4
+
+
+def test_cached_figure_is_a_plotly_figure():
+    fig = cached_figure('chart', ('data', 1), Chart(), [1, 2], title='Revenue')
+    assert isinstance(fig, go.Figure)
+    assert list(fig.data[0].y) == [1, 2]
+    assert fig.layout.title.text == 'Revenue'
+    fig.update_layout(height=300)
+    assert fig.to_dict()['layout']['height'] == 300
+
+
+def test_charts_without_figure_are_not_cached():
+    chart = Chart(figure=False)
+    assert cached_figure('chart', ('data', 1), chart, [1, 2]) is None
+    assert cached_figure('chart', ('data', 1), chart, [1, 2]) is None
+    assert chart.builds == 2
+
+
+def test_time_relative_figures_are_rebuilt_every_hour(monkeypatch):
+    now = [datetime(2026, 1, 5, 9, 10, tzinfo=timezone.utc)]
+
+    class Clock:
+        @staticmethod
+        def now(tz=None):
+            return now[0]
+
+    monkeypatch.setattr(figure_cache, 'datetime', Clock)
+    chart = Chart()
+    cached_figure('chart', ('data', 1), chart, [1, 2], time_relative=True)
+    now[0] = datetime(2026, 1, 5, 9, 50, tzinfo=timezone.utc)
+    cached_figure('chart', ('data', 1), chart, [1, 2], time_relative=True)
+    assert chart.builds == 1
+
+    now[0] = datetime(2026, 1, 5, 10, 0, tzinfo=timezone.utc)
+    cached_figure('chart', ('data', 1), chart, [1, 2], time_relative=True)
+    assert chart.builds == 2
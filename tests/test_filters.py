@@ -0,0 +1,152 @@
+import gc
+import weakref
+
+import pandas as pd
+import pytest
+
+from aggregates import CUBE_DIMENSIONS, cube_lines, period_comparison
+from conftest import csv_upload, generated_sales
+from data_store import load_sales_data
+from filters import _VIEWS_PER_DATASET, FilteredAggregates, combine_selections, filter_options, filtered_sales, selection_values
+
+# Selections cutting through orders: their lines fall in several products, locations and channels
+SELECTIONS = [
+    {'product_name': ['Chair']},
+    {'location': ['london', 'paris']},
+    {'sales_channel': ['Online']},
+    {'month': selection_values('month', ['2023-03', '2023-04', '2024-11'])},
+    {'year': [2024], 'product_name': ['Desk', 'Lamp'], 'sales_channel': ['In-Store', 'Marketplace']}
+]
+
+
+@pytest.mark.parametrize('selection', SELECTIONS)
+def test_filtered_order_counts_match_distinct_orders(sales_data, selection):
+    view = filtered_sales(sales_data, selection)
+    lines = view.lines
+    assert len(lines)
+
+    # Every order of the selection is counted once, in the month of its first selected line
+    first_lines = lines.drop_duplicates('order_id')
+    expected = first_lines.groupby(first_lines['order_date'].dt.tz_convert(None).dt.to_period('M')).size()
+    orders = view.monthly_totals()['orders']
+    assert orders.sum() == lines['order_id'].nunique()
+    pd.testing.assert_series_equal(orders, expected, check_names=False, check_index_type=False, check_dtype=False)
+
+    for levels in [['sales_channel', 'month'], ['fulfillment_status'], ['product_name']]:
+        assert view.rollup(levels)['orders'].sum() == lines['order_id'].nunique()
+    assert period_comparison(view, 1)['orders'].sum() == lines['order_id'].nunique()
+
+
+@pytest.mark.parametrize('selection', SELECTIONS)
+def test_filtered_cube_matches_selected_lines(sales_data, selection):
+    # Served from the cells of the full cube, with the orders counted again on the selected lines
+    view = FilteredAggregates(sales_data, selection)
+    expected = cube_lines(view.lines).groupby(CUBE_DIMENSIONS, dropna=False, observed=True).sum()
+    pd.testing.assert_frame_equal(
+        view.monthly_cube.sort_index(), expected.sort_index(), check_exact=False, rtol=1e-9, check_index_type=False
+    )
+
+
+def test_views_do_not_keep_frames_alive():
+    sales = load_sales_data([csv_upload(generated_sales(orders=300, seed=4))])
+    months = filter_options(sales)['month']
+    lines = [weakref.ref(filtered_sales(sales, {'month': [month]}).lines) for month in months]
+    assert len(lines) > _VIEWS_PER_DATASET
+    gc.collect()
+    # Only the line items of the views still cached are alive
+    assert sum(ref() is not None for ref in lines) == _VIEWS_PER_DATASET
+
+    view = filtered_sales(sales, {'month': months[:1]})
+    collected = weakref.ref(sales)
+    del sales
+    gc.collect()
+    assert collected() is None
+    assert view.product_totals['product_revenue'].sum() > 0
+
+
+def test_filtered_aov_matches_line_items(sales_data):
+    view = filtered_sales(sales_data, {'product_name': ['Shelf']})
+    lines = view.lines
+    channels = view.rollup(['sales_channel'])
+    expected = lines.groupby('sales_channel', observed=True).agg(
+        product_revenue=('product_revenue', 'sum'),
+        orders=('order_id', 'nunique')
+    )
+    for channel, row in expected.iterrows():
+        assert channels.loc[channel, 'product_revenue'] == pytest.approx(row['product_revenue'])
+    # Orders of several channels are counted in the channel of their first line, in total once each
+    assert channels['orders'].sum() == lines['order_id'].nunique()
+    assert (channels['orders'] <= expected['orders'].reindex(channels.index)).all()
+
+
+def test_unfiltered_options_list_every_value(sales_data):
+    options = filter_options(sales_data)
+    assert options['location'] == ['berlin', 'london', 'new york', 'paris']
+    assert options['product_name'] == ['Chair', 'Desk', 'Lamp', 'Shelf']
+
+
+def _mask(sales_data, selection):
+    # Plain boolean mask of a selection over the line items
+    months = sales_data['order_date'].dt.tz_convert(None).dt.to_period('M')
+    mask = pd.Series(True, index=sales_data.index)
+    for dimension, values in selection.items():
+        if dimension == 'month':
+            mask &= months.isin(values)
+        elif dimension == 'year':
+            mask &= months.dt.year.isin(values)
+        else:
+            mask &= sales_data[dimension].astype(str).str.strip().str.lower().isin([str(value).lower() for value in values])
+    return mask
+
+
+# Sidebar filters (as set in the Filters expander) and chart selections (as clicked point labels)
+SIDEBAR_FILTERS = [
+    {'month': selection_values('month', [f'2023-{month:02d}' for month in range(3, 13)])},
+    {'location': ['london', 'berlin'], 'sales_channel': ['Online', 'Marketplace']},
+    {'product_name': ['Lamp', 'Chair', 'Shelf'], 'month': selection_values('month', ['2024-01', '2024-02', '2024-03'])}
+]
+CROSS_FILTERS = [
+    {},
+    {'year': selection_values('year', ['2023'])},
+    {'product_name': selection_values('product_name', ['Lamp', ' Desk'])},
+    {'location': selection_values('location', ['London', 'New York']), 'year': selection_values('year', [2023, 2024])}
+]
+
+
+@pytest.mark.parametrize('sidebar', SIDEBAR_FILTERS)
+@pytest.mark.parametrize('cross_filter', CROSS_FILTERS)
+def test_sidebar_and_cross_filters_match_boolean_mask(sales_data, sidebar, cross_filter):
+    selection = combine_selections(sidebar, cross_filter)
+    view = filtered_sales(sales_data, selection)
+    expected = sales_data[_mask(sales_data, sidebar) & _mask(sales_data, cross_filter)].reset_index(drop=True)
+
+    pd.testing.assert_frame_equal(view.lines, expected)
+
+    months = expected['order_date'].dt.tz_convert(None).dt.to_period('M')
+    totals = view.monthly_totals()
+    revenue = expected.groupby(months)['product_revenue'].sum()
+    pd.testing.assert_series_equal(totals['product_revenue'], revenue, check_names=False, check_index_type=False)
+    assert totals['lines'].sum() == len(expected)
+    assert totals['orders'].sum() == expected['order_id'].nunique()
+    assert totals['refunded_lines'].sum() == (expected['refund_amount'] > 0).sum()
+    assert totals['refunded_orders'].sum() == expected.loc[expected['refund_amount'] > 0, 'order_id'].nunique()
+
+    for dimension, totals_by_value in [('product_name', view.product_totals), ('location', view.location_totals)]:
+        revenue = expected.groupby(expected[dimension].astype(object).astype(str))['product_revenue'].sum()
+        pd.testing.assert_series_equal(
+            totals_by_value['product_revenue'].sort_index(), revenue.sort_index(), check_names=False, check_index_type=False
+        )
+
+    days = expected['order_date'].dt.tz_convert(None).dt.floor('D')
+    daily = view.daily_cube['product_revenue'].groupby(level='day').sum()
+    pd.testing.assert_series_equal(
+        daily, expected.groupby(days)['product_revenue'].sum(), check_names=False, check_index_type=False
+    )
+    assert view.orders.index.nunique() == expected['order_id'].nunique()
+
+
+def test_combined_selections_intersect_values():
+    assert combine_selections(
+        {'product_name': ['Lamp', 'Desk'], 'month': ['2024-01']},
+        {'product_name': ['Desk', 'Chair']}
+    ) == {'product_name': ['Desk'], 'month': ['2024-01']}
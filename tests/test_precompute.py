@@ -0,0 +1,74 @@
+import gc
+import threading
+import time
+import weakref
+
+import pytest
+
+import precompute
+from conftest import csv_upload, generated_sales
+from data_store import DATASET_STORE, DatasetLease, load_sales_data
+from precompute import Precomputation, precompute_datasets
+from schema import available_columns
+
+
+@pytest.fixture
+def counted_builds(monkeypatch):
+    # Every shared aggregate counts its builds, and is slow enough for the callers to overlap
+    counts = {}
+    lock = threading.Lock()
+
+    def counted(aggregate, build):
+        def run(*datasets):
+            with lock:
+                counts[aggregate] = counts.get(aggregate, 0) + 1
+            time.sleep(0.01)
+            return build(*datasets)
+        return run
+
+    for aggregate, (names, build) in list(precompute.SHARED_AGGREGATES.items()):
+        monkeypatch.setitem(precompute.SHARED_AGGREGATES, aggregate, (names, counted(aggregate, build)))
+    return counts
+
+
+def test_aggregates_are_built_once_by_concurrent_sessions(counted_builds):
+    sales = load_sales_data([csv_upload(generated_sales(orders=200, seed=3))])
+    # The background workers are held back, so the sessions claim the aggregates before them
+    release = threading.Event()
+    blockers = [precompute._EXECUTOR.submit(release.wait) for _ in range(precompute.PRECOMPUTE_WORKERS)]
+    precomputation = Precomputation({'sales': sales, 'customers': None}, {'sales': available_columns(sales)})
+    aggregates = list(dict.fromkeys(aggregate for aggregate, _ in precomputation._futures))
+    assert aggregates
+
+    results = []
+
+    def session():
+        results.append([precomputation.wait(aggregate, [sales]) for aggregate in aggregates])
+
+    sessions = [threading.Thread(target=session) for _ in range(4)]
+    for thread in sessions:
+        thread.start()
+    for thread in sessions:
+        thread.join()
+    release.set()
+    for blocker in blockers:
+        blocker.result()
+    precomputation._job.result()
+
+    assert results == [[True] * len(aggregates)] * len(sessions)
+    assert counted_builds == {aggregate: 1 for aggregate in aggregates}
+
+
+def test_released_upload_is_collected_after_precomputation():
+    upload = csv_upload(generated_sales(orders=150, seed=5))
+    lease = DatasetLease(DATASET_STORE, 'sales:precompute-test', lambda: load_sales_data([upload]))
+    sales = lease.value
+    precomputation = precompute_datasets({'sales': sales, 'customers': None}, {'sales': available_columns(sales)})
+    precomputation._job.result()
+    collected = weakref.ref(sales)
+
+    # As when the session ends: its lease is released and dropped
+    lease.release()
+    del sales, precomputation, lease
+    gc.collect()
+    assert collected() is None
@@ -0,0 +1,57 @@
+import pandas as pd
+import pytest
+
+from baskets import product_pairs
+from conftest import csv_upload, generated_sales
+from customers import cohort_matrix, customer_sales_rollup
+from data_store import load_sales_data
+from process_pool import attach_frame, shared_frame
+
+
+@pytest.mark.parametrize('unit', ['s', 'ms', 'us', 'ns'])
+@pytest.mark.parametrize('tz', [None, 'UTC', 'America/Toronto'])
+def test_shared_dates_keep_their_unit_and_time_zone(unit, tz):
+    dates = pd.Series(pd.to_datetime(['2023-01-01 08:30:00', None, '2024-06-30 23:59:59']), name='order_date')
+    dates = (dates.dt.tz_localize(tz) if tz else dates).dt.as_unit(unit)
+    data = pd.DataFrame({'order_date': dates, 'order_id': [1, 2, 3]})
+
+    shared = attach_frame(shared_frame(data).handle())
+    assert shared['order_date'].dtype == data['order_date'].dtype
+    pd.testing.assert_frame_equal(shared, data)
+
+
+@pytest.fixture
+def process_pool():
+    # A pool of its own, shut down after the test
+    import process_pool
+
+    process_pool._reset_executor()
+    yield process_pool
+    if process_pool._EXECUTOR is not None:
+        process_pool._EXECUTOR.shutdown()
+    process_pool._reset_executor()
+
+
+@pytest.mark.parametrize('function, cache_name, columns', [
+    (customer_sales_rollup, '_ROLLUPS', ['customer_id', 'order_id', 'order_date', 'product_revenue']),
+    (cohort_matrix, '_COHORTS', ['customer_id', 'order_date']),
+    (product_pairs, '_PAIRS', ['order_id', 'product_name'])
+])
+def test_aggregate_built_in_the_pool_matches_the_local_one(process_pool, monkeypatch, function, cache_name, columns):
+    monkeypatch.setattr(process_pool, 'PROCESS_WORKERS', 2)
+    # A broken pool would fall back to the local computation
+    monkeypatch.setattr(process_pool, '_reset_executor', lambda: pytest.fail("the process pool broke"))
+
+    # Separate loads of the same upload, so neither finds the other's value in the cache
+    upload = csv_upload(generated_sales(orders=300, seed=3))
+    pooled_sales = load_sales_data([upload])
+    process_pool.in_process(function, cache_name, [columns])(pooled_sales)
+    # The function finds the value published by the pool in its cache
+    pooled = function(pooled_sales)
+    local = function(load_sales_data([upload]))
+
+    assert process_pool._EXECUTOR is not None
+    if isinstance(local, pd.DataFrame):
+        pd.testing.assert_frame_equal(pooled, local)
+    else:
+        pd.testing.assert_series_equal(pooled, local)